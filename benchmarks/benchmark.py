@@ -0,0 +1,357 @@
+'''Benchmarks for the TSVx library.
+
+This generates a synthetic TSVx file (and an equivalent CSV file), and
+times the reader, the writer, type guessing, and conversion. The
+stdlib `csv` module serves as a baseline. For each benchmark, we record
+rows per second, and peak Python memory (via `tracemalloc`, in a
+second, untimed run). Memory of worker processes isn't counted.
+
+Results are appended as JSON lines to a results file, tagged with the
+git revision, so runs can be compared between revisions.
+
+Usage:
+  benchmark.py [--rows=<rows>] [--columns=<columns>] [--types=<types>]
+               [--only=<names>] [--label=<label>] [--results=<file>]
+               [--no-memory]
+  benchmark.py compare <old> <new> [--results=<file>]
+  benchmark.py list
+  benchmark.py -h | --help
+
+Options:
+  --rows=<rows>        Rows in the synthetic file [default: 100000]
+  --columns=<columns>  Columns in the synthetic file [default: 10]
+  --types=<types>      Comma-separated type mix, cycled across columns.
+                       From int, float, str, date, datetime, and bool.
+                       [default: int,float,str,date,datetime,bool]
+  --only=<names>       Comma-separated list of benchmarks to run
+  --label=<label>      Label for this run (e.g. a branch name)
+  --results=<file>     Results file (by default, results.jsonl next to
+                       this script)
+  --no-memory          Skip the memory measurement runs
+
+`compare` prints the most recent results for two revisions (or labels)
+side by side.
+'''
+
+import collections
+import csv
+import datetime
+import json
+import os
+import os.path
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import docopt
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import tsvx
+import tsvx.convert
+import tsvx.parser
+
+# Type guessing is slow (it falls back to dateutil), so we only guess
+# on the first few rows.
+GUESS_ROWS = 10000
+
+# Number of fresh interpreters for timing `import tsvx`
+IMPORT_RUNS = 20
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+RESULTS = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                       "results.jsonl")
+
+# Strings with things that need escaping. No newlines, so the CSV
+# version can be converted in parallel.
+STRINGS = ["plain", "tab\there", 'quote"d', "back\\slash", "ünïcode",
+           "comma, separated"]
+
+
+def _random_value(rng, type_name):
+    '''
+    A random Python value of one of the benchmark types
+    '''
+    if type_name == "int":
+        return rng.randint(-10**9, 10**9)
+    if type_name == "float":
+        return rng.uniform(-1000, 1000)
+    if type_name == "str":
+        return rng.choice(STRINGS) + str(rng.randint(0, 1000))
+    if type_name == "date":
+        return datetime.date(2000, 1, 1) + \
+            datetime.timedelta(days=rng.randint(0, 9000))
+    if type_name == "datetime":
+        return datetime.datetime(2000, 1, 1) + \
+            datetime.timedelta(seconds=rng.randint(0, 10**9))
+    if type_name == "bool":
+        return rng.random() < 0.5
+    raise ValueError("Unknown benchmark type: " + type_name)
+
+
+TSVX_TYPES = {
+    "int": "int",
+    "float": "float",
+    "str": "str",
+    "date": "ISO8601-date",
+    "datetime": "ISO8601-datetime",
+    "bool": "bool"
+}
+
+
+class Fixture:
+    '''
+    Synthetic data, and files for the benchmarks to work on.
+    '''
+    def __init__(self, directory, rows, columns, type_mix, seed=0):
+        rng = random.Random(seed)
+        self.directory = directory
+        self.type_names = [type_mix[i % len(type_mix)]
+                           for i in range(columns)]
+        self.types = [TSVX_TYPES[name] for name in self.type_names]
+        self.headers = ["Column {i} ({t})".format(i=i, t=t)
+                        for i, t in enumerate(self.type_names)]
+        self.data = [[_random_value(rng, t) for t in self.type_names]
+                     for i in range(rows)]
+        self.tsvx_path = os.path.join(directory, "input.tsvx")
+        self.csv_path = os.path.join(directory, "input.csv")
+        self.write_tsvx(self.tsvx_path)
+        self.write_csv(self.csv_path)
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def write_tsvx(self, path):
+        writer = tsvx.writer(open(path, "w"))
+        writer.title = "Benchmark data"
+        writer.headers = self.headers
+        writer.types = self.types
+        writer.write_headers()
+        for row in self.data:
+            writer.write(*row)
+        writer.close()
+
+    def csv_rows(self):
+        '''
+        The data as CSV strings, formatted like TSVx would
+        '''
+        for row in self.data:
+            yield [tsvx.parser.encode(item, t) if t != "str" else item
+                   for item, t in zip(row, self.types)]
+
+    def write_csv(self, path):
+        with open(path, "w", newline='') as fp:
+            writer = csv.writer(fp)
+            writer.writerow(self.headers)
+            writer.writerows(self.csv_rows())
+
+
+BENCHMARKS = collections.OrderedDict()
+
+
+def benchmark(name):
+    '''
+    Register a benchmark. Benchmarks take a `Fixture`, and return the
+    number of rows processed. They may instead return a tuple of rows
+    and seconds, if they time themselves.
+    '''
+    def register(function):
+        BENCHMARKS[name] = function
+        return function
+    return register
+
+
+@benchmark("import")
+def import_time(fixture):
+    '''
+    Time `import tsvx` in fresh interpreters, excluding interpreter
+    startup. Here, "rows" are imports.
+    '''
+    code = ("import time; start = time.perf_counter(); import tsvx; "
+            "print(time.perf_counter() - start)")
+    environment = dict(os.environ, PYTHONPATH=ROOT)
+    seconds = 0.0
+    for i in range(IMPORT_RUNS):
+        seconds += float(subprocess.check_output(
+            [sys.executable, "-c", code], env=environment))
+    return (IMPORT_RUNS, seconds)
+
+
+@benchmark("csv_read")
+def csv_read(fixture):
+    count = 0
+    with open(fixture.csv_path, newline='') as fp:
+        for row in csv.reader(fp):
+            count += 1
+    return count - 1
+
+
+@benchmark("csv_write")
+def csv_write(fixture):
+    rows = fixture.data
+    with open(fixture.path("output.csv"), "w", newline='') as fp:
+        csv.writer(fp).writerows(rows)
+    return len(rows)
+
+
+@benchmark("tsvx_read")
+def tsvx_read(fixture):
+    count = 0
+    with open(fixture.tsvx_path) as fp:
+        for line in tsvx.reader(fp):
+            count += 1
+    return count
+
+
+@benchmark("tsvx_write")
+def tsvx_write(fixture):
+    fixture.write_tsvx(fixture.path("output.tsvx"))
+    return len(fixture.data)
+
+
+@benchmark("guess_type")
+def guess_type(fixture):
+    rows = 0
+    for row in fixture.csv_rows():
+        for item in row:
+            tsvx.parser.guess_type(item)
+        rows += 1
+        if rows == GUESS_ROWS:
+            break
+    return rows
+
+
+@benchmark("convert")
+def convert(fixture):
+    return tsvx.convert.convert(
+        fixture.csv_path, fixture.path("converted.tsvx"), jobs=1)
+
+
+@benchmark("convert_parallel")
+def convert_parallel(fixture):
+    return tsvx.convert.convert(
+        fixture.csv_path, fixture.path("converted.tsvx"),
+        chunk_size=1024 * 1024)
+
+
+def measure(function, fixture, memory=True):
+    '''
+    Run a benchmark. Return a dictionary of results.
+    '''
+    start = time.perf_counter()
+    rows = function(fixture)
+    seconds = time.perf_counter() - start
+    if isinstance(rows, tuple):
+        (rows, seconds) = rows
+    result = {
+        "rows": rows,
+        "seconds": seconds,
+        "rows_per_sec": rows / seconds if seconds else None
+    }
+    if memory:
+        tracemalloc.start()
+        function(fixture)
+        result["peak_bytes"] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return result
+
+
+def revision():
+    '''
+    The git revision we're benchmarking, with a `+` if there are local
+    changes.
+    '''
+    try:
+        directory = os.path.dirname(os.path.abspath(__file__))
+        rev = subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=directory,
+            stderr=subprocess.DEVNULL).decode().strip()
+        dirty = subprocess.check_output(
+            ["git", "status", "--porcelain", "--untracked-files=no"],
+            cwd=directory).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+    return rev + ("+" if dirty else "")
+
+
+def run(arguments):
+    type_mix = arguments["--types"].split(",")
+    names = list(BENCHMARKS)
+    if arguments["--only"]:
+        names = arguments["--only"].split(",")
+        unknown = [name for name in names if name not in BENCHMARKS]
+        if unknown:
+            sys.exit("Unknown benchmarks: {unknown}. Choose from: "
+                     "{names}".format(unknown=", ".join(unknown),
+                                      names=", ".join(BENCHMARKS)))
+    record = {
+        "revision": revision(),
+        "label": arguments["--label"],
+        "date": datetime.datetime.utcnow().isoformat(),
+        "python": sys.version.split()[0],
+        "rows": int(arguments["--rows"]),
+        "columns": int(arguments["--columns"]),
+        "types": type_mix,
+        "results": collections.OrderedDict()
+    }
+    directory = tempfile.mkdtemp(prefix="tsvx-benchmark-")
+    try:
+        fixture = Fixture(directory, record["rows"], record["columns"],
+                          type_mix)
+        for name in names:
+            result = measure(BENCHMARKS[name], fixture,
+                             memory=not arguments["--no-memory"])
+            record["results"][name] = result
+            print("{name:20} {rate:>14,.0f} rows/sec {peak}".format(
+                name=name,
+                rate=result["rows_per_sec"] or 0,
+                peak="{0:>12,} bytes peak".format(result["peak_bytes"])
+                if "peak_bytes" in result else ""))
+    finally:
+        shutil.rmtree(directory)
+
+    with open(arguments["--results"], "a") as fp:
+        fp.write(json.dumps(record) + "\n")
+
+
+def compare(arguments):
+    '''
+    Show the latest results for two revisions (or labels) side by side.
+    Benchmarks without a rate on either side are skipped.
+    '''
+    latest = {}
+    with open(arguments["--results"]) as fp:
+        for line in fp:
+            record = json.loads(line)
+            latest[record["revision"]] = record
+            if record.get("label"):
+                latest[record["label"]] = record
+    old = latest[arguments["<old>"]]["results"]
+    new = latest[arguments["<new>"]]["results"]
+    print("{0:20} {1:>14} {2:>14} {3:>8}".format(
+        "benchmark", arguments["<old>"], arguments["<new>"], "speedup"))
+    for name in old:
+        if name not in new:
+            continue
+        (before, after) = (old[name]["rows_per_sec"],
+                           new[name]["rows_per_sec"])
+        if not before or not after:
+            continue
+        print("{0:20} {1:>14,.0f} {2:>14,.0f} {3:>7.2f}x".format(
+            name, before, after, after / before))
+
+
+if __name__ == "__main__":
+    arguments = docopt.docopt(__doc__)
+    arguments["--results"] = arguments["--results"] or RESULTS
+    if arguments["list"]:
+        print("\n".join(BENCHMARKS))
+    elif arguments["compare"]:
+        compare(arguments)
+    else:
+        run(arguments)
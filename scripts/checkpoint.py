@@ -0,0 +1,172 @@
+'''
+Checkpoints, so that a long export can pick up where it left off after
+a crash.
+
+An export to `filename` writes to `filename.partial`, and renames it to
+`filename` only once it's complete. A file with the final name is
+always whole.
+
+As it goes, the export commits: it ends the current gzip member (or
+just flushes, for uncompressed files), syncs the file to disk, and
+records how far it got in `filename.checkpoint`, with the byte offset
+of the end of the committed data. On restart, we truncate the partial
+file to that offset, and carry on from there. Since gzip files may
+hold several members, the result is a normal `.tsvx.gz` file.
+'''
+
+import gzip
+import json
+import os
+import os.path
+
+CHECKPOINT_VERSION = 3
+
+
+def partial_filename(filename):
+    '''
+    Where an export to `filename` writes until it's complete
+
+    >>> partial_filename("db-table.tsvx.gz")
+    'db-table.tsvx.gz.partial'
+    '''
+    return filename + ".partial"
+
+
+def checkpoint_filename(filename):
+    '''
+    Where the progress of an export to `filename` is kept
+    '''
+    return filename + ".checkpoint"
+
+
+def complete(filename):
+    '''
+    Give a finished partial file its final name
+    '''
+    os.replace(partial_filename(filename), filename)
+
+
+class CheckpointedFile:
+    '''
+    A text stream, for a TSVx writer, on the partial file of an export
+    to `filename`, gzipped if the name ends in `.gz`. With an `offset`,
+    we resume an earlier export: the file is truncated there, and
+    appended to.
+    '''
+    def __init__(self, filename, offset=None):
+        self.filename = filename
+        self.compress = filename.endswith(".gz")
+        path = partial_filename(filename)
+        if offset is None:
+            self._raw = open(path, "wb")
+        else:
+            self._raw = open(path, "r+b")
+            self._raw.truncate(offset)
+            self._raw.seek(offset)
+        self._member = None
+
+    def write(self, text):
+        if self._member is None:
+            if self.compress:
+                self._member = gzip.GzipFile(fileobj=self._raw, mode="wb")
+            else:
+                self._member = self._raw
+        self._member.write(text.encode("utf-8"))
+
+    def flush(self):
+        if self._member is not None:
+            self._member.flush()
+
+    def commit(self):
+        '''
+        Make everything written so far durable, and return the offset at
+        which it ends.
+        '''
+        if self._member is not None and self._member is not self._raw:
+            self._member.close()
+        self._member = None
+        self._raw.flush()
+        os.fsync(self._raw.fileno())
+        return self._raw.tell()
+
+    def close(self):
+        if not self._raw.closed:
+            self.commit()
+            self._raw.close()
+
+
+class Checkpoint:
+    '''
+    The progress of an export to `filename`. `identity` is a dictionary
+    describing the export (say, the database and table). A checkpoint
+    left by some other export to the same file is ignored. Values set
+    in `extra` are saved with every checkpoint.
+
+        checkpoint = Checkpoint(filename, {"table": table})
+        state = checkpoint.load()     # None if starting afresh
+        stream = checkpoint.open(state)
+        ...
+        checkpoint.save(last=key, offset=stream.commit())
+        ...
+        checkpoint.finish()
+    '''
+    def __init__(self, filename, identity):
+        self.filename = filename
+        self.path = checkpoint_filename(filename)
+        self.identity = identity
+        self.extra = {}
+        self.stream = None
+
+    def load(self):
+        '''
+        The state recorded by the last `save`, as a dictionary, or `None`
+        if there's nothing to resume.
+        '''
+        try:
+            with open(self.path) as fp:
+                checkpoint = json.load(fp)
+        except (OSError, ValueError):
+            return None
+        if checkpoint.get("version") != CHECKPOINT_VERSION or \
+           checkpoint.get("identity") != self.identity:
+            return None
+        state = checkpoint["state"]
+        if "offset" in state and \
+           not os.path.exists(partial_filename(self.filename)):
+            return None
+        return state
+
+    def save(self, **state):
+        '''
+        Record progress. The checkpoint is replaced atomically, so a crash
+        leaves either the old one or the new one.
+        '''
+        temporary = self.path + ".tmp"
+        with open(temporary, "w") as fp:
+            json.dump({"version": CHECKPOINT_VERSION,
+                       "identity": self.identity,
+                       "state": dict(self.extra, **state)}, fp)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(temporary, self.path)
+
+    def open(self, state=None):
+        '''
+        Open the partial file, resuming at the offset in `state`, if any
+        '''
+        offset = None
+        if state:
+            offset = state.get("offset")
+        self.stream = CheckpointedFile(self.filename, offset)
+        return self.stream
+
+    def finish(self):
+        '''
+        The export is done. Rename the partial file (if we opened one),
+        and remove the checkpoint.
+        '''
+        if self.stream is not None:
+            self.stream.close()
+            complete(self.filename)
+        if os.path.exists(self.path):
+            os.unlink(self.path)
@@ -0,0 +1,109 @@
+'''
+Run many table exports at once, for dumping whole databases.
+
+Jobs run on a bounded pool of threads, largest first: the biggest
+tables set the length of the whole dump, so they start right away,
+and small ones fill in the gaps. At most `per_server` jobs run against
+any one server at a time. As each job finishes, we report how long it
+took, and its throughput.
+
+Threads are fine for jobs which mostly wait on the database, or on a
+subprocess (as `mysql_fulldb.py` does). Jobs which spend their time in
+Python should run in a subprocess, to use more than one core.
+'''
+
+import collections
+import concurrent.futures
+import time
+
+# `run` is called with no arguments, and may return the number of rows
+# exported. `size` is the size of the table in bytes (or any measure,
+# for ordering). `server` is whatever identifies the database server.
+Job = collections.namedtuple("Job", ["name", "run", "size", "server"],
+                             defaults=(0, None))
+
+
+def format_bytes(count):
+    '''
+    Format a number of bytes for people
+
+    >>> format_bytes(1536)
+    '1.5 KB'
+    >>> format_bytes(12)
+    '12 B'
+    '''
+    for unit in ["B", "KB", "MB", "GB", "TB"]:
+        if count < 1024 or unit == "TB":
+            break
+        count /= 1024.0
+    if unit == "B":
+        return "{count} B".format(count=int(count))
+    return "{count:.1f} {unit}".format(count=count, unit=unit)
+
+
+def _summary(job, result, seconds):
+    '''
+    How long a job took, and how fast it went
+    '''
+    rate = max(seconds, 0.001)
+    summary = "{size} in {seconds:.1f}s ({speed}/s)".format(
+        size=format_bytes(job.size), seconds=seconds,
+        speed=format_bytes(job.size / rate))
+    if isinstance(result, int):
+        summary += ", {rows} rows ({speed:.0f} rows/s)".format(
+            rows=result, speed=result / rate)
+    return summary
+
+
+def run_jobs(jobs, workers=4, per_server=None, report=print,
+             clock=time.monotonic):
+    '''
+    Run `jobs` (a list of `Job`s), largest first, at most `workers` at
+    once, and at most `per_server` at once on any one server. Progress
+    goes to `report`, a line at a time.
+
+    Returns a dictionary from job name to result: the value returned by
+    its `run`, or the exception it raised. A failed job doesn't stop
+    the others.
+    '''
+    if per_server is not None and per_server < 1:
+        raise ValueError("per_server must be at least 1")
+    pending = sorted(jobs, key=lambda job: -job.size)
+    total = len(pending)
+    running = {}
+    busy = collections.Counter()
+    results = {}
+    with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+        while pending or running:
+            # Start the largest jobs whose servers have room
+            for job in list(pending):
+                if len(running) >= workers:
+                    break
+                if per_server and busy[job.server] >= per_server:
+                    continue
+                pending.remove(job)
+                busy[job.server] += 1
+                report("Starting {name} ({size})".format(
+                    name=job.name, size=format_bytes(job.size)))
+                running[executor.submit(job.run)] = (job, clock())
+
+            done, _ = concurrent.futures.wait(
+                running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                (job, started) = running.pop(future)
+                busy[job.server] -= 1
+                seconds = clock() - started
+                try:
+                    result = future.result()
+                    status = _summary(job, result, seconds)
+                except Exception as error:
+                    result = error
+                    status = "failed after {seconds:.1f}s: {error}".format(
+                        seconds=seconds, error=error)
+                results[job.name] = result
+                report("[{done}/{total}] {name}: {status}; {running} "
+                       "running, {pending} waiting".format(
+                           done=len(results), total=total, name=job.name,
+                           status=status, running=len(running),
+                           pending=len(pending)))
+    return results
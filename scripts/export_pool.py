@@ -0,0 +1,328 @@
+'''
+Concurrent table exports over a pool of database connections.
+
+A table is exported as a list of range queries (partitions). These
+are run concurrently, each on its own connection. Results are either
+merged, in order, into one TSVx writer, or each partition is written
+to its own shard file.
+
+A partition which fails is retried on a fresh connection after a
+pause. The pause happens in that partition's worker, so the other
+partitions carry on.
+
+A table can also be exported page by page along its key, with the
+page size adapted to how quickly the database answers (see
+`AdaptiveStep` and `export_keyset`).
+
+Rows are read with `fetchmany`, in batches of tuples, and go to the
+writer a batch at a time. With an unbuffered cursor (such as MySQLdb's
+`SSCursor`), a shard export holds one batch in memory, however big the
+partition.
+
+This works with any DB-API connection (MySQLdb, vertica_python, or
+sqlite3 for testing).
+'''
+
+import concurrent.futures
+import contextlib
+import queue
+import tempfile
+import threading
+import time
+
+import tsvx.helpers
+
+# Rows per `fetchmany` call
+BATCH_SIZE = 10000
+
+# Encoded text a partition keeps in memory before spilling to disk
+SPOOL_BYTES = 8 * 1024 * 1024
+
+
+class ConnectionPool:
+    '''
+    A pool of at most `size` connections. `connect` is a function
+    which opens a new connection. Connections are opened as needed, and
+    reused. A connection which raised an exception is closed rather
+    than reused, since it may be broken.
+    '''
+    def __init__(self, connect, size):
+        self._connect = connect
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+        self.size = size
+
+    @contextlib.contextmanager
+    def connection(self):
+        '''
+        Borrow a connection:
+
+            with pool.connection() as connection:
+                ...
+        '''
+        with self._slots:
+            try:
+                connection = self._idle.get_nowait()
+            except queue.Empty:
+                connection = self._connect()
+            try:
+                yield connection
+            except BaseException:
+                _close_quietly(connection)
+                raise
+            self._idle.put(connection)
+
+    def close(self):
+        '''
+        Close idle connections
+        '''
+        while True:
+            try:
+                _close_quietly(self._idle.get_nowait())
+            except queue.Empty:
+                return
+
+
+def _close_quietly(connection):
+    try:
+        connection.close()
+    except Exception:
+        pass
+
+
+def with_retries(function, retries=3, backoff=1.0):
+    '''
+    Call `function()`. If it raises, wait, and try again, up to
+    `retries` more times. The wait doubles each time, starting at
+    `backoff` seconds.
+    '''
+    for attempt in range(retries + 1):
+        try:
+            return function()
+        except Exception:
+            if attempt == retries:
+                raise
+            time.sleep(backoff * 2 ** attempt)
+
+
+class AdaptiveStep:
+    '''
+    Chooses how many rows to ask for in each query. We aim for queries
+    which take about `target` seconds: after each query, the size moves
+    towards `target` times the measured rows per second, by at most a
+    factor of two. A failed query (for instance, a timeout) halves it.
+    The size stays between `minimum` and `maximum` (by default, the
+    initial size).
+
+    >>> step = AdaptiveStep(1000, target=1.0)
+    >>> step.failure()
+    >>> step.size
+    500
+    >>> step.success(500, 0.1)
+    >>> step.size
+    1000
+    >>> step.success(1000, 4.0)
+    >>> step.size
+    500
+    '''
+    def __init__(self, initial, minimum=100, maximum=None, target=2.0):
+        self.size = initial
+        self.minimum = min(minimum, initial)
+        self.maximum = maximum or initial
+        self.target = target
+
+    def _clamp(self, size):
+        return int(max(self.minimum, min(self.maximum, size)))
+
+    def success(self, rows, seconds):
+        '''
+        Record a query which returned `rows` rows in `seconds`
+        '''
+        if rows == 0:
+            return
+        ideal = rows / max(seconds, 0.001) * self.target
+        self.size = self._clamp(
+            min(max(ideal, self.size / 2), self.size * 2))
+
+    def failure(self):
+        '''
+        Record a query which failed
+        '''
+        self.size = self._clamp(self.size // 2)
+
+
+def fetch_batches(cursor, batch_size=BATCH_SIZE):
+    '''
+    Iterate over the results of an executed query, in lists of at most
+    `batch_size` rows
+    '''
+    while True:
+        batch = cursor.fetchmany(batch_size)
+        if not batch:
+            return
+        yield batch
+
+
+def stream_query(pool, query, write, batch_size=BATCH_SIZE):
+    '''
+    Run a query on a pooled connection, and pass the rows to `write`,
+    a batch at a time. Returns the number of rows.
+    '''
+    rows = 0
+    with pool.connection() as connection:
+        cursor = connection.cursor()
+        try:
+            cursor.execute(query)
+            for batch in fetch_batches(cursor, batch_size):
+                write(batch)
+                rows += len(batch)
+        finally:
+            cursor.close()
+    return rows
+
+
+def export_partitions(pool, writer, queries, workers=4, retries=3,
+                      backoff=1.0, progress=None, batch_size=BATCH_SIZE):
+    '''
+    Run the `queries` concurrently on `workers` pooled connections,
+    and write the rows to `writer`, in the order of the queries.
+
+    Workers encode their rows to TSVx text as they fetch them, into
+    a temporary file for each partition, which stays in memory only
+    while it's under `SPOOL_BYTES`. At most `2 * workers` partitions
+    are held at once, and they're copied to the writer in order, a
+    block at a time.
+
+    `progress`, if given, is called with each query once its rows are
+    written.
+    '''
+    def fetch_once(query):
+        spool = tempfile.SpooledTemporaryFile(
+            SPOOL_BYTES, mode="w+", encoding="utf-8")
+        try:
+            stream_query(pool, query,
+                         lambda batch: spool.write(writer.encode_rows(batch)),
+                         batch_size)
+        except BaseException:
+            spool.close()
+            raise
+        return spool
+
+    def fetch(query):
+        return with_retries(lambda: fetch_once(query), retries, backoff)
+
+    with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+        results = tsvx.helpers.bounded_map(
+            executor, fetch, queries, 2 * workers)
+        for query, spool in zip(queries, results):
+            with spool:
+                spool.seek(0)
+                while True:
+                    block = spool.read(SPOOL_BYTES)
+                    if not block:
+                        break
+                    writer.write_chunk(block)
+            if progress:
+                progress(query)
+
+
+def export_partition_shards(pool, make_writer, queries, workers=4,
+                            retries=3, backoff=1.0, progress=None,
+                            batch_size=BATCH_SIZE, finish=None):
+    '''
+    Run the `queries` concurrently on `workers` pooled connections.
+    The rows of the i'th query are streamed to the writer
+    `make_writer(i)`, which is closed when the partition is done.
+    Returns the number of rows in each shard.
+
+    A retry calls `make_writer(i)` again, which should start the shard
+    afresh. If any partition fails (after retries), the others still
+    finish, and then the first failure is raised. `finish`, if given,
+    is called with the index of each shard which succeeded.
+    '''
+    def export_once(index, query):
+        writer = make_writer(index)
+        try:
+            return stream_query(pool, query, writer.write_rows, batch_size)
+        finally:
+            writer.close()
+
+    def export(item):
+        (index, query) = item
+        rows = with_retries(lambda: export_once(index, query),
+                            retries, backoff)
+        if finish:
+            finish(index)
+        if progress:
+            progress(query)
+        return rows
+
+    with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+        futures = [executor.submit(export, item)
+                   for item in enumerate(queries)]
+        concurrent.futures.wait(futures)
+    return [future.result() for future in futures]
+
+
+def export_keyset(pool, writer, make_query, key_index, step,
+                  row_limit=None, retries=3, backoff=1.0, progress=None,
+                  clock=time.monotonic, last=None, total=0, commit=None):
+    '''
+    Export a table a page at a time along its key. Each query,
+    `make_query(last, size)`, asks for the `size` rows after key `last`
+    (`None` for the first page), in key order. `key_index` is the
+    column holding the key, or a list of the columns of a composite
+    key, whose values are then kept as a tuple. The size comes from
+    `step`, an `AdaptiveStep`, which learns from how long each page
+    takes.
+
+    Rows are written as they're fetched, a batch at a time. A page
+    which fails is retried from the last row written, after a pause
+    which doubles each time, and with a smaller size. After `retries`
+    failures in a row, we give up, and raise. Returns the number of
+    rows written.
+
+    `progress`, if given, is called with the number of rows in each
+    batch. `commit`, if given, is called with the last key and the total
+    rows so far, after each page is written. To resume an export, pass
+    those back as `last` and `total`.
+    '''
+    if isinstance(key_index, int):
+        def key(row):
+            return row[key_index]
+    else:
+        def key(row):
+            return tuple(row[index] for index in key_index)
+
+    failures = 0
+    while True:
+        size = step.size
+        if row_limit:
+            size = min(size, row_limit - total)
+        rows = 0
+
+        def write(batch):
+            nonlocal last, total, rows
+            writer.write_rows(batch)
+            last = key(batch[-1])
+            total += len(batch)
+            rows += len(batch)
+            if progress:
+                progress(len(batch))
+
+        started = clock()
+        try:
+            stream_query(pool, make_query(last, size), write)
+        except Exception:
+            failures += 1
+            if failures > retries:
+                raise
+            step.failure()
+            time.sleep(backoff * 2 ** (failures - 1))
+            continue
+        failures = 0
+        step.success(rows, clock() - started)
+        if commit:
+            commit(last, total)
+        if rows < size or (row_limit and total >= row_limit):
+            return total
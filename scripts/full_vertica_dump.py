@@ -6,14 +6,26 @@ Usage:
                        [--host=host] [--user=user] [--port=port]
                        [--password=password] [--database=database]
                        [--prefix=prefix]
+                       [--workers=workers] [--per-server=connections]
+
+Options:
+  --workers=workers          Tables to dump at once [default: 4]
+  --per-server=connections   At most this many connections to the server
 
 One must specify either host, user, port, database, and password, or
 prefix. If prefix is specified, said information will be taken
 from environment variables
+
+Tables are dumped concurrently, largest first (see
+`dump_scheduler.py`), each over its own connection.
+
+Each table is written to a `.partial` file, and renamed once complete.
+If a dump is interrupted, run it again: tables already in the directory
+are skipped, and the table which was in progress is started afresh.
 '''
 
 import docopt
-import gzip
+import functools
 import os
 import sys
 import vertica_python
@@ -21,6 +33,8 @@ import vertica_python.errors
 
 import tsvx
 
+import checkpoint
+import dump_scheduler
 import helpers
 
 arguments = docopt.docopt(__doc__)
@@ -35,59 +49,101 @@ def argument(x):
     else:
         raise Exception("Missing parameter " + x)
 
-connection = vertica_python.connect(
-    host=argument('host'),
-    port=int(argument('port')),
-    user=argument('user'),
-    password=argument('password'),
-    database=argument('database'),
-    unicode_error='replace'
-)
-
-cur = connection.cursor('dict')
-cur.execute("select * from ALL_TABLES;");
-for item in list(cur.iterate()):
-    query = "select * from {schema_name}.{table_name};".format(
-        schema_name=item['schema_name'],
-        table_name=item['table_name']
+def connect():
+    return vertica_python.connect(
+        host=argument('host'),
+        port=int(argument('port')),
+        user=argument('user'),
+        password=argument('password'),
+        database=argument('database'),
+        unicode_error='replace'
     )
-    title = str(item['remarks'])
-    if title is None:
-        title = "Vertica dump"
-    description = "Vertica dump from query: " + query
-    filename = "{schema_name}.{table_name}.tsvx.gz".format(
-        schema_name=item['schema_name'],
-        table_name=item['table_name']
-    )
-    pathname = os.path.join(arguments['--output'], filename)
-    print pathname
-    print title
-    print description
-    print query
-    if os.path.exists(pathname):
-        print "Already exists"+pathname
-        continue
-    fp = gzip.open(pathname, "w")
+
+
+def table_sizes(cursor):
+    '''
+    Bytes used by each table, as a dictionary keyed by (schema, table).
+    Empty if we can't see the storage tables.
+    '''
+    try:
+        cursor.execute(
+            "select anchor_table_schema, anchor_table_name, sum(used_bytes) "
+            "from v_monitor.projection_storage group by 1, 2;")
+    except vertica_python.errors.Error:
+        return {}
+    return dict(((schema, table), size)
+                for (schema, table, size) in cursor.fetchall())
+
+
+def dump_table(query, pathname, title, description):
+    '''
+    Dump one table, over its own connection. Returns the number of rows.
+    '''
+    connection = connect()
+    cur = connection.cursor()
+    fp = checkpoint.CheckpointedFile(pathname)
     tsvx_writer = tsvx.writer(fp)
-    tsvx_writer.title(title)
-    tsvx_writer.description(description)
+    tsvx_writer.title = title
+    tsvx_writer.description = description
+    rows = 0
     try:
-        helpers.query_vertica_to_tsvx(
+        rows = helpers.query_vertica_to_tsvx(
             cur,
             query,
             tsvx_writer
         )
     except vertica_python.errors.PermissionDenied:
         fp.write("Permission denied")
-        fp.close()
-        print "Permission denied on "+pathname
-    except StopIteration:
+        print("Permission denied on "+pathname)
+    except helpers.EmptyResultException:
         fp.write("Empty table")
-        fp.close()
-        print "Empty Table "+pathname
+        print("Empty Table "+pathname)
     except:
-        tsvx_writer.close()
-        os.unlink(pathname)
+        fp.close()
+        os.unlink(checkpoint.partial_filename(pathname))
         raise
-    print
-    tsvx_writer.close()
+    finally:
+        connection.close()
+    fp.close()
+    checkpoint.complete(pathname)
+    return rows
+
+
+connection = connect()
+cur = connection.cursor()
+sizes = table_sizes(cur)
+cur.execute("select schema_name, table_name, remarks from ALL_TABLES;")
+jobs = []
+for (schema_name, table_name, remarks) in cur.fetchall():
+    query = "select * from {schema_name}.{table_name};".format(
+        schema_name=schema_name,
+        table_name=table_name
+    )
+    title = remarks or "Vertica dump"
+    description = "Vertica dump from query: " + query
+    filename = "{schema_name}.{table_name}.tsvx.gz".format(
+        schema_name=schema_name,
+        table_name=table_name
+    )
+    pathname = os.path.join(arguments['--output'], filename)
+    if os.path.exists(pathname):
+        print("Already exists "+pathname)
+        continue
+    jobs.append(dump_scheduler.Job(
+        name=pathname,
+        run=functools.partial(dump_table, query, pathname, title,
+                              description),
+        size=sizes.get((schema_name, table_name), 0),
+        server=argument('host')))
+connection.close()
+
+per_server = None
+if arguments["--per-server"]:
+    per_server = int(arguments["--per-server"])
+results = dump_scheduler.run_jobs(
+    jobs, int(arguments["--workers"]), per_server)
+failures = [name for name in results
+            if isinstance(results[name], Exception)]
+if failures:
+    print("Failed:", " ".join(sorted(failures)))
+    sys.exit(1)
@@ -1,15 +1,55 @@
-import MySQLdb
 import click
 import collections
-import gzip
+import io
 import numbers
-import os
-import time
+import os.path
+import subprocess
+import sys
 
 import tsvx
+import tsvx.helpers
+
+import checkpoint
+import export_pool
+import mongo_export
 
 mysql_escape = None
-connect_args = None  # For reconnecting, if we need to
+connect_args = None  # For opening more connections, if we need to
+
+
+class EmptyResultException(Exception):
+    '''
+    A query returned no rows, so there's nothing to tell the column
+    types from
+    '''
+
+
+def mysql_connection_factory(arguments, streaming=False):
+    '''
+    Given arguments from docopt, return a function which opens a new
+    MySQL connection. This is what connection pools need.
+
+    With `streaming`, cursors are unbuffered (`SSCursor`): rows come
+    from the server as we fetch them, rather than all being loaded on
+    `execute`. Each result must then be read to the end before the
+    next query on that connection.
+    '''
+    import MySQLdb
+    import MySQLdb.cursors
+
+    options = {}
+    if streaming:
+        options["cursorclass"] = MySQLdb.cursors.SSCursor
+
+    def connect():
+        return MySQLdb.connect(host=arguments["--host"],
+                               port=int(arguments["--port"]),
+                               user=arguments["--user"],
+                               passwd=arguments["--password"],
+                               db=arguments["--database"],
+                               **options)
+    return connect
+
 
 def mysql_connect(arguments):
     '''
@@ -19,57 +59,279 @@ def mysql_connect(arguments):
     global mysql_escape
     global connect_args
     connect_args = arguments
-    db = MySQLdb.connect(host=arguments["--host"],
-                         port=int(arguments["--port"]),
-                         user=arguments["--user"],
-                         passwd=arguments["--password"],
-                         db=arguments["--database"])
-    mysql_escape = db.escape_string
+    db = mysql_connection_factory(arguments)()
+    mysql_escape = lambda s: db.escape_string(s).decode('utf-8')
     c = db.cursor()
     return c
 
 
-def reconnect():
-    return mysql_connect(connect_args)
+def mysql_table_sizes(cursor):
+    '''
+    Bytes of data in each table of the current database, as a dictionary
+    keyed by table name
+    '''
+    cursor.execute("show table status;")
+    keys = [t[0].lower() for t in cursor.description]
+    return dict((row[keys.index("name")], row[keys.index("data_length")] or 0)
+                for row in cursor.fetchall())
+
+
+def mysql_tsvx_command(arguments, table, filename, options=()):
+    '''
+    Command line to export one table with `mysql_tsvx.py`, in its own
+    process, given connection arguments from docopt
+    '''
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          "mysql_tsvx.py")
+    return [sys.executable, script,
+            "--host=" + arguments["--host"],
+            "--port=" + arguments["--port"],
+            "--user=" + arguments["--user"],
+            "--password=" + arguments["--password"],
+            "--database=" + arguments["--database"],
+            "--table=" + table,
+            "--output=" + filename] + list(options)
+
+
+def run_command(command):
+    '''
+    Run a command quietly, for the dump scheduler. If it fails, raise
+    an exception with the last line of its error output.
+    '''
+    result = subprocess.run(command, stdout=subprocess.DEVNULL,
+                            stderr=subprocess.PIPE, universal_newlines=True)
+    if result.returncode != 0:
+        lines = result.stderr.strip().splitlines() or ["(no output)"]
+        raise RuntimeError("{command} exited with {code}: {error}".format(
+            command=os.path.basename(command[1]), code=result.returncode,
+            error=lines[-1]))
+
+
+def mysql_pool(size):
+    '''
+    A pool of up to `size` streaming connections to the database of the
+    last `mysql_connect`
+    '''
+    return export_pool.ConnectionPool(
+        mysql_connection_factory(connect_args, streaming=True), size)
+
+
+def open_tsvx_writer(filename):
+    '''
+    Open a TSVx writer on a file, gzipped if the name ends in .gz
+    '''
+    return tsvx.writer(tsvx.helpers.open_text(filename, "w"))
+
+
+def _numbered_filename(filename, kind, index):
+    for extension in [".tsvx.gz", ".tsvx"]:
+        if filename.endswith(extension):
+            base = filename[:-len(extension)]
+            return "{base}.{kind}-{index:04d}{extension}".format(
+                base=base, kind=kind, index=index, extension=extension)
+    return "{filename}.{kind}-{index:04d}".format(
+        filename=filename, kind=kind, index=index)
+
+
+def shard_filename(filename, index):
+    '''
+    Name of the index'th shard of an export
+
+    >>> shard_filename("db-table.tsvx.gz", 3)
+    'db-table.part-0003.tsvx.gz'
+    '''
+    return _numbered_filename(filename, "part", index)
+
+
+def delta_filename(filename, index):
+    '''
+    Name of the index'th incremental export following a full export to
+    `filename`
+
+    >>> delta_filename("db-table.tsvx.gz", 1)
+    'db-table.delta-0001.tsvx.gz'
+    '''
+    return _numbered_filename(filename, "delta", index)
+
+
+def _exported(filename):
+    '''
+    The file holding the headers of an export: the file itself, or, if
+    the export was sharded, its first shard. `None` if neither exists.
+    '''
+    for candidate in [filename, shard_filename(filename, 0)]:
+        if os.path.exists(candidate):
+            return candidate
+    return None
+
+
+def high_water_mark(filename):
+    '''
+    Find the high-water mark of the latest export to `filename`: the
+    full export, or its latest delta (see `delta_filename`). Returns the
+    column, the mark, and the index for the next delta. Returns `None`
+    if there's no earlier export, or it has no high-water mark.
+    '''
+    index = 1
+    while _exported(delta_filename(filename, index)):
+        index += 1
+    if index > 1:
+        latest = _exported(delta_filename(filename, index - 1))
+    else:
+        latest = _exported(filename)
+    if latest is None:
+        return None
+    metadata = tsvx.read_header(latest).metadata
+    if "high-water-column" not in metadata:
+        return None
+    return (metadata["high-water-column"], metadata.get("high-water-mark"),
+            index)
+
+
+def high_water_value(value):
+    '''
+    A high-water mark, as we keep it in TSVx metadata: numbers as they
+    are, and anything else (such as dates) as a string
+
+    >>> import datetime
+    >>> high_water_value(datetime.datetime(2016, 5, 1, 12, 30))
+    '2016-05-01 12:30:00'
+    '''
+    if value is None or isinstance(value, numbers.Number):
+        return value
+    return str(value)
+
+
+def copy_headers(template, writer):
+    '''
+    Configure a TSVx writer with the same headers as another one.
+    '''
+    for key, value in template.metadata.items():
+        writer.add_metadata(key, value)
+    writer.headers = template.headers
+    writer.types = template.types
+    writer.variables = template.variables
+    for key, value in template.extra_headers.items():
+        writer.line_header(key, value)
+
+
+def open_checkpointed_writer(export_checkpoint, template, state=None):
+    '''
+    Open a TSVx writer on the partial file of a checkpointed export,
+    with the headers of `template`. Given the `state` of an earlier
+    run, we resume it, and the headers are already there.
+    '''
+    writer = tsvx.writer(export_checkpoint.open(state))
+    copy_headers(template, writer)
+    if not state:
+        writer.write_headers()
+    return writer
 
 
 def scrape_mysql_table_to_tsvx(filename, cursor, database, table,
-                               row_limit, max_step, sequential_id=False):
+                               row_limit, max_step, sequential_id=False,
+                               pool=None, workers=1, shards=False,
+                               timeout=None, high_water=None, since=None):
     '''
     Scrape a MySQL table, outputting to a TSVx file. This is the
     top-level helper function.
 
+    With one worker, we page through the table, adapting the page size
+    as we go (see `grab_table_data`). With a connection `pool` and more
+    than one worker, the table is partitioned up front, and partitions
+    are fetched concurrently. They're merged into the file in order, or,
+    with `shards`, each goes to its own file (see `shard_filename`).
+
+    Progress is checkpointed (see `checkpoint.py`). If an earlier run
+    of the same export was interrupted, we resume it.
+
+    With `high_water`, a column which only grows (say, an updated-at
+    timestamp), or `True` for the primary key, we record its maximum
+    in the metadata, as the high-water mark. With `since`, an earlier
+    export's mark, only rows above it are exported; this is a delta
+    (see `high_water_mark` and `delta_filename`).
+
     The way 'rows' is passed around is a bit of a hack.
     '''
-    if filename.endswith(".gz"):
-        stream = gzip.open(filename, "w")
-    elif filename.endswith("tsvx"):
-        stream = open(filename, "w")
-    writer = tsvx.writer(stream)
+    # Headers go into a template, and from there, into the output file
+    # (or each shard)
+    template = tsvx.writer(io.StringIO())
 
     # Get table headers and information
     write_table_metadata(
-        cursor, writer, database, table, row_limit
+        cursor, template, database, table, row_limit
     )
 
-    if writer.get_metadata('mysql-rows') == "0":
-        writer.close()
+    sequential = pool is None or (workers <= 1 and not shards)
+    if sequential:
+        mode = "keyset"
+    elif shards:
+        mode = "shards"
+    else:
+        mode = "partitions"
+    export_checkpoint = checkpoint.Checkpoint(
+        filename, {"database": database, "table": table, "mode": mode,
+                   "high-water": high_water, "since": since})
+    state = export_checkpoint.load()
+    if state:
+        print("Resuming from " + export_checkpoint.path)
+
+    condition = None
+    if high_water:
+        if high_water is True:
+            high_water = primary_key(template)
+        if state:
+            # Keep to the mark in the headers we already wrote
+            mark = state["high-water-mark"]
+        else:
+            cursor.execute("select max(`{column}`) from {table};".format(
+                column=high_water, table=table))
+            mark = high_water_value(list(cursor)[0][0])
+        print("High-water mark of", high_water, "is", mark)
+        export_checkpoint.extra["high-water-mark"] = mark
+        template.add_metadata("high-water-column", high_water)
+        template.add_metadata("high-water-mark", mark)
+        if since is not None:
+            template.add_metadata("high-water-since", since)
+        condition = high_water_condition(
+            "`{column}`".format(column=high_water), since, mark)
+
+    if template.get_metadata('mysql-rows') == 0:
+        if not shards:
+            open_checkpointed_writer(export_checkpoint, template).close()
+        export_checkpoint.finish()
+        return
+
+    if sequential:
+        writer = open_checkpointed_writer(export_checkpoint, template, state)
+        grab_table_data(pool or mysql_pool(1), writer, table,
+                        max_step, row_limit, timeout,
+                        export_checkpoint, state, condition)
         return
 
     # Figure out how to partition the data
-    if not sequential_id:
+    if state:
+        id_range = state["id_range"]
+    elif not sequential_id:
         id_range = partition_data(
-            cursor, writer, table,
-            row_limit, max_step)
+            cursor, template, table,
+            row_limit, max_step, condition)
     else:
         id_range = sequential_partition_data(
-            cursor, writer, table,
-            row_limit, max_step)
+            cursor, template, table,
+            row_limit, max_step, condition)
     # Now, grab the data itself
-    if id_range is not None:
-        grab_table_data(cursor, writer, table, id_range)
+    if id_range is None:
+        if not shards:
+            open_checkpointed_writer(export_checkpoint, template).close()
+        export_checkpoint.finish()
+    elif shards:
+        grab_table_data_shards(pool, template, table, id_range, filename,
+                               workers, export_checkpoint, state, condition)
     else:
-        writer.close()
+        writer = open_checkpointed_writer(export_checkpoint, template, state)
+        grab_table_data_parallel(pool, writer, table, id_range, workers,
+                                 export_checkpoint, state, condition)
 
 
 def primary_key(writer):
@@ -77,17 +339,27 @@ def primary_key(writer):
     For a TSVx writer with MySQL metadata, return the primary key
     '''
     pri_key_index = writer.line_header("mysql-key").index("PRI")
-    pri_key = writer.headers()[pri_key_index]
+    pri_key = writer.headers[pri_key_index]
     return pri_key
 
 
+def primary_keys(writer):
+    '''
+    For a TSVx writer with MySQL metadata, return all the columns of the
+    primary key (more than one, if it's composite)
+    '''
+    return [header for (header, key)
+            in zip(writer.headers, writer.line_header("mysql-key"))
+            if key == "PRI"]
+
+
 def write_table_metadata(cursor, writer, database, table, row_limit=None):
     '''
     Ask the database about the table. Extract the metadata. Write
     it to a TSVx writer.
     '''
     # First, we grab column headers
-    writer.title("MySQL Export of %s from %s" % (table, database))
+    writer.title = "MySQL Export of %s from %s" % (table, database)
     cursor.execute("DESCRIBE " + table)
     headers = [i[0] for i in cursor.description]
     rowdata = list(cursor)
@@ -95,19 +367,17 @@ def write_table_metadata(cursor, writer, database, table, row_limit=None):
     # Now we write them into the appropriate fields
     for key, value in zip(headers, zip(*rowdata)):
         if key == "Field":
-            writer.headers(value)
+            writer.headers = list(value)
         elif key == "Type":
-            writer.python_types(map(mysql_to_python_type, value))
+            writer.types = list(map(mysql_to_python_type, value))
         else:
-            writer.line_header("mysql-"+key.lower(), map(str, value))
+            writer.line_header("mysql-"+key.lower(), list(map(str, value)))
 
     # Now we grab the metadata for the whole table
     cursor.execute('show table status where Name="'+table+'";')
     keys = [t[0] for t in cursor.description]
     values = list(cursor)[0]
     for (key, value) in zip(keys, values):
-        if type(value) == long and value == int(value):
-            value = int(value)
         if key.lower() == "rows":
             if row_limit:
                 if value > int(row_limit):
@@ -116,144 +386,411 @@ def write_table_metadata(cursor, writer, database, table, row_limit=None):
     writer.write_headers()
 
 
-def sequential_partition_data(cursor, writer, table, row_limit, max_step):
+def sequential_partition_data(cursor, writer, table, row_limit, max_step,
+                              condition=None):
     '''
     We use this to return a set of breakpoints of table IDs so we can
     grab the database in steps. Grabbing a whole table is a bit
     expensive. This takes the shortcut of assuming IDs are numeric and
     sequential.  Fast if they are, breaks if they aren't.
     '''
-    print "Partioning data"
+    print("Partioning data")
     pri_key = primary_key(writer)
-    cursor.execute('select min(`{pri}`), max(`{pri}`) from {table};'.format(
+    cursor.execute(
+        'select min(`{pri}`), max(`{pri}`) from {table} {where};'.format(
             pri=pri_key,
-            table=table
+            table=table,
+            where=_where([condition])
         ))
     (min_id, max_id) = (list(cursor)[0])
+    if min_id is None:
+        return None
 
-    print "Data range is: ", min_id, max_id
+    print("Data range is: ", min_id, max_id)
 
-    if row_limit and max_id-min_id < row_limit:
-        r = [min_id, min_id+row_limit+1]
-        print "Full range", r
+    if row_limit and max_id-min_id < int(row_limit):
+        r = [min_id, min_id+int(row_limit)+1]
+        print("Full range", r)
     else:
-        r = range(min_id, max_id, int(max_step)) + [max_id + 1]
-        print "Partitions", r
+        r = list(range(min_id, max_id, int(max_step))) + [max_id + 1]
+        print("Partitions", r)
     return r
 
 
-def partition_data(cursor, writer, table, row_limit, max_step):
+def sql_literal(value):
+    '''
+    Format a key value for use in SQL
+
+    >>> sql_literal(17)
+    '17'
+    >>> import datetime
+    >>> sql_literal(datetime.date(2016, 5, 1))
+    '"2016-05-01"'
+    '''
+    if isinstance(value, numbers.Number):
+        return str(value)
+    if not isinstance(value, str):
+        value = str(value)
+    if mysql_escape:
+        return '"{id}"'.format(id=mysql_escape(value))
+    return '"{id}"'.format(id=value.replace('\\', '\\\\').replace('"', '\\"'))
+
+
+def _where(conditions):
+    '''
+    A `where` clause joining the conditions which aren't `None`
+
+    >>> _where(["`id` > 7", None, "`id` <= 20"])
+    'where `id` > 7 and `id` <= 20'
+    >>> _where([None])
+    ''
+    '''
+    conditions = [c for c in conditions if c]
+    if not conditions:
+        return ""
+    return "where " + " and ".join(conditions)
+
+
+def vertica_literal(value):
+    '''
+    Format a value for use in Vertica SQL, which quotes strings with
+    single quotes
+
+    >>> vertica_literal("2016-05-01 12:30:00")
+    "'2016-05-01 12:30:00'"
+    '''
+    if isinstance(value, numbers.Number):
+        return str(value)
+    return "'" + str(value).replace("'", "''") + "'"
+
+
+def high_water_condition(column, since, mark, literal=sql_literal):
+    '''
+    SQL condition for rows above an old high-water mark, `since` (if
+    there is one), up to a new one, `mark`. `column` is quoted as
+    needed by the caller, and `literal` formats values.
+
+    >>> high_water_condition("`id`", 7, 20)
+    '`id` > 7 and `id` <= 20'
+    >>> high_water_condition("`id`", None, 20)
+    '`id` <= 20'
+    '''
+    conditions = []
+    if since is not None:
+        conditions.append("{column} > {since}".format(
+            column=column, since=literal(since)))
+    if mark is not None:
+        conditions.append("{column} <= {mark}".format(
+            column=column, mark=literal(mark)))
+    return " and ".join(conditions) or None
+
+
+def _key_after(key):
+    '''
+    A key greater than `key`, to end the last (half-open) partition
+    '''
+    if isinstance(key, numbers.Number):
+        return key + 1
+    return key + 'Z'
+
+
+def keyset_partitions(cursor, table, pri_key, step, row_limit=None,
+                      progress=None, condition=None):
+    '''
+    Find breakpoints splitting a table into partitions of `step` rows,
+    in a single walk along the primary key index. Each query starts at
+    the previous breakpoint (`where pk >= last`) and skips `step` keys,
+    so each index entry is read once. Stepping with `offset` alone
+    rescans from the start of the table every time, which is quadratic.
+
+    Returns the breakpoints (the first key of each partition, and an
+    exclusive end for the last), and the number of rows in each
+    partition. Returns `None` for an empty table. If `row_limit` is
+    set, we stop after that many rows. `progress`, if given, is called
+    with the number of rows in each partition found. With a `condition`,
+    only rows which match it count.
+    '''
+    def key_at(where, offset):
+        cursor.execute(
+            'select `{pri}` from {table} {where} order by `{pri}` '
+            'limit 1 offset {offset};'.format(
+                pri=pri_key, table=table, where=_where([where, condition]),
+                offset=offset))
+        result = list(cursor)
+        if result:
+            return result[0][0]
+        return None
+
+    start = key_at(None, 0)
+    if start is None:
+        return None
+    breakpoints = [start]
+    counts = []
+    total = 0
+    while step or (row_limit and not counts):
+        size = step or row_limit
+        if row_limit:
+            size = min(size, row_limit - total)
+        following = key_at(
+            "`{pri}` >= {last}".format(
+                pri=pri_key, last=sql_literal(breakpoints[-1])),
+            size)
+        if following is None:
+            break
+        breakpoints.append(following)
+        counts.append(size)
+        total += size
+        if progress:
+            progress(size)
+        if row_limit and total >= row_limit:
+            return (breakpoints, counts)
+
+    # The last partition runs to the end of the table
+    cursor.execute(
+        'select count(*), max(`{pri}`) from {table} {where};'.format(
+            pri=pri_key, table=table, where=_where([
+                "`{pri}` >= {last}".format(
+                    pri=pri_key, last=sql_literal(breakpoints[-1])),
+                condition])))
+    (count, last_key) = list(cursor)[0]
+    if progress:
+        progress(count)
+    counts.append(count)
+    breakpoints.append(_key_after(last_key))
+    return (breakpoints, counts)
+
+
+def partition_data(cursor, writer, table, row_limit, max_step,
+                   condition=None):
     '''
     We use this to return a set of breakpoints of table IDs so we can
     grab the database in steps. Grabbing a whole table is a bit
     expensive. This will step through the IDs, and return the ID at
-    every max_step, and finally the maximum ID plus one.
+    every max_step, and finally the maximum ID plus one. See
+    `keyset_partitions` for how.
 
     If max_step isn't set, it will return (min, max+1)
 
     If row_limit is set, it will only do that many rows in the table
-    (useful for debugging).
+    (useful for debugging). If condition is set, only rows matching it
+    are counted.
     '''
-    print "Partioning data"
+    print("Partioning data")
     rows = writer.get_metadata('mysql-rows')
-    id_range = []
     pri_key = primary_key(writer)
-    if max_step:
-        step = int(max_step)
-        with click.progressbar(range(0, rows, step), show_pos=True) as steps:
-            for offset in steps:
-                cursor.execute(
-                    'select `{pri}` from {table} order by `{pri}` '
-                    'limit 1 offset {offset};'.format(
-                        table=table,
-                        pri=pri_key,
-                        offset=offset)
-                )
-                offset_list = list(cursor)
-                if len(offset_list) > 0:
-                    id_range.append(offset_list[0][0])
-                else:
-                    continue
-    else:
-        cursor.execute('select min(`{pri}`) from {table};'.format(
-            pri=pri_key,
-            table=table
-        ))
-        id_range.append(list(cursor)[0][0])
+    step = int(max_step) if max_step else None
+    limit = int(row_limit) if row_limit else None
+    with click.progressbar(length=rows, show_pos=True) as bar:
+        partitions = keyset_partitions(
+            cursor, table, pri_key, step, limit, progress=bar.update,
+            condition=condition)
+    if partitions is None:
+        return None
+    (id_range, counts) = partitions
+
+    if isinstance(id_range[0], str):
+        id_range = [sql_literal(id) for id in id_range]
+
+    print("Partitions:", id_range)
+    print("Rows per partition:", counts)
+    return id_range
 
-    # This is a little complex so we can handle the case where there are fewer
-    # rows than the limit
-    row_max = None
-    if row_limit:
-        cursor.execute(
-            'select `{pri}` from {table} order by `{pri}` '
-            'limit 1 offset {rows};'.format(
-                pri=pri_key,
-                table=table,
-                rows=rows))
-        offset_list = list(cursor)
-        if len(offset_list) > 0:
-            row_max = offset_list[0][0]
-
-    if row_max is None:
-        cursor.execute('select max(`{pri}`) from {table};'.format(
+
+def range_query(table, pri_key, min_id, max_id, condition=None):
+    '''
+    SQL to select one partition of a table
+    '''
+    return "select * from {table} where " \
+        '`{pri}` >= {min_id} and `{pri}` < {max_id}{condition};'.format(
             pri=pri_key,
-            table=table
-        ))
+            table=table,
+            min_id=min_id,
+            max_id=max_id,
+            condition=" and " + condition if condition else ""
+        )
 
-        max_id_list = list(cursor)
-        if len(max_id_list) > 0 and max_id_list[0][0] is not None:
-            last_row = max_id_list[0][0]
-            if isinstance(last_row, numbers.Number):
-                row_max = last_row + 1
-            elif isinstance(last_row, basestring):
-                row_max = last_row + 'Z'
-        else:
-            return None
 
-    id_range.append(row_max)
+def keyset_query(table, pri_key, last, size, timeout=None, condition=None):
+    '''
+    SQL for the `size` rows after key `last` (from the start of the
+    table if `last` is None), in key order, which match `condition`,
+    if given. For a composite key, `pri_key` is a list of columns, and
+    `last` a tuple of their values. With a `timeout` in seconds, MySQL
+    (5.7 and up) abandons the query if it runs longer. Other databases
+    ignore the hint.
+
+    >>> keyset_query("items", "id", 7, 100)
+    'select * from items where `id` > 7 order by `id` limit 100;'
+    >>> keyset_query("t", ["a", "b"], (7, 8), 10)
+    'select * from t where (`a`, `b`) > (7, 8) order by `a`, `b` limit 10;'
+    '''
+    if isinstance(pri_key, str):
+        (pri_key, last) = ([pri_key], None if last is None else [last])
+    columns = ", ".join("`{0}`".format(column) for column in pri_key)
+    hint = ""
+    if timeout:
+        hint = "/*+ MAX_EXECUTION_TIME({ms}) */ ".format(
+            ms=int(timeout * 1000))
+    after = None
+    if last is not None:
+        values = ", ".join(sql_literal(value) for value in last)
+        if len(pri_key) > 1:
+            (columns, values) = ("(" + columns + ")", "(" + values + ")")
+        after = "{columns} > {values}".format(columns=columns, values=values)
+    where = _where([after, condition])
+    if where:
+        where += " "
+    return "select {hint}* from {table} {where}order by {order} " \
+        "limit {size};".format(
+            hint=hint, table=table, where=where,
+            order=", ".join("`{0}`".format(column) for column in pri_key),
+            size=size)
+
+
+def range_queries(writer, table, id_range, condition=None):
+    '''
+    SQL to select each partition of a table, given the breakpoints
+    '''
+    pri_key = primary_key(writer)
+    return [range_query(table, pri_key, min_id, max_id, condition)
+            for min_id, max_id in zip(id_range[:-1], id_range[1:])]
+
 
-    if isinstance(id_range[0], basestring):
-        id_range = ['"{id}"'.format(id=mysql_escape(id)) for id in id_range]
+def grab_table_data_parallel(pool, writer, table, id_range, workers,
+                             export_checkpoint=None, state=None,
+                             condition=None):
+    '''
+    Like `grab_table_data`, but fetch partitions concurrently over a
+    pool of connections, and merge them into the writer in order.
+
+    With a checkpoint, we record each partition as it's written, and
+    resume after the partitions done according to `state`.
+    '''
+    print("Grabbing data for "+table+" with", workers, "workers")
+    queries = range_queries(writer, table, id_range, condition)
+    done = state["done"] if state else 0
+
+    with click.progressbar(length=len(queries), show_pos=True) as bar:
+        def written(query):
+            nonlocal done
+            done += 1
+            if export_checkpoint:
+                export_checkpoint.save(id_range=id_range, done=done,
+                                       offset=writer.destination.commit())
+            bar.update(1)
+
+        bar.update(done)
+        export_pool.export_partitions(
+            pool, writer, queries[done:], workers, progress=written)
+    writer.close()
+    if export_checkpoint:
+        export_checkpoint.finish()
+    print("Done!")
 
-    print "Partitions:", id_range
-    return id_range
 
+def grab_table_data_shards(pool, writer, table, id_range, filename, workers,
+                           export_checkpoint=None, state=None,
+                           condition=None):
+    '''
+    Fetch partitions concurrently over a pool of connections, writing
+    each to its own shard file, with the headers of `writer`.
 
-def grab_table_data(cursor, writer, table, id_range):
+    Each shard is written to a partial file, and renamed when it's
+    complete. When resuming an export (given its `state`), shards which
+    are already complete are skipped.
     '''
-    Step through a table, in blocks of the partitions, and write out
-    the rows to a TSVx file.
+    print("Grabbing data for "+table+" with", workers, "workers")
+    queries = range_queries(writer, table, id_range, condition)
+    todo = list(range(len(queries)))
+    if state:
+        todo = [index for index in todo
+                if not os.path.exists(shard_filename(filename, index))]
+    if export_checkpoint:
+        export_checkpoint.save(id_range=id_range)
+
+    def make_writer(position):
+        index = todo[position]
+        shard = tsvx.writer(
+            checkpoint.CheckpointedFile(shard_filename(filename, index)))
+        copy_headers(writer, shard)
+        shard.add_metadata("shard", index)
+        shard.add_metadata("shards", len(queries))
+        shard.write_headers()
+        return shard
+
+    def finish(position):
+        checkpoint.complete(shard_filename(filename, todo[position]))
+
+    with click.progressbar(length=len(queries), show_pos=True) as bar:
+        bar.update(len(queries) - len(todo))
+        export_pool.export_partition_shards(
+            pool, make_writer, [queries[index] for index in todo], workers,
+            progress=lambda query: bar.update(1), finish=finish)
+    if export_checkpoint:
+        export_checkpoint.finish()
+    print("Done!")
+
+
+def grab_table_data(pool, writer, table, max_step=None, row_limit=None,
+                    timeout=None, export_checkpoint=None, state=None,
+                    condition=None):
     '''
-    print "Grabbing data for "+table
-    ranges = zip(id_range[:-1], id_range[1:])
-    pri_key = primary_key(writer)
-    with click.progressbar(ranges, show_pos = True, item_show_func = lambda x:str(x), show_percent = True) as steps:
-        for min_id, max_id in steps:
-            sql_command = "select * from {table} where " \
-                          '`{pri}` >= {min_id} and `{pri}` < {max_id};'.format(
-                              pri=pri_key,
-                              table=table,
-                              min_id=min_id,
-                              max_id=max_id
-                          )
-            try:
-                cursor.execute(sql_command)
-            except:
-                time.sleep(5)
-                os.system("echo Change this line to have a command which fixes the problem ")
-                time.sleep(5)
-                try:
-                    cursor = reconnect()
-                    cursor.execute(sql_command)
-                except:
-                    raw_input("Confirm connection")
-                    cursor = reconnect()
-                    cursor.execute(sql_command)
-            for row in cursor:
-                writer.write(*row)
+    Read a table, and write out the rows to a TSVx file.
+
+    Without `max_step`, this is one query for the whole table, which is
+    consistent, but may be slow. Otherwise, we page through the table
+    along its primary key (all its columns, if it's composite), in
+    pages of at most `max_step` rows. Slow pages shrink, and fast ones
+    grow back; pages which fail, or run past `timeout` seconds, are
+    retried with fewer rows after a pause (see
+    `export_pool.export_keyset`).
+
+    With a checkpoint, paged exports record the last key written after
+    each page (encoded as the key columns are in TSVx, since keys may be
+    dates or decimals, which JSON can't hold), and resume after the key
+    in `state`. With a `condition`, only matching rows are exported.
+    '''
+    print("Grabbing data for "+table)
+    if not max_step:
+        query = "select * from {table}".format(table=table)
+        if condition:
+            query += " where " + condition
+        if row_limit:
+            query += " limit {limit}".format(limit=int(row_limit))
+        export_pool.stream_query(pool, query + ";", writer.write_rows)
+    else:
+        pri_keys = primary_keys(writer)
+        key_indices = [writer.headers.index(key) for key in pri_keys]
+        key_types = [writer.types[index] for index in key_indices]
+        step = export_pool.AdaptiveStep(int(max_step))
+        limit = int(row_limit) if row_limit else None
+        (last, total) = (None, 0)
+        if state:
+            (last, total) = (state["last"], state["rows"])
+            if last is not None:
+                last = tuple(tsvx.parser.parser_for(key_type)(value)
+                             for (key_type, value) in zip(key_types, last))
+
+        def commit(last, total):
+            if export_checkpoint:
+                export_checkpoint.save(
+                    last=[tsvx.parser.encoder_for(key_type)(value)
+                          for (key_type, value) in zip(key_types, last)],
+                    rows=total, offset=writer.destination.commit())
+
+        with click.progressbar(length=writer.get_metadata('mysql-rows'),
+                               show_pos=True) as bar:
+            bar.update(total)
+            export_pool.export_keyset(
+                pool, writer,
+                lambda last, size: keyset_query(
+                    table, pri_keys, last, size, timeout, condition),
+                key_indices, step, limit,
+                progress=bar.update, last=last, total=total, commit=commit)
     writer.close()
-    print "Done!"
+    if export_checkpoint:
+        export_checkpoint.finish()
+    print("Done!")
 
 
 def mysql_to_python_type(type_string):
@@ -285,70 +822,84 @@ def mysql_to_python_type(type_string):
                      "in this file" % (type_string))
 
 
-def probe_mongo_schema(mongoclient, database, collection, omits=None):
+def probe_mongo_schema(mongoclient, database, collection, omits=None,
+                       sample_size=mongo_export.SAMPLE_SIZE, workers=4):
     '''
     Create a dictionary of all the field names in a Mongo database,
     and their associated types. Takes a MongoClient, a database name,
     and a collection name. Returns a dictionary mapping field names
-    (e.g. "top_level.mid_level.bottom_level") to lists of types which
-    occur under that name.
-    '''
-    def flatson(fields, json, prefix=""):
-	'''
-        Helper script to recursively crawl JSON dictionary, extract types,
-        and convert to dot format.
-        '''
-        for key in json:
-            if key in omits:
-                fields[prefix+key].add(type(json[key]).__name__)
-            elif isinstance(json[key], dict):
-                flatson(fields, json[key], prefix+key+".")
-            else:
-                fields[prefix+key].add(type(json[key]).__name__)
-        return fields
-
-    cursor = mongoclient[database][collection].find()
-    fields = collections.defaultdict(lambda: set())
-    for item in cursor:
-        flatson(fields, item)
-    return dict(fields)
+    (e.g. "top_level.mid_level.bottom_level") to sets of types which
+    occur under that name. We look at a sample of `sample_size`
+    documents, in `workers` threads (see `mongo_export.probe_schema`).
+    '''
+    return mongo_export.probe_schema(
+        mongoclient[database][collection], sample_size, workers,
+        omits or ())
+
+
+def vertica_high_water_query(cursor, query, column, since=None):
+    '''
+    Find the high-water mark (the maximum) of `column` in the results of
+    a Vertica `query`. Returns a query for the rows above `since` (an
+    earlier mark, if there is one), up to the new mark, and the mark.
+    '''
+    query = query.strip().rstrip(";")
+    cursor.execute("select max({column}) from ({query}) as source;".format(
+        column=column, query=query))
+    mark = high_water_value(cursor.fetchall()[0][0])
+    condition = high_water_condition(column, since, mark, vertica_literal)
+    if condition:
+        query = "select * from ({query}) as source where {condition}".format(
+            query=query, condition=condition)
+    return (query + ";", mark)
 
 
 def query_vertica_to_tsvx(
         cursor,
         query,
-        tsvx_writer):
+        tsvx_writer,
+        batch_size=export_pool.BATCH_SIZE):
     '''
     Run a query in Vertica. Output it to a TSVx file. Takes
     a cursor, a SQL query, and a TSVx writer.
+
+    The cursor should return rows as tuples (the default, not
+    `cursor('dict')`). Column names come from `cursor.description`,
+    and types from the first row. Rows are fetched and written in
+    batches, so memory use doesn't grow with the size of the result.
+    Returns the number of rows. Raises `EmptyResultException` if the
+    query returns no rows.
     '''
     # Run the query
     cursor.execute(query)
+    headers = [column[0] for column in cursor.description]
 
-    # Inspect the first element to figure out the headers
-    first, rest = tsvx.helpers.peek(cursor.iterate())
+    # Inspect the first row to figure out the types
+    batch = cursor.fetchmany(batch_size)
+    if not batch:
+        raise EmptyResultException("No rows returned by " + query)
     python_types = []
-    headers = []
-    variables = []
-    for key in first:
-        t = type(first[key])
+    for value in batch[0]:
+        t = type(value)
         # Typically, vertica_python uses future.types.newstr.newstr
         # We'd prefer 'unicode'
-        if isinstance(first[key], basestring):
+        if isinstance(value, str):
             t = str
         python_types.append(t)
-        headers.append(key)
-        variables.append(tsvx.helpers.variable_from_string(key))
 
     # Write the headers
-    tsvx_writer.python_types(python_types)
-    tsvx_writer.headers(headers)
-    tsvx_writer.variables(variables)
+    tsvx_writer.types = python_types
+    tsvx_writer.headers = headers
+    tsvx_writer.variables = [
+        tsvx.helpers.variable_from_string(key) for key in headers]
     tsvx_writer.write_headers()
 
     # Dump the data
-    for line in rest:
-        items = [line[key] for key in line]
-        tsvx_writer.write(*items)
+    rows = 0
+    while batch:
+        tsvx_writer.write_rows(batch)
+        rows += len(batch)
+        batch = cursor.fetchmany(batch_size)
 
     tsvx_writer.close()
+    return rows
@@ -0,0 +1,309 @@
+'''
+Export a MongoDB collection to TSVx, in two passes.
+
+Pass one finds the schema. Documents are flattened into dotted field
+names ("top_level.mid_level.bottom_level"), and we collect the types
+which occur under each. Rather than read the whole collection, we
+look at a sample: several workers each draw part of it (with
+`$sample`, or by reading a bounded range of the collection), and we
+merge what they find. Fields which never show up in the sample aren't
+exported, so rare fields need a bigger sample.
+
+Pass two exports the collection with that schema. We compile the
+schema into a plan, a tree of the paths to fetch, so each document is
+walked once, visiting only the fields we want. Values are converted
+to the column types, and rows are written in batches. A value which
+doesn't fit its column (say, a string in a column which was all
+integers in the sample) can't be written. Rather than lose its
+document, the export fails with `SchemaMismatchException`, once it has
+counted all of them, and can be run again with those columns widened
+to strings (see `widen_schema`). Only strings can be missing in TSVx,
+so fields which were ever missing from the sample are exported as
+strings.
+'''
+
+import collections
+import concurrent.futures
+import datetime
+import itertools
+import json
+
+import tsvx.helpers
+
+import export_pool
+
+SAMPLE_SIZE = 10000
+
+_INTEGERS = {"int", "Int64", "long"}
+_NUMBERS = _INTEGERS | {"float"}
+
+
+class SchemaMismatchException(Exception):
+    '''
+    Some documents had values which didn't fit the types of their
+    columns. `plan.mismatches` counts them by column.
+    '''
+    def __init__(self, plan):
+        self.plan = plan
+        Exception.__init__(self, "Values which don't fit their columns: " +
+                           ", ".join("{column} ({count})".format(
+                               column=column, count=count)
+                               for column, count
+                               in sorted(plan.mismatches.items())))
+
+
+def flatten_fields(document, fields, omits=(), prefix=""):
+    '''
+    Add the dotted field names in `document`, and the names of the
+    types found under them, to `fields` (a dictionary of sets). We
+    don't descend into keys in `omits`: they're exported whole.
+
+    >>> fields = collections.defaultdict(set)
+    >>> flatten_fields({"a": 1, "b": {"c": "x"}, "d": {"e": 1}}, fields,
+    ...                omits=["d"])
+    >>> sorted((key, sorted(types)) for key, types in fields.items())
+    [('a', ['int']), ('b.c', ['str']), ('d', ['dict'])]
+    '''
+    for key, value in document.items():
+        if isinstance(value, dict) and key not in omits:
+            flatten_fields(value, fields, omits, prefix + key + ".")
+        else:
+            fields[prefix + key].add(type(value).__name__)
+
+
+def _probe(documents, omits):
+    '''
+    The schema of some documents. Fields missing from any of them get
+    "NoneType" among their types, as do fields which are null.
+    '''
+    fields = collections.defaultdict(set)
+    counts = collections.Counter()
+    total = 0
+    for document in documents:
+        found = collections.defaultdict(set)
+        flatten_fields(document, found, omits)
+        for field, types in found.items():
+            fields[field] |= types
+            counts[field] += 1
+        total += 1
+    for field in fields:
+        if counts[field] < total:
+            fields[field].add("NoneType")
+    return fields
+
+
+def _sample(collection, size, omits):
+    return _probe(
+        collection.aggregate([{"$sample": {"size": size}}]), omits)
+
+
+def _scan(collection, skip, limit, omits):
+    return _probe(collection.find({}, skip=skip, limit=limit), omits)
+
+
+def probe_schema(collection, sample_size=SAMPLE_SIZE, workers=4,
+                 omits=(), method="sample"):
+    '''
+    Find the schema of a collection: a dictionary mapping dotted field
+    names to sets of type names ("NoneType" if the field was missing or
+    null in some documents). We look at about `sample_size`
+    documents, shared between `workers` threads. With `method="sample"`,
+    they're picked at random with `$sample`; with `method="scan"`, we
+    read the first `sample_size` in natural order. If the sample would
+    be most of the collection (or `sample_size` is `None`), we read all
+    of it.
+    '''
+    count = collection.estimated_document_count()
+    if sample_size is None or sample_size * 2 >= count:
+        (method, sample_size) = ("scan", count)
+    share = sample_size // workers + 1
+    if method == "sample":
+        tasks = [(_sample, collection, share, omits)
+                 for _ in range(workers)]
+    elif method == "scan":
+        tasks = [(_scan, collection, skip, share, omits)
+                 for skip in range(0, sample_size, share)]
+    else:
+        raise ValueError("Unknown sampling method: " + repr(method))
+
+    schema = collections.defaultdict(set)
+    with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+        futures = [executor.submit(*task) for task in tasks]
+        for future in futures:
+            for field, types in future.result().items():
+                schema[field] |= types
+    return dict(schema)
+
+
+def column_type(types):
+    '''
+    The TSVx type for a column, given the type names seen in it.
+    Anything we can't do better with is a string. Only strings can be
+    missing in TSVx, so columns which were ever missing are strings.
+
+    >>> column_type({"int", "float"})
+    'float'
+    >>> column_type({"int", "NoneType"})
+    'str'
+    '''
+    types = set(types)
+    if types == {"bool"}:
+        return "bool"
+    if types <= _INTEGERS:
+        return "int"
+    if types <= _NUMBERS:
+        return "float"
+    if types == {"datetime"}:
+        return "ISO8601-datetime"
+    return "str"
+
+
+def widen_schema(schema, columns):
+    '''
+    A copy of `schema` in which `columns` are exported as strings
+
+    >>> widen_schema({"a": {"int"}}, ["a"])["a"] == {"int", "str"}
+    True
+    '''
+    widened = dict(schema)
+    for column in columns:
+        widened[column] = set(schema[column]) | {"str"}
+    return widened
+
+
+def _to_str(value):
+    if value is None or isinstance(value, str):
+        return value
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, default=str, sort_keys=True)
+    return str(value)
+
+
+def _converter(name):
+    '''
+    A function converting values to the type `name`. It raises
+    `ValueError` for values which don't fit.
+    '''
+    if name == "str":
+        return _to_str
+    kinds = {"bool": bool, "int": int, "float": (int, float),
+             "ISO8601-datetime": datetime.datetime}[name]
+    convert = {"int": int, "float": float}.get(name)
+
+    def fits(value):
+        # bool is an int, but True isn't a number we want
+        return isinstance(value, kinds) and \
+            (name == "bool" or not isinstance(value, bool))
+
+    def converter(value):
+        if not fits(value):
+            raise ValueError("{value!r} is not {name}".format(
+                value=value, name=name))
+        if convert is None:
+            return value
+        return convert(value)
+    return converter
+
+
+class ExportPlan:
+    '''
+    How to turn documents into rows, for a schema from `probe_schema`.
+    Columns are the dotted field names, in sorted order.
+
+    >>> plan = ExportPlan({"a": {"int"}, "b.c": {"str", "int"}})
+    >>> plan.columns, plan.types
+    (['a', 'b.c'], ['int', 'str'])
+    >>> plan.row({"a": 1, "b": {"c": 2, "d": 3}})
+    [1, '2']
+    >>> plan.row({"a": "one"}), plan.mismatches["a"]
+    (None, 1)
+    '''
+    def __init__(self, schema):
+        self.columns = sorted(schema)
+        self.types = [column_type(schema[column])
+                      for column in self.columns]
+        self.mismatches = collections.Counter()
+        self._converters = [_converter(name) for name in self.types]
+        # Each node maps a key to [column index, child node]; a field
+        # may be a value in some documents, and a document in others.
+        self._tree = {}
+        for index, column in enumerate(self.columns):
+            node = self._tree
+            keys = column.split(".")
+            for key in keys[:-1]:
+                node = node.setdefault(key, [None, None])
+                if node[1] is None:
+                    node[1] = {}
+                node = node[1]
+            node.setdefault(keys[-1], [None, None])[0] = index
+
+    def projection(self):
+        '''
+        A projection fetching just the top-level fields we export
+        '''
+        projection = dict((key, 1) for key in self._tree)
+        if "_id" not in projection:
+            projection["_id"] = 0
+        return projection
+
+    def row(self, document):
+        '''
+        The row for a document, or `None` if some value doesn't fit its
+        column (which is counted in `mismatches`)
+        '''
+        row = [None] * len(self.columns)
+        self._fill(self._tree, document, row)
+        for index, convert in enumerate(self._converters):
+            try:
+                row[index] = convert(row[index])
+            except ValueError:
+                self.mismatches[self.columns[index]] += 1
+                return None
+        return row
+
+    def _fill(self, node, document, row):
+        for key, (index, children) in node.items():
+            value = document.get(key)
+            if value is None:
+                continue
+            if children is not None and isinstance(value, dict):
+                self._fill(children, value, row)
+            elif index is not None:
+                row[index] = value
+
+
+def export_collection(collection, writer, schema, query=None,
+                      batch_size=export_pool.BATCH_SIZE):
+    '''
+    Pass two: write the headers for `schema`, and then the documents
+    matching `query` (all of them, by default) to a TSVx writer, in
+    batches. Returns the `ExportPlan`, and the number of rows written.
+
+    If some documents have values which don't fit their columns, we
+    carry on to count them, and then raise `SchemaMismatchException`.
+    What was written is incomplete; export again with
+    `widen_schema(schema, error.plan.mismatches)`.
+    '''
+    plan = ExportPlan(schema)
+    writer.headers = plan.columns
+    writer.variables = [tsvx.helpers.variable_from_string(
+        column.replace(".", "_")) for column in plan.columns]
+    writer.types = plan.types
+    writer.line_header("mongo-types", [
+        ",".join(sorted(schema[column])) for column in plan.columns])
+    writer.write_headers()
+
+    documents = iter(collection.find(query or {}, plan.projection(),
+                                     batch_size=batch_size))
+    rows = 0
+    while True:
+        batch = list(itertools.islice(documents, batch_size))
+        if not batch:
+            break
+        batch = [plan.row(document) for document in batch]
+        batch = [row for row in batch if row is not None]
+        writer.write_rows(batch)
+        rows += len(batch)
+    if plan.mismatches:
+        raise SchemaMismatchException(plan)
+    return (plan, rows)
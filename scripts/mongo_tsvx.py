@@ -1,24 +1,34 @@
-'''
-UNFINISHED
+'''Export a Mongo collection as a TSVx file
 
-This script will, once finished, output a Mongo table as a TSVx
-file. It's a two-pass process. Pass 1 discovers the schemaless
-schema. Pass two exports it with that schema.
+It's a two-pass process (see `mongo_export.py`). Pass one discovers
+the schemaless schema, from a sample of the collection. Pass two
+exports it with that schema.
 
-It doesn't work very well on edX data; we have values in keys. That's
-why it's unfinished
+Where data has values in keys (as edX data does), every value becomes
+a column. List such keys in `--omits`; each is then exported whole, as
+JSON.
 
 Usage:
   mongo_tsvx.py --host=host --user=user --port=port
                 --password=password --database=database
                 --collection=collection
-                --omits=omits
+                [--omits=omits] [--output=filename]
+                [--sample=documents] [--scan] [--workers=workers]
 
+Options:
+  --omits=omits              Comma-separated keys not to flatten
+  --sample=documents         Documents to look at for the schema
+                             [default: 10000]
+  --scan                     Sample the start of the collection, rather
+                             than at random
+  --workers=workers          Threads sampling at once [default: 4]
 '''
 
 import docopt
 from pymongo import MongoClient
+
 import helpers
+import mongo_export
 
 arguments = docopt.docopt(__doc__)
 host = arguments["--host"]
@@ -27,10 +37,42 @@ password = arguments["--password"]
 database = arguments["--database"]
 collection = arguments["--collection"]
 username = arguments["--user"]
+omits = []
+if arguments["--omits"]:
+    omits = arguments["--omits"].split(",")
+filename = arguments["--output"]
+if not filename:
+    filename = "{database}-{collection}.tsvx.gz".format(
+        database=database, collection=collection)
+
+client = MongoClient(host, port, username=username, password=password,
+                     authSource=database)
+source = client[database][collection]
+schema = mongo_export.probe_schema(
+    source, int(arguments["--sample"]), int(arguments["--workers"]),
+    omits, "scan" if arguments["--scan"] else "sample")
+print("Found {count} fields".format(count=len(schema)))
+
+while True:
+    writer = helpers.open_tsvx_writer(filename)
+    writer.title = "{database}.{collection}".format(
+        database=database, collection=collection)
+    writer.add_metadata("mongo-database", database)
+    writer.add_metadata("mongo-collection", collection)
+    try:
+        (plan, rows) = mongo_export.export_collection(source, writer, schema)
+        break
+    except mongo_export.SchemaMismatchException as error:
+        mismatches = error.plan.mismatches
+        for column, count in sorted(mismatches.items()):
+            print("{count} documents where {column} wasn't {type}".format(
+                column=column, count=count,
+                type=error.plan.types[error.plan.columns.index(column)]))
+        print("Exporting again, with those columns as strings "
+              "(a bigger --sample may avoid this)")
+        schema = mongo_export.widen_schema(schema, mismatches)
+    finally:
+        writer.close()
 
-client = MongoClient(host, port)
-db = client[database]
-db.authenticate(username, password)
-fields = helpers.probe_mongo_schema(
-    client, database, collection, omits=arguments["--omits"].split(",")
-)
+print("Exported {rows} documents to {filename}".format(
+    rows=rows, filename=filename))
@@ -1,19 +1,28 @@
 '''Dump a MySQL database to a directory of TSVx files
 
+Tables are exported concurrently, each by `mysql_tsvx.py` in its own
+process, largest first (see `dump_scheduler.py`).
+
 Usage:
   mysql_fulldb.py --host=host --user=user --port=port
                   --password=password --database=database
                   [--output=directory]
                   [--max-step=maximum-step] [--row-limit=row-limit]
+                  [--workers=workers] [--per-server=connections]
+
+Options:
+  --workers=workers          Tables to export at once [default: 4]
+  --per-server=connections   At most this many exports at once on the
+                             server
 '''
 
-import MySQLdb
 import docopt
-import subprocess
+import functools
 import sys
 import os
 import os.path
 
+import dump_scheduler
 import helpers
 
 arguments = docopt.docopt(__doc__)
@@ -25,20 +34,40 @@ if not arguments["--output"]:
 else:
     directory = arguments["--output"]
 
-print "Saving to " + directory
+print("Saving to " + directory)
 
 if not os.path.exists(directory):
     os.mkdir(directory)
 
+options = []
+if arguments["--max-step"]:
+    options.append("--max-step=" + arguments["--max-step"])
+if arguments["--row-limit"]:
+    options.append("--row-limit=" + arguments["--row-limit"])
+
+sizes = helpers.mysql_table_sizes(cursor)
 cursor.execute("show tables;")
-for table in cursor:
+jobs = []
+for table in cursor.fetchall():
     table = table[0]
     filename = os.path.join(directory, table + ".tsvx.gz")
     if os.path.exists(filename):
-        print "Skipping", filename
-    else:
-        print filename
-        helpers.scrape_mysql_table_to_tsvx(
-            filename, cursor, arguments["--database"], table,
-            arguments["--row-limit"], arguments["--max-step"]
-        )
+        print("Skipping", filename)
+        continue
+    command = helpers.mysql_tsvx_command(arguments, table, filename, options)
+    jobs.append(dump_scheduler.Job(
+        name=table,
+        run=functools.partial(helpers.run_command, command),
+        size=sizes.get(table, 0),
+        server=arguments["--host"]))
+
+per_server = None
+if arguments["--per-server"]:
+    per_server = int(arguments["--per-server"])
+results = dump_scheduler.run_jobs(
+    jobs, int(arguments["--workers"]), per_server)
+failures = [name for name in results
+            if isinstance(results[name], Exception)]
+if failures:
+    print("Failed:", " ".join(sorted(failures)))
+    sys.exit(1)
@@ -10,23 +10,28 @@ This script is kind of useable, but you need to read it to use it, and
 comment lines in/out. Step 1: Comment in mysqldump lines. Step 2: 
 Comment them out and comment in TSVX lines.
 
+Tables are dumped concurrently, largest first (see `dump_scheduler.py`).
+
 Usage:
   mysql_fulldb.py --host=host --user=user --port=port
                   --password=password --database=database
                   [--output=directory]
                   [--max-step=maximum-step] [--row-limit=row-limit]
-                  [--dry-run]
+                  [--dry-run] [--workers=workers]
+
+Options:
+  --workers=workers          Tables to dump at once [default: 4]
 '''
 
-import MySQLdb
 import docopt
-import random
-import subprocess
+import functools
 import sys
 import os
 import os.path
 import subprocess
 
+import checkpoint
+import dump_scheduler
 import helpers
 
 arguments = docopt.docopt(__doc__)
@@ -38,7 +43,7 @@ if not arguments["--output"]:
 else:
     directory = arguments["--output"]
 
-print "Saving to " + directory
+print("Saving to " + directory)
 
 if not os.path.exists(directory) and not arguments["--dry-run"]:
     os.mkdir(directory)
@@ -47,28 +52,14 @@ dry_run_tsvx = set()
 dry_run_needed = set()
 dry_run_mysql = set()
 
-cursor.execute("show tables;")
-ordered_cursor = list(cursor)
-random.shuffle(ordered_cursor)
-for table in ordered_cursor:
-    filename=directory+"/"+table[0]
 
-    if arguments["--dry-run"]:
-        if os.path.exists(filename+".0.gz"):
-            dry_run_mysql.add(table[0])
-        elif os.path.exists(filename+".tsvx.gz"):
-            dry_run_tsvx.add(table[0])
-        else:
-            dry_run_needed.add(table[0])
-
-    if os.path.exists(filename+".0.gz") or os.path.exists(filename+".0.tsvx.gz"):
-        print "Skipping", filename
-        continue
-    
-    print "Dumping", table, "to", filename
-    if arguments["--dry-run"]:
-        continue
 
+def dump(table, filename):
+    '''
+    Dump one table. The output file (or, if the dump didn't finish,
+    its partial file) is renamed with the exit code of the dump, so
+    failures are easy to spot.
+    '''
     # output = subprocess.call(
     #     ["mysqldump",
     #      "--single-transaction",
@@ -81,44 +72,58 @@ for table in ordered_cursor:
     #      "-p"+arguments["--password"],
     #      "--result-file="+filename,
     #      arguments["--database"],
-    #      table[0]]
+    #      table]
     # )
-    output = subprocess.call(
-        ["python", "mysql_tsvx.py",
-         "--user="+arguments["--user"],
-         "--host=127.0.0.1",
-         "--port="+arguments["--port"],
-         "--password="+arguments["--password"],
-         "--output="+filename+".tsvx.gz",
-         "--database="+arguments["--database"],
-         "--table="+table[0], "--max-step=100000", "--seq-id-partition"]
-    )
+    command = helpers.mysql_tsvx_command(
+        dict(arguments, **{"--host": "127.0.0.1"}), table,
+        filename+".tsvx.gz", ["--max-step=100000", "--seq-id-partition"])
+    output = subprocess.call(command, stdout=subprocess.DEVNULL)
     # newfilename = filename+"."+str(output)
 
     # newfilename = filename+"."+str(output)
-    # print "Moving", filename, "to", newfilename
+    # print("Moving", filename, "to", newfilename)
     # os.rename(filename, newfilename)
-    os.rename(filename+".tsvx.gz", filename+"."+str(output)+".tsvx.gz")
-    
-    if output == 0:
-        #subprocess.call(["gzip", newfilename])
-        
-        print "Success!"
-    else:
-        print "Failure :("
-
-    # table = table[0]
-    # filename = os.path.join(directory, table + ".tsvx.gz")
-    # if os.path.exists(filename):
-    #     print "Skipping", filename
-    # else:
-    #     print filename
-    #     helpers.scrape_mysql_table_to_tsvx(
-    #         filename, cursor, arguments["--database"], table,
-    #         arguments["--row-limit"], arguments["--max-step"]
-    #     )
+    for suffix in [".tsvx.gz", checkpoint.partial_filename(".tsvx.gz")]:
+        if os.path.exists(filename+suffix):
+            os.rename(filename+suffix, filename+"."+str(output)+suffix)
+            break
+
+    if output != 0:
+        raise RuntimeError("mysql_tsvx.py exited with " + str(output))
+    #subprocess.call(["gzip", newfilename])
+
+
+sizes = helpers.mysql_table_sizes(cursor)
+cursor.execute("show tables;")
+jobs = []
+for table in cursor.fetchall():
+    filename=directory+"/"+table[0]
+
+    if arguments["--dry-run"]:
+        if os.path.exists(filename+".0.gz"):
+            dry_run_mysql.add(table[0])
+        elif os.path.exists(filename+".tsvx.gz"):
+            dry_run_tsvx.add(table[0])
+        else:
+            dry_run_needed.add(table[0])
+
+    if os.path.exists(filename+".0.gz") or os.path.exists(filename+".0.tsvx.gz"):
+        print("Skipping", filename)
+        continue
+
+    print("Dumping", table[0], "to", filename)
+    if arguments["--dry-run"]:
+        continue
+
+    jobs.append(dump_scheduler.Job(
+        name=table[0],
+        run=functools.partial(dump, table[0], filename),
+        size=sizes.get(table[0], 0)))
+
+# Every table comes from the same server, so --workers is the only limit
+dump_scheduler.run_jobs(jobs, int(arguments["--workers"]))
 
 if arguments["--dry-run"]:
-    print "SQL Dump:", " ".join(sorted(dry_run_mysql))
-    print "TSVX Dump:", " ".join(sorted(dry_run_tsvx))
-    print "Needed:", " ".join(sorted(dry_run_needed))
+    print("SQL Dump:", " ".join(sorted(dry_run_mysql)))
+    print("TSVX Dump:", " ".join(sorted(dry_run_tsvx)))
+    print("Needed:", " ".join(sorted(dry_run_needed)))
@@ -4,15 +4,30 @@ This is a script which will dump a MySQL table to a TSVx file. In some
 modes of operation, it does NOT guarantee consistency. For large MySQL
 tables, doing a SELECT * will cause serious performance
 issues. Instead, this script will grab table rows in steps of
-e.g. 100,000 rows at a time. It will first figure out how to partition
-the table (IDs are often not contiguous). Then it will select rows in
-ranges. If you do want consistency, don't set a step size, and it will
-grab the whole table (but this may be slow).
+e.g. 100,000 rows at a time, paging along the primary key. The step
+adapts as we go: it grows while queries are quick, and shrinks when
+they're slow, fail, or pass the --timeout. Failed steps are retried
+after a pause. If you do want consistency, don't set a step size, and
+it will grab the whole table (but this may be slow).
 
-Note that the progress bar gives an estimate. For large tables, it may
-slow down (in MySQL, large offsets sometimes take longer than small
-offsets). This very noticable for the partitioning step, and less
-significant for the data step itself.
+The file is written as FILENAME.partial, and renamed when complete.
+Progress is saved in FILENAME.checkpoint; if the export is interrupted,
+run the same command again to resume it.
+
+For tables which are only appended to, --incremental records a
+high-water mark (the largest primary key, or --updated-at column) in
+the metadata. Run again with --incremental, and only rows above the
+mark of the latest export are grabbed, into a new delta file next to
+the full export (e.g. db-table.delta-0001.tsvx).
+
+With several workers, we first figure out how to partition the table
+(IDs are often not contiguous), and then select the partitions
+concurrently, in fixed steps.
+
+Note that the progress bar gives an estimate, based on the row count
+MySQL reports for the table. Partitioning walks the primary key index
+once, from one breakpoint to the next, so it takes time proportional to
+the size of the table.
 
 Usage:
   mysql_tsvx.py --host=host --user=user --port=port
@@ -20,19 +35,35 @@ Usage:
                 --table=table  [--output=filename]
                 [--overwrite] [--max-step=maximum-step]
                 [--row-limit=row-limit] [--seq-id-partition]
+                [--workers=workers] [--shards] [--timeout=seconds]
+                [--incremental] [--updated-at=column]
 
 Options:
   --output=filename     What file to output to. Otherwise, generate.
                         a filename based on database and table name.
   --overwrite           If set, will overwrite file if it exists.
-  --max-step=step-size  Maximum number of rows to grab in one query. If
-                        you do want consistency, set this to be larger
-                        than the database.
+  --max-step=step-size  Number of rows to grab in the first query (and,
+                        with several workers, in each partition). If
+                        you do want consistency, don't set this.
   --row-limit=row-limit Only grab the first few rows. Useful for debugging!
   --seq-id-partition    With a maximum step, just partition based on steps
                         between minimum ID and maximum ID. Much faster for
                         numeric, sequential IDs. Might be very slow with
                         non-sequential IDs. Doesn't work with string IDs.
+  --workers=workers     Fetch this many partitions at once, each over its
+                        own connection [default: 1]
+  --shards              With several workers, write each partition to its
+                        own file (e.g. db-table.part-0003.tsvx), rather
+                        than merging them into one file in order.
+  --timeout=seconds     With one worker, abandon and retry (with a smaller
+                        step) queries running longer than this. Needs
+                        MySQL 5.7 or later.
+  --incremental         Record a high-water mark. If the file exists, and
+                        has one, export just the newer rows, to a delta
+                        file.
+  --updated-at=column   With --incremental, use this column (such as a
+                        last-modified time) for the high-water mark,
+                        rather than the primary key.
 '''
 
 import docopt
@@ -43,6 +74,10 @@ import helpers
 
 arguments = docopt.docopt(__doc__)
 cursor = helpers.mysql_connect(arguments)
+workers = int(arguments["--workers"])
+pool = None
+if workers > 1:
+    pool = helpers.mysql_pool(workers)
 
 if not arguments["--output"]:
     filename = arguments["--database"] + \
@@ -50,19 +85,32 @@ if not arguments["--output"]:
 else:
     filename = arguments["--output"]
 
-print "Saving to "+filename
+high_water = None
+since = None
+if arguments["--incremental"]:
+    high_water = arguments["--updated-at"] or True
+    previous = helpers.high_water_mark(filename)
+    if previous:
+        (high_water, since, index) = previous
+        print("Exporting rows with", high_water, "above", since)
+        filename = helpers.delta_filename(filename, index)
+
+print("Saving to "+filename)
 
 if os.path.exists(filename) and not arguments["--overwrite"]:
-    print "File %s exists" % (filename)
+    print("File %s exists" % (filename))
     sys.exit(-1)
 
 if arguments["--seq-id-partition"] and not arguments["--max-step"]:
-    print "Invalid arguments. --seq-id-partition requires a --max-step for the partitioning"
-    print "Try adding --max-step=100000"
+    print("Invalid arguments. --seq-id-partition requires a --max-step for the partitioning")
+    print("Try adding --max-step=100000")
     sys.exit(1)
 
 helpers.scrape_mysql_table_to_tsvx(
     filename, cursor, arguments["--database"], arguments["--table"],
     arguments["--row-limit"], arguments["--max-step"],
-    arguments["--seq-id-partition"]
+    arguments["--seq-id-partition"],
+    pool=pool, workers=workers, shards=arguments["--shards"],
+    timeout=float(arguments["--timeout"]) if arguments["--timeout"] else None,
+    high_water=high_water, since=since
 )
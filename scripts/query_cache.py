@@ -0,0 +1,185 @@
+'''
+A cache of query exports, so that jobs which run the same query
+against the same warehouse share one export.
+
+Entries are TSVx files in a cache directory, named by a hash of the
+normalized query and the connection target. Each records, in its
+metadata, the query, the target, when it was made, and how long it
+stays fresh (`cache-created` and `cache-ttl`, in seconds). A fresh
+entry is hardlinked (or copied) to where it's wanted. Compressed and
+uncompressed exports are separate entries.
+
+The cache is bounded in size. When it grows too big, we evict the
+least recently used entries. An entry's modification time is its last
+use; we touch it on every hit.
+
+Entries keep the title and description of the export which made them.
+'''
+
+import hashlib
+import os
+import os.path
+import re
+import shutil
+import threading
+import time
+
+import tsvx
+import tsvx.exceptions
+import tsvx.helpers
+
+EXTENSIONS = (".tsvx.gz", ".tsvx")
+
+_QUOTED = re.compile(r"('(?:[^']|'')*'|\"(?:[^\"]|\"\")*\")")
+
+
+def normalize_query(query):
+    '''
+    Normalize a query, so trivially different spellings share a cache
+    entry: whitespace is collapsed, and everything outside of quotes is
+    lower-cased. Trailing semicolons are dropped.
+
+    >>> normalize_query("SELECT *\\n  FROM t WHERE name = 'Bob' ;")
+    "select * from t where name = 'Bob'"
+    '''
+    parts = _QUOTED.split(query)
+    for i in range(0, len(parts), 2):
+        parts[i] = re.sub(r"\s+", " ", parts[i]).lower()
+    return "".join(parts).strip().rstrip(";").strip()
+
+
+def connection_target(host, port, database, user):
+    '''
+    A string identifying where a query runs
+
+    >>> connection_target("vertica", 5433, "warehouse", "etl")
+    'etl@vertica:5433/warehouse'
+    '''
+    return "{user}@{host}:{port}/{database}".format(
+        user=user, host=host, port=port, database=database)
+
+
+class QueryCache:
+    '''
+    A cache of exports in `directory`. Entries are fresh for `ttl`
+    seconds. If `max_bytes` is set, least recently used entries are
+    evicted to keep the cache under that size.
+    '''
+    def __init__(self, directory, ttl=3600, max_bytes=None, clock=time.time):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.clock = clock
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+    def key(self, query, target):
+        '''
+        The cache key for a query on a connection target
+        '''
+        text = normalize_query(query) + "\n" + target
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def path(self, query, target, extension=".tsvx.gz"):
+        '''
+        Where the entry for a query lives (whether or not it exists)
+        '''
+        return os.path.join(self.directory,
+                            self.key(query, target) + extension)
+
+    def lookup(self, query, target, extension=".tsvx.gz"):
+        '''
+        The path of a fresh entry for the query, or `None`. Stale (or
+        unreadable) entries are removed.
+        '''
+        path = self.path(query, target, extension)
+        try:
+            metadata = tsvx.read_header(path).metadata
+            expires = metadata["cache-created"] + metadata["cache-ttl"]
+        except FileNotFoundError:
+            return None
+        except (OSError, KeyError, TypeError, EOFError,
+                tsvx.exceptions.TSVxException):
+            expires = None
+        if expires is None or expires < self.clock():
+            self._remove(path)
+            return None
+        os.utime(path)
+        return path
+
+    def export(self, query, target, run, extension=".tsvx.gz"):
+        '''
+        Make a new entry for a query. `run` is called with a TSVx writer,
+        which it fills in and closes (`helpers.query_vertica_to_tsvx`
+        does this). Returns the path of the entry.
+        '''
+        path = self.path(query, target, extension)
+        # Concurrent exports of the same query each write their own
+        # file. The last to finish wins.
+        temporary = "{key}.{pid}-{thread}.tmp{extension}".format(
+            key=os.path.join(self.directory, self.key(query, target)),
+            pid=os.getpid(), thread=threading.get_ident(),
+            extension=extension)
+        writer = tsvx.writer(tsvx.helpers.open_text(temporary, "w"))
+        writer.add_metadata("cache-query", normalize_query(query))
+        writer.add_metadata("cache-target", target)
+        writer.add_metadata("cache-created", int(self.clock()))
+        writer.add_metadata("cache-ttl", int(self.ttl))
+        try:
+            run(writer)
+        except BaseException:
+            writer.destination.close()
+            self._remove(temporary)
+            raise
+        os.replace(temporary, path)
+        return path
+
+    def deliver(self, path, destination, link=True):
+        '''
+        Put a copy of the entry at `path` at `destination`: a hardlink if
+        `link` is set and the filesystem allows it, and otherwise a copy.
+        Anything already at `destination` is replaced, never written
+        over, so a linked entry can't be changed through it.
+        '''
+        if os.path.exists(destination):
+            os.unlink(destination)
+        if link:
+            try:
+                os.link(path, destination)
+                return
+            except OSError:
+                pass
+        shutil.copyfile(path, destination)
+
+    def entries(self):
+        '''
+        Paths of all entries, least recently used first
+        '''
+        paths = [os.path.join(self.directory, name)
+                 for name in os.listdir(self.directory)
+                 if name.endswith(EXTENSIONS) and ".tmp" not in name]
+        return sorted(paths, key=os.path.getmtime)
+
+    def evict(self):
+        '''
+        Remove least recently used entries until the cache is within
+        `max_bytes`. Returns the paths removed.
+        '''
+        if self.max_bytes is None:
+            return []
+        entries = self.entries()
+        total = sum(os.path.getsize(path) for path in entries)
+        removed = []
+        for path in entries:
+            if total <= self.max_bytes:
+                break
+            total -= os.path.getsize(path)
+            self._remove(path)
+            removed.append(path)
+        return removed
+
+    def _remove(self, path):
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
@@ -1,19 +1,22 @@
-'''Upload a TSVx file to Vertica
+'''Upload TSVx files to Vertica
 
-This is a script which will slowly upload a TSVx file to Vertica. It
-has two modes of operation:
-
-* Line-by-line (thanks, Uber library!), so slower than necessary, but
-  gets the job done, eventually.
-* Bulk transfers. No promises on escaping strings correctly (thanks,
-  HP!)
+Files are bulk loaded with COPY, over several connections at once (see
+`vertica_load.py`): uncompressed files are split into byte ranges, and
+gzipped files (say, the shards of an export) load one per stream.
+Strings are re-escaped for COPY on the way. We report the rows loaded,
+and the rows rejected.
 
 Usage:
-  tsvx2vertica.py --table=table --file=tsvxfile
+  tsvx2vertica.py --table=table (--file=tsvxfile)...
                   [--host=host] [--user=user] [--port=port]
                   [--password=password] [--database=database]
                   [--prefix=prefix]
                   [--drop] [--create]
+                  [--streams=streams] [--rejected-table=table]
+
+Options:
+  --streams=streams          COPY streams to run at once [default: 4]
+  --rejected-table=table     Keep rows Vertica rejects in this table
 
 One must specify either host, user, port, database, and password, or
 prefix. If prefix is specified, said information will be taken
@@ -21,14 +24,14 @@ from environment variables
 '''
 
 import docopt
-import gzip
-import itertools
+import functools
 import os
-import os.path
 import sys
 import tsvx
 import vertica_python
 
+import vertica_load
+
 arguments = docopt.docopt(__doc__)
 
 
@@ -41,7 +44,8 @@ def argument(x):
     else:
         raise Exception("Missing parameter " + x)
 
-connection = vertica_python.connect(
+connect = functools.partial(
+    vertica_python.connect,
     host=argument('host'),
     port=int(argument('port')),
     user=argument('user'),
@@ -49,58 +53,47 @@ connection = vertica_python.connect(
     database=argument('database')
 )
 
-cur = connection.cursor()
-
 table_types = {
     'int': 'bigint',
     'str': 'varchar(64)',
     'float': 'float',
     'bool': 'boolean',
-    'ISO8601-datetime': 'DATETIME'
+    'ISO8601-datetime': 'DATETIME',
+    'ISO8601-date': 'DATE'
     }
 
-fp = gzip.open(arguments['--file'])
-input_tsvx = tsvx.reader(fp)
-vsql_types = [table_types[t] for t in input_tsvx.types()]
+files = arguments['--file']
+header = tsvx.read_header(files[0])
+type_names = [getattr(t, "__name__", t) for t in header.types]
+vsql_types = [table_types[t] for t in type_names]
 fields = ",\n    ".join(["{name} {type}".format(name=name, type=vsql_type)
                          for (name, vsql_type)
-                         in zip(input_tsvx.variables(), vsql_types)])
+                         in zip(header.variables, vsql_types)])
 create_command = "CREATE TABLE {table_name} ({fields});".format(
     table_name=arguments["--table"],
     fields=fields
 )
 
+connection = connect()
+cur = connection.cursor()
 if arguments['--drop']:
     cur.execute("DROP TABLE {table};".format(table=arguments["--table"]))
 if arguments['--create']:
     cur.execute(create_command)
     cur.execute("comment on table {table_name} is '{title}'".format(
         table_name=arguments["--table"],
-        title=input_tsvx.title().replace("'", '"').replace('\n', ' ')
+        title=(header.metadata.get("title") or "").replace(
+            "'", '"').replace('\n', ' ')
     ))
-
-columns = ",".join(input_tsvx.variables())
-
-
-def format(x):
-    if isinstance(x, int) or isinstance(x, float):
-        return str(x)
-    elif isinstance(x, str) or isinstance(x, unicode):
-        return "'"+x+"'"
-    else:
-        raise Exception(str(type(x)))
-
-# Line-by-line insert
-# Slow, but robust
-if False:
-    for line in input_tsvx:
-        cur.execute("insert into {table} values ({values});".format(
-            table=arguments["--table"],
-            values=",".join([format(x) for x in line])
-        ))
-    connection.commit()
-
-# CSV-style insert. Fast, but not well-vetted
-if True:
-    cur.copy("COPY {table} FROM stdin DELIMITER E'\t' NULL 'null';".format(
-        table=arguments["--table"]), fp)
+connection.commit()
+connection.close()
+
+statement = vertica_load.copy_statement(
+    arguments["--table"], header.variables, arguments["--rejected-table"])
+(loaded, rejected) = vertica_load.load(
+    files, vertica_load.vertica_sink(connect, statement),
+    streams=int(arguments["--streams"]), report=print)
+print("Loaded {loaded} rows; {rejected} rejected".format(
+    loaded=loaded, rejected=rejected))
+if rejected:
+    sys.exit(1)
@@ -9,15 +9,34 @@ Usage:
                   [--prefix=prefix]
                   [--title=title]
                   [--description=description]
+                  [--high-water=column]
+                  [--cache=directory] [--cache-ttl=seconds]
+                  [--cache-size=megabytes] [--cache-copy]
+
+Options:
+  --cache=directory        Share exports of the same query through a
+                           cache in this directory
+  --cache-ttl=seconds      How long a cached export stays fresh
+                           [default: 3600]
+  --cache-size=megabytes   Evict least recently used exports to keep the
+                           cache under this size [default: 10240]
+  --cache-copy             Copy cached exports, rather than hardlinking
 
 One must specify either host, user, port, database, and password, or
 prefix. If prefix is specified, said information will be taken
 from environment variables
+
+With --high-water, we record the maximum of a column which only grows
+(an ID, or a timestamp) in the metadata. If the file already exists,
+with such a mark, we export just the rows above it, to a delta file
+next to it (e.g. export.delta-0001.tsvx).
+
+With --cache, if the same query (up to whitespace and case) was run on
+the same server within the TTL, we hand back that export, rather than
+querying again. See `query_cache.py`. Incremental exports aren't cached.
 '''
 
 import docopt
-import gzip
-import itertools
 import os
 import os.path
 import sys
@@ -27,6 +46,7 @@ import vertica_python
 import tsvx.helpers
 
 import helpers
+import query_cache
 
 arguments = docopt.docopt(__doc__)
 
@@ -40,6 +60,25 @@ def argument(x):
     else:
         raise Exception("Missing parameter " + x)
 
+filename = arguments['--file']
+query = arguments['--query']
+high_water = arguments['--high-water']
+
+cache = None
+if arguments["--cache"] and not high_water:
+    cache = query_cache.QueryCache(
+        arguments["--cache"], ttl=int(arguments["--cache-ttl"]),
+        max_bytes=int(arguments["--cache-size"]) * 1024 * 1024)
+    target = query_cache.connection_target(
+        argument('host'), argument('port'), argument('database'),
+        argument('user'))
+    extension = ".tsvx.gz" if filename.endswith(".gz") else ".tsvx"
+    cached = cache.lookup(query, target, extension)
+    if cached:
+        print("Using cached export " + cached)
+        cache.deliver(cached, filename, link=not arguments["--cache-copy"])
+        sys.exit(0)
+
 connection = vertica_python.connect(
     host=argument('host'),
     port=int(argument('port')),
@@ -48,29 +87,58 @@ connection = vertica_python.connect(
     database=argument('database')
 )
 
-cur = connection.cursor('dict')
+cur = connection.cursor()
+if high_water:
+    since = None
+    previous = helpers.high_water_mark(filename)
+    if previous:
+        (high_water, since, index) = previous
+        filename = helpers.delta_filename(filename, index)
+        print("Exporting rows with", high_water, "above", since,
+              "to", filename)
+    (query, mark) = helpers.vertica_high_water_query(
+        cur, query, high_water, since)
 
-filename = arguments['--file']
-if filename.lower().endswith(".gz"):
-    fp = gzip.open(filename, "w")
-else:
-    fp = open(filename, "w")
-tsvx_writer = tsvx.writer(fp)
-
-if arguments["--title"]:
-    tsvx_writer.title(arguments["--title"])
-else:
-    tsvx_writer.title("Vertica query export")
-
-if arguments["--description"]:
-    tsvx_writer.description(arguments["--description"])
-else:
-    tsvx_writer.description("Vertica query export: {query}".format(
-        query=arguments['--query']
-    ))
-
-helpers.query_vertica_to_tsvx(
-    cur,
-    arguments['--query'],
-    tsvx_writer
-)
+
+
+def export(tsvx_writer):
+    if arguments["--title"]:
+        tsvx_writer.title = arguments["--title"]
+    else:
+        tsvx_writer.title = "Vertica query export"
+
+    if arguments["--description"]:
+        tsvx_writer.description = arguments["--description"]
+    else:
+        tsvx_writer.description = "Vertica query export: {query}".format(
+            query=arguments['--query']
+        )
+
+    if high_water:
+        tsvx_writer.add_metadata("high-water-column", high_water)
+        tsvx_writer.add_metadata("high-water-mark", mark)
+        if since is not None:
+            tsvx_writer.add_metadata("high-water-since", since)
+
+    helpers.query_vertica_to_tsvx(
+        cur,
+        query,
+        tsvx_writer
+    )
+
+
+try:
+    if cache:
+        cached = cache.export(query, target, export, extension)
+        cache.deliver(cached, filename, link=not arguments["--cache-copy"])
+        cache.evict()
+    else:
+        tsvx_writer = helpers.open_tsvx_writer(filename)
+        try:
+            export(tsvx_writer)
+        except helpers.EmptyResultException:
+            tsvx_writer.close()
+            os.unlink(filename)
+            raise
+except helpers.EmptyResultException:
+    print("No rows to export")
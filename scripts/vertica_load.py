@@ -0,0 +1,301 @@
+'''
+Bulk loading of TSVx files into Vertica, with parallel COPY streams.
+
+TSVx bodies are close to what Vertica's COPY wants already: tab
+separated, one row per line. The differences are in the escaping.
+TSVx strings are JSON-escaped (`\\t`, `\\n`, `\\"`, `\\u00e9`, ...),
+and a missing string is written `"null"`. COPY, with backslash as its
+escape character, takes a backslash as "the next character is
+literal", so a tab in a string is a backslash followed by a real tab.
+We decode each escaped string, and escape it again for COPY. NULLs
+are written `\\N`.
+
+Most chunks have nothing to rewrite. We check each with a regular
+expression and a couple of counts, and pass clean chunks through
+untouched; only chunks with escapes or NULLs are rewritten, line by
+line. Lines of the wrong width are dropped here, and counted as
+rejected, rather than sent on to the database.
+
+Each file is loaded in one or more tasks: byte ranges of uncompressed
+files (split at line boundaries), or whole gzipped files (so shards of
+an export load in parallel). Each task runs a COPY on its own
+connection, through a `sink`: a function which takes a binary stream
+of COPY data, and returns the number of rows loaded and rejected.
+`vertica_sink` makes one for Vertica; tests use a stand-in.
+'''
+
+import concurrent.futures
+import os
+import os.path
+import re
+
+import tsvx
+import tsvx.exceptions
+import tsvx.helpers
+import tsvx.tsvx
+
+from tsvx.parser import _parsestr
+
+CHUNK_SIZE = 4 * 1024 * 1024
+
+NULL = "\\N"
+
+# Anything which might need rewriting: an escape, a missing string, or
+# a missing (or empty) non-string value.
+_SPECIAL = re.compile(r'\\|"null"|(?:^|\t)(?:null|None)?(?:\t|$)', re.M)
+
+# Dates and booleans write missing values as strings do
+_NON_STRING_NULLS = ("null", "None", "", '"null"')
+
+
+def copy_escape(string):
+    r'''
+    Escape a string for COPY, with backslash as the escape character
+
+    >>> copy_escape("a\tb\\c")
+    'a\\\tb\\\\c'
+    '''
+    return string.replace("\\", "\\\\").replace("\t", "\\\t") \
+        .replace("\n", "\\\n").replace("\r", "\\\r")
+
+
+def copy_statement(table, columns, rejected_table=None):
+    r'''
+    The COPY statement matching the data we send
+
+    >>> print(copy_statement("items", ["id", "name"]))
+    COPY items (id, name) FROM STDIN DELIMITER E'\t' NULL AS '\N' ESCAPE AS '\';
+    '''
+    statement = "COPY {table} ({columns}) FROM STDIN DELIMITER E'\\t' " \
+        "NULL AS '{null}' ESCAPE AS '\\'".format(
+            table=table, columns=", ".join(columns), null=NULL)
+    if rejected_table:
+        statement += " REJECTED DATA AS TABLE {rejected}".format(
+            rejected=rejected_table)
+    return statement + ";"
+
+
+class CopyTranslator:
+    r'''
+    Rewrites chunks of TSVx body (whole lines) with column `types` into
+    COPY data. Lines we can't translate are dropped, and counted in
+    `rejected`.
+
+    >>> translator = CopyTranslator([int, str])
+    >>> translator.translate("1\tplain\n")
+    '1\tplain\n'
+    >>> translator.translate('2\ttab\\there\nnull\t"null"\n3\n')
+    '2\ttab\\\there\n\\N\t\\N\n'
+    >>> translator.rejected
+    1
+    >>> CopyTranslator([bool]).translate('"null"\n')
+    '\\N\n'
+    '''
+    def __init__(self, types):
+        self.width = len(types)
+        self.strings = [i for (i, python_type) in enumerate(types)
+                        if python_type in (str, "str")]
+        self.others = [i for i in range(self.width)
+                       if i not in self.strings]
+        self.rejected = 0
+
+    def translate(self, chunk):
+        if not chunk:
+            return chunk
+        if not chunk.endswith("\n"):
+            chunk += "\n"
+        lines = chunk.count("\n")
+        if chunk.count("\t") == lines * (self.width - 1) and \
+           not _SPECIAL.search(chunk, 0, len(chunk) - 1):
+            return chunk
+        output = []
+        for line in chunk.split("\n")[:-1]:
+            line = self._translate_line(line)
+            if line is not None:
+                output.append(line)
+        if not output:
+            return ""
+        return "\n".join(output) + "\n"
+
+    def _translate_line(self, line):
+        fields = line.split("\t")
+        if len(fields) != self.width:
+            if line:
+                self.rejected += 1
+            return None
+        for i in self.strings:
+            field = fields[i]
+            if field == '"null"':
+                fields[i] = NULL
+            elif "\\" in field:
+                try:
+                    fields[i] = copy_escape(_parsestr(field))
+                except ValueError:
+                    self.rejected += 1
+                    return None
+        for i in self.others:
+            if fields[i] in _NON_STRING_NULLS:
+                fields[i] = NULL
+        return "\t".join(fields)
+
+
+class ChunkReader:
+    '''
+    A binary stream (as COPY reads from) over an iterator of text
+    chunks
+
+    >>> ChunkReader(iter(["ab", "cd"])).read(3)
+    b'abc'
+    '''
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.buffer = b""
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                break
+            self.buffer += chunk.encode("utf-8")
+        if size < 0:
+            size = len(self.buffer)
+        (data, self.buffer) = (self.buffer[:size], self.buffer[size:])
+        return data
+
+
+def _body_offset(path):
+    '''
+    The header of an uncompressed TSVx file, and the byte offset at
+    which its body starts
+    '''
+    size = [0]
+
+    def lines(fp):
+        for line in fp:
+            size[0] += len(line)
+            yield line.decode("utf-8")
+
+    with open(path, "rb") as fp:
+        header = tsvx.tsvx.parse_header_lines(
+            tsvx.tsvx.read_header_lines(lines(fp)))
+    return (header, size[0])
+
+
+def _range_chunks(path, start, end, chunk_size):
+    '''
+    The lines in bytes [start, end) of a file, in chunks
+    '''
+    with open(path, "rb") as fp:
+        offsets = tsvx.helpers.line_offsets(fp, start, end, chunk_size)
+        for (begin, finish) in zip(offsets[:-1], offsets[1:]):
+            fp.seek(begin)
+            yield fp.read(finish - begin).decode("utf-8")
+
+
+def _stream_chunks(path, chunk_size):
+    '''
+    The body of a (gzipped) file, in chunks of whole lines
+    '''
+    with tsvx.helpers.open_text(path) as stream:
+        tsvx.tsvx.read_header_lines(stream)
+        while True:
+            chunk = stream.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk + stream.readline()
+
+
+def plan_tasks(paths, streams, chunk_size=CHUNK_SIZE):
+    '''
+    Split the files at `paths` into load tasks, to share between
+    `streams` parallel COPY streams. Returns the header, and a
+    list of `(path, start, end)` tasks; `start` and `end` are `None`
+    for gzipped files, which load whole. All the files must have the
+    same columns and types.
+    '''
+    headers = []
+    tasks = []
+    for path in paths:
+        if path.endswith(".gz"):
+            headers.append(tsvx.read_header(path))
+            tasks.append((path, None, None))
+            continue
+        (header, start) = _body_offset(path)
+        headers.append(header)
+        end = os.path.getsize(path)
+        # Big files are split between streams, but no piece is smaller
+        # than a chunk.
+        share = max(chunk_size, (end - start) // max(streams, 1) + 1)
+        with open(path, "rb") as fp:
+            offsets = tsvx.helpers.line_offsets(fp, start, end, share)
+        tasks.extend((path, begin, finish) for (begin, finish)
+                     in zip(offsets[:-1], offsets[1:]) if finish > begin)
+    if not headers:
+        raise ValueError("No files to load")
+    for (path, header) in zip(paths, headers):
+        if header.types != headers[0].types or \
+           header.column_names != headers[0].column_names:
+            raise tsvx.exceptions.TSVxFileFormatException(
+                "{path} has different columns from {first}".format(
+                    path=path, first=paths[0]))
+    return (headers[0], tasks)
+
+
+def load(paths, sink, streams=4, chunk_size=CHUNK_SIZE, report=None):
+    '''
+    Load the TSVx files at `paths` through `sink`, with up to `streams`
+    COPY streams at once. Returns the total number of rows loaded, and
+    the number rejected (by us or by the database). If `report` is
+    given, it's called with a line of progress as each task finishes.
+    '''
+    (header, tasks) = plan_tasks(paths, streams, chunk_size)
+
+    def run(task):
+        (path, start, end) = task
+        if start is None:
+            chunks = _stream_chunks(path, chunk_size)
+        else:
+            chunks = _range_chunks(path, start, end, chunk_size)
+        translator = CopyTranslator(header.types)
+        translated = (translator.translate(chunk) for chunk in chunks)
+        (loaded, rejected) = sink(ChunkReader(translated))
+        return (loaded, rejected + translator.rejected)
+
+    total_loaded = 0
+    total_rejected = 0
+    with concurrent.futures.ThreadPoolExecutor(streams) as executor:
+        for (task, (loaded, rejected)) in zip(tasks,
+                                               executor.map(run, tasks)):
+            total_loaded += loaded
+            total_rejected += rejected
+            if report:
+                (path, start, end) = task
+                where = os.path.basename(path)
+                if start is not None:
+                    where += " [{start}, {end})".format(start=start, end=end)
+                report("{where}: {loaded} rows loaded, {rejected} "
+                       "rejected".format(where=where, loaded=loaded,
+                                         rejected=rejected))
+    return (total_loaded, total_rejected)
+
+
+def vertica_sink(connect, statement):
+    '''
+    A sink which runs `statement` (see `copy_statement`) on a new
+    connection from `connect` for each task, and commits it. Counts
+    come from Vertica's `GET_NUM_ACCEPTED_ROWS` and
+    `GET_NUM_REJECTED_ROWS`.
+    '''
+    def sink(stream):
+        connection = connect()
+        try:
+            cursor = connection.cursor()
+            cursor.copy(statement, stream)
+            cursor.execute("SELECT GET_NUM_ACCEPTED_ROWS(), "
+                           "GET_NUM_REJECTED_ROWS();")
+            (loaded, rejected) = cursor.fetchone()
+            connection.commit()
+            return (loaded, rejected)
+        finally:
+            connection.close()
+    return sink
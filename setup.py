@@ -14,6 +14,12 @@ setup(
     scripts=[
         'scripts/tsv2tsvx.py'
     ],
+    entry_points={
+        'console_scripts': [
+            'tsv2tsvx = tsvx.convert:main',
+            'tsvx-profile = tsvx.profiling:main'
+        ]
+    },
     install_requires=[
         'python-dateutil',
         'docopt',
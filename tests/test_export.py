@@ -0,0 +1,781 @@
+'''
+Tests for the database export and load helpers in `scripts/`, using
+SQLite as a stand-in for MySQL, a parser as a stand-in for COPY, and
+lists of dictionaries as a stand-in for MongoDB. Runs under pytest, or as a script.
+'''
+
+import datetime
+import os
+import os.path
+import shutil
+import random
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "scripts"))
+
+import tsvx
+
+import checkpoint
+import dump_scheduler
+import mongo_export
+import export_pool
+import helpers
+import query_cache
+import vertica_load
+
+ROWS = 1000
+
+
+def make_database(directory):
+    '''
+    Create a SQLite table `items` with ROWS rows and gaps in the ids.
+    Return a function which connects to it.
+    '''
+    path = os.path.join(directory, "test.db")
+    connection = sqlite3.connect(path)
+    connection.execute(
+        "create table items (`id` integer primary key, name text, price real)")
+    connection.executemany(
+        "insert into items values (?, ?, ?)",
+        [(i * 3, "item\t" + str(i), i / 4.0) for i in range(ROWS)])
+    connection.commit()
+    connection.close()
+    return lambda: sqlite3.connect(path, check_same_thread=False)
+
+
+def make_writer(filename):
+    '''
+    A writer with the headers `write_table_metadata` would give for
+    the table.
+    '''
+    writer = helpers.open_tsvx_writer(filename)
+    writer.title = "Test export"
+    writer.headers = ["id", "name", "price"]
+    writer.types = [int, str, float]
+    writer.line_header("mysql-key", ["PRI", "", ""])
+    writer.write_headers()
+    return writer
+
+
+def expected_rows():
+    return [[i * 3, "item\t" + str(i), i / 4.0] for i in range(ROWS)]
+
+
+def read_rows(filename):
+    with tsvx.helpers.open_text(filename) as fp:
+        return [line.values() for line in tsvx.reader(fp)]
+
+
+def test_parallel_export():
+    '''
+    Partitions come back in order, whether they're held in memory or
+    spilled to disk.
+    '''
+    directory = tempfile.mkdtemp()
+    spool_bytes = export_pool.SPOOL_BYTES
+    try:
+        pool = export_pool.ConnectionPool(make_database(directory), 4)
+        filename = os.path.join(directory, "items.tsvx.gz")
+        id_range = list(range(0, ROWS * 3, 250)) + [ROWS * 3]
+        for export_pool.SPOOL_BYTES in [spool_bytes, 100]:
+            writer = make_writer(filename)
+            helpers.grab_table_data_parallel(
+                pool, writer, "items", id_range, 4)
+            assert read_rows(filename) == expected_rows()
+    finally:
+        export_pool.SPOOL_BYTES = spool_bytes
+        shutil.rmtree(directory)
+
+
+def test_sharded_export():
+    directory = tempfile.mkdtemp()
+    try:
+        pool = export_pool.ConnectionPool(make_database(directory), 3)
+        filename = os.path.join(directory, "items.tsvx")
+        template = make_writer(os.path.join(directory, "template.tsvx"))
+        id_range = list(range(0, ROWS * 3, 700)) + [ROWS * 3]
+        helpers.grab_table_data_shards(
+            pool, template, "items", id_range, filename, 3)
+        rows = []
+        for index in range(len(id_range) - 1):
+            rows.extend(read_rows(helpers.shard_filename(filename, index)))
+        assert rows == expected_rows()
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_keyset_partitions():
+    directory = tempfile.mkdtemp()
+    try:
+        cursor = make_database(directory)().cursor()
+        assert helpers.keyset_partitions(cursor, "items", "id", 300) == \
+            ([0, 900, 1800, 2700, 2998], [300, 300, 300, 100])
+        assert helpers.keyset_partitions(cursor, "items", "id", 300, 500) == \
+            ([0, 900, 1500], [300, 200])
+        assert helpers.keyset_partitions(cursor, "items", "id", None) == \
+            ([0, 2998], [ROWS])
+        cursor.execute("delete from items")
+        assert helpers.keyset_partitions(cursor, "items", "id", 300) is None
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_streaming_export():
+    '''
+    Rows are fetched and written in batches, and a query's columns and
+    types come from the cursor and the first row.
+    '''
+    directory = tempfile.mkdtemp()
+    try:
+        cursor = make_database(directory)().cursor()
+        filename = os.path.join(directory, "items.tsvx.gz")
+        helpers.query_vertica_to_tsvx(
+            cursor, "select * from items order by id",
+            helpers.open_tsvx_writer(filename), batch_size=64)
+        with tsvx.helpers.open_text(filename) as fp:
+            reader = tsvx.reader(fp)
+            assert reader.column_names == ["id", "name", "price"]
+            assert reader.types == [int, str, float]
+            assert [line.values() for line in reader] == expected_rows()
+
+        cursor.execute("delete from items")
+        try:
+            helpers.query_vertica_to_tsvx(
+                cursor, "select * from items",
+                helpers.open_tsvx_writer(filename))
+            assert False, "Expected EmptyResultException"
+        except helpers.EmptyResultException:
+            pass
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_adaptive_export():
+    '''
+    Paging along the key gets every row, with or without a step, and
+    with a row limit.
+    '''
+    directory = tempfile.mkdtemp()
+    try:
+        pool = export_pool.ConnectionPool(make_database(directory), 1)
+        filename = os.path.join(directory, "items.tsvx")
+        for (max_step, row_limit) in [(64, None), (None, None), (64, 100)]:
+            writer = make_writer(filename)
+            writer.add_metadata("mysql-rows", ROWS)
+            helpers.grab_table_data(pool, writer, "items", max_step,
+                                    row_limit, timeout=60)
+            assert read_rows(filename) == expected_rows()[:row_limit]
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_composite_key_export():
+    '''
+    With a composite key, pages follow all its columns, so rows which
+    share the first column's value with the end of a page aren't lost.
+    '''
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, "test.db")
+        rows = [[i // 10, i % 10, str(i)] for i in range(100)]
+        connection = sqlite3.connect(path)
+        connection.execute(
+            "create table pairs (a integer, b integer, name text, "
+            "primary key (a, b))")
+        connection.executemany("insert into pairs values (?, ?, ?)", rows)
+        connection.commit()
+        connection.close()
+        pool = export_pool.ConnectionPool(
+            lambda: sqlite3.connect(path, check_same_thread=False), 1)
+        filename = os.path.join(directory, "pairs.tsvx")
+        writer = helpers.open_tsvx_writer(filename)
+        writer.headers = ["a", "b", "name"]
+        writer.types = [int, int, str]
+        writer.line_header("mysql-key", ["PRI", "PRI", ""])
+        writer.add_metadata("mysql-rows", len(rows))
+        writer.write_headers()
+        helpers.grab_table_data(pool, writer, "pairs", 7)
+        assert read_rows(filename) == rows
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_adaptive_step_shrinks():
+    '''
+    Pages of more than 100 rows fail, as if they timed out. The step
+    shrinks until they succeed, and we still get every row, in order.
+    '''
+    directory = tempfile.mkdtemp()
+    try:
+        connect = make_database(directory)
+        failures = []
+
+        class SlowConnection:
+            def __init__(self):
+                self.connection = connect()
+
+            def cursor(self):
+                return SlowCursor(self.connection.cursor())
+
+            def close(self):
+                self.connection.close()
+
+        class SlowCursor:
+            def __init__(self, cursor):
+                self.cursor = cursor
+
+            def execute(self, query):
+                if int(query.split("limit ")[1].rstrip(";")) > 100:
+                    failures.append(query)
+                    raise sqlite3.OperationalError("Query timed out")
+                self.cursor.execute(query)
+
+            def fetchmany(self, size):
+                return self.cursor.fetchmany(size)
+
+            def close(self):
+                self.cursor.close()
+
+        pool = export_pool.ConnectionPool(SlowConnection, 1)
+        filename = os.path.join(directory, "items.tsvx")
+        writer = make_writer(filename)
+        step = export_pool.AdaptiveStep(400, minimum=10)
+        rows = export_pool.export_keyset(
+            pool, writer,
+            lambda last, size: helpers.keyset_query("items", "id", last, size),
+            0, step, backoff=0.001)
+        writer.close()
+        assert rows == ROWS
+        assert len(failures) >= 2
+        assert read_rows(filename) == expected_rows()
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_incremental_export():
+    '''
+    A full export records a high-water mark. After more rows are added,
+    a delta export gets just those rows, and moves the mark on.
+    '''
+    directory = tempfile.mkdtemp()
+    try:
+        connect = make_database(directory)
+        connection = connect()
+        cursor = connection.cursor()
+        filename = os.path.join(directory, "items.tsvx.gz")
+
+        def export():
+            (column, since, index) = ("id", None, None)
+            target = filename
+            previous = helpers.high_water_mark(filename)
+            if previous:
+                (column, since, index) = previous
+                target = helpers.delta_filename(filename, index)
+            (query, mark) = helpers.vertica_high_water_query(
+                cursor, "select * from items;", column, since)
+            writer = helpers.open_tsvx_writer(target)
+            writer.add_metadata("high-water-column", column)
+            writer.add_metadata("high-water-mark", mark)
+            helpers.query_vertica_to_tsvx(cursor, query, writer)
+            return target
+
+        assert helpers.high_water_mark(filename) is None
+        assert export() == filename
+        assert read_rows(filename) == expected_rows()
+        assert helpers.high_water_mark(filename) == ("id", (ROWS - 1) * 3, 1)
+
+        connection.executemany(
+            "insert into items values (?, ?, ?)",
+            [(i * 3, "item\t" + str(i), i / 4.0)
+             for i in range(ROWS, ROWS + 100)])
+        connection.commit()
+        delta = export()
+        assert delta == helpers.delta_filename(filename, 1)
+        assert [row[0] for row in read_rows(delta)] == \
+            [i * 3 for i in range(ROWS, ROWS + 100)]
+        assert helpers.high_water_mark(filename) == \
+            ("id", (ROWS + 99) * 3, 2)
+
+        # The same condition restricts a paged MySQL-style export
+        writer = make_writer(os.path.join(directory, "paged.tsvx"))
+        writer.add_metadata("mysql-rows", ROWS)
+        helpers.grab_table_data(
+            export_pool.ConnectionPool(connect, 1), writer, "items", 64,
+            condition=helpers.high_water_condition(
+                "`id`", (ROWS - 1) * 3, (ROWS + 49) * 3))
+        assert [row[0] for row in
+                read_rows(os.path.join(directory, "paged.tsvx"))] == \
+            [i * 3 for i in range(ROWS, ROWS + 50)]
+    finally:
+        shutil.rmtree(directory)
+
+
+class Crash(BaseException):
+    '''
+    Stands in for the export being killed; it isn't retried.
+    '''
+
+
+def crashing_pool(connect, queries):
+    '''
+    A pool whose connections crash the export on the `queries`'th query
+    '''
+    count = []
+
+    class CrashingConnection:
+        def __init__(self):
+            self.connection = connect()
+
+        def cursor(self):
+            count.append(1)
+            if len(count) == queries:
+                raise Crash()
+            return self.connection.cursor()
+
+        def close(self):
+            self.connection.close()
+
+    return export_pool.ConnectionPool(CrashingConnection, 1)
+
+
+def test_resume_export():
+    '''
+    An export killed part-way leaves only a partial file and a
+    checkpoint. Run again, it resumes, ignoring anything written after
+    the last checkpoint, and gives a complete file.
+    '''
+    directory = tempfile.mkdtemp()
+    try:
+        connect = make_database(directory)
+        filename = os.path.join(directory, "items.tsvx.gz")
+        template = make_writer(os.path.join(directory, "template.tsvx"))
+        template.add_metadata("mysql-rows", ROWS)
+
+        def run(pool):
+            export_checkpoint = checkpoint.Checkpoint(filename, {"t": 1})
+            state = export_checkpoint.load()
+            writer = helpers.open_checkpointed_writer(
+                export_checkpoint, template, state)
+            helpers.grab_table_data(pool, writer, "items", 100,
+                                    export_checkpoint=export_checkpoint,
+                                    state=state)
+
+        try:
+            run(crashing_pool(connect, 3))
+            assert False, "Expected a crash"
+        except Crash:
+            pass
+        assert not os.path.exists(filename)
+        state = checkpoint.Checkpoint(filename, {"t": 1}).load()
+        assert state["rows"] > 0 and state["last"] is not None
+        assert checkpoint.Checkpoint(filename, {"t": 2}).load() is None
+
+        # A torn write, after the last checkpoint
+        with open(checkpoint.partial_filename(filename), "ab") as fp:
+            fp.write(b"\x1f\x8bgarbage")
+
+        run(export_pool.ConnectionPool(connect, 1))
+        assert read_rows(filename) == expected_rows()
+        assert not os.path.exists(checkpoint.partial_filename(filename))
+        assert not os.path.exists(checkpoint.checkpoint_filename(filename))
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_resume_export_datetime_key():
+    '''
+    Keys which JSON can't hold, such as dates (here, with fractional
+    seconds), are checkpointed as TSVx encodes them, and decoded to
+    resume.
+    '''
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, "test.db")
+        start = datetime.datetime(2016, 5, 1)
+        rows = [[start + datetime.timedelta(minutes=i, microseconds=i + 1),
+                 str(i)] for i in range(ROWS)]
+        connection = sqlite3.connect(path)
+        connection.execute(
+            "create table events (created keytime primary key, name text)")
+        connection.executemany(
+            "insert into events values (?, ?)",
+            [(str(created), name) for (created, name) in rows])
+        connection.commit()
+        connection.close()
+        sqlite3.register_converter("keytime", lambda value: (
+            datetime.datetime.fromisoformat(value.decode())))
+
+        def connect():
+            return sqlite3.connect(path, check_same_thread=False,
+                                   detect_types=sqlite3.PARSE_DECLTYPES)
+
+        filename = os.path.join(directory, "events.tsvx")
+        template = helpers.open_tsvx_writer(
+            os.path.join(directory, "template.tsvx"))
+        template.headers = ["created", "name"]
+        template.types = ["ISO8601-datetime", str]
+        template.line_header("mysql-key", ["PRI", ""])
+        template.add_metadata("mysql-rows", ROWS)
+
+        def run(pool):
+            export_checkpoint = checkpoint.Checkpoint(filename, {"t": 1})
+            state = export_checkpoint.load()
+            writer = helpers.open_checkpointed_writer(
+                export_checkpoint, template, state)
+            helpers.grab_table_data(pool, writer, "events", 100,
+                                    export_checkpoint=export_checkpoint,
+                                    state=state)
+
+        try:
+            run(crashing_pool(connect, 3))
+            assert False, "Expected a crash"
+        except Crash:
+            pass
+        state = checkpoint.Checkpoint(filename, {"t": 1}).load()
+        assert state["last"][0] in [created.isoformat()
+                                    for (created, _) in rows[:-1]]
+
+        run(export_pool.ConnectionPool(connect, 1))
+        assert read_rows(filename) == rows
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_resume_sharded_export():
+    '''
+    Shards are only given their final names once complete, and a
+    resumed export skips them. When one shard fails, the others still
+    finish.
+    '''
+    directory = tempfile.mkdtemp()
+    try:
+        connect = make_database(directory)
+        filename = os.path.join(directory, "items.tsvx")
+        template = make_writer(os.path.join(directory, "template.tsvx"))
+        id_range = list(range(0, ROWS * 3, 700)) + [ROWS * 3]
+        export_checkpoint = checkpoint.Checkpoint(filename, {"t": 1})
+        try:
+            helpers.grab_table_data_shards(
+                crashing_pool(connect, 3), template, "items", id_range,
+                filename, 1, export_checkpoint)
+            assert False, "Expected a crash"
+        except Crash:
+            pass
+        shards = [helpers.shard_filename(filename, index)
+                  for index in range(len(id_range) - 1)]
+        assert [os.path.exists(shard) for shard in shards] == \
+            [True, True, False, True, True]
+
+        state = export_checkpoint.load()
+        assert state["id_range"] == id_range
+        helpers.grab_table_data_shards(
+            crashing_pool(connect, 4), template, "items", state["id_range"],
+            filename, 1, export_checkpoint, state)
+        rows = []
+        for shard in shards:
+            rows.extend(read_rows(shard))
+        assert rows == expected_rows()
+        assert not os.path.exists(checkpoint.checkpoint_filename(filename))
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_dump_scheduler():
+    '''
+    Jobs start largest first, within the worker and per-server limits,
+    and a failure doesn't stop the others.
+    '''
+    lock = threading.Lock()
+    started = []
+    running = {"a": 0, "b": 0}
+    most = {"a": 0, "b": 0}
+
+    def run(name, server):
+        with lock:
+            started.append(name)
+            running[server] += 1
+            most[server] = max(most[server], running[server])
+        time.sleep(0.02)
+        with lock:
+            running[server] -= 1
+        if name == "t3":
+            raise ValueError("Broken table")
+        return 10
+
+    jobs = [dump_scheduler.Job(
+        name="t" + str(i),
+        run=lambda i=i: run("t" + str(i), "ab"[i % 2]),
+        size=i * 1000,
+        server="ab"[i % 2]) for i in range(8)]
+    report = []
+    results = dump_scheduler.run_jobs(jobs, workers=3, per_server=1,
+                                      report=report.append)
+    assert started[:2] == ["t7", "t6"]
+    assert most == {"a": 1, "b": 1}
+    assert isinstance(results.pop("t3"), ValueError)
+    assert results == dict(("t" + str(i), 10) for i in range(8) if i != 3)
+    assert len([line for line in report if line.startswith("[")]) == 8
+
+
+def test_query_cache():
+    '''
+    A query is exported once, and served from the cache while fresh.
+    Least recently used entries are evicted to keep the cache small.
+    '''
+    directory = tempfile.mkdtemp()
+    try:
+        cursor = make_database(directory)().cursor()
+        now = [1000.0]
+        cache = query_cache.QueryCache(
+            os.path.join(directory, "cache"), ttl=60, clock=lambda: now[0])
+        target = query_cache.connection_target("localhost", 5433, "db", "me")
+        queries = []
+
+        def export(query):
+            def run(writer):
+                queries.append(query)
+                helpers.query_vertica_to_tsvx(cursor, query, writer)
+            return run
+
+        query = "select * from items"
+        assert cache.lookup(query, target) is None
+        cached = cache.export(query, target, export(query))
+        destination = os.path.join(directory, "items.tsvx.gz")
+        cache.deliver(cached, destination)
+        assert read_rows(destination) == expected_rows()
+
+        # Same query, differently spelled; and on another server
+        assert cache.lookup("SELECT *\n FROM items;", target) == cached
+        assert cache.lookup(query, "me@elsewhere:5433/db") is None
+        assert cache.lookup(query, target, ".tsvx") is None
+        cache.deliver(cached, destination, link=False)
+        assert read_rows(destination) == expected_rows()
+
+        now[0] += 61
+        assert cache.lookup(query, target) is None
+        assert not os.path.exists(cached)
+
+        # Three entries, of which the first was used most recently
+        paths = []
+        for i in range(3):
+            query = "select * from items where id < " + str(i * 300 + 3)
+            paths.append(cache.export(query, target, export(query)))
+            os.utime(paths[-1], (now[0] + i, now[0] + i))
+        os.utime(paths[0], (now[0] + 10, now[0] + 10))
+        cache.max_bytes = sum(os.path.getsize(p) for p in paths) - 1
+        assert cache.evict() == [paths[1]]
+        assert len(queries) == 4
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_retries():
+    '''
+    A flaky connection fails once per partition; the retry picks up on
+    a fresh connection, and we still get every row in order.
+    '''
+    directory = tempfile.mkdtemp()
+    try:
+        connect = make_database(directory)
+        failures = []
+
+        class FlakyConnection:
+            def __init__(self):
+                self.connection = connect()
+
+            def cursor(self):
+                if len(failures) < 3:
+                    failures.append(1)
+                    raise sqlite3.OperationalError("Lost connection")
+                return self.connection.cursor()
+
+            def close(self):
+                self.connection.close()
+
+        pool = export_pool.ConnectionPool(FlakyConnection, 2)
+        filename = os.path.join(directory, "items.tsvx")
+        writer = make_writer(filename)
+        queries = helpers.range_queries(
+            writer, "items", [0, 1000, 2000, ROWS * 3])
+        export_pool.export_partitions(
+            pool, writer, queries, workers=2, backoff=0.01)
+        writer.close()
+        assert len(failures) == 3
+        assert read_rows(filename) == expected_rows()
+    finally:
+        shutil.rmtree(directory)
+
+
+def parse_copy(data):
+    '''
+    Read COPY data (as `vertica_load` writes it) back into rows of
+    strings and `None`s
+    '''
+    rows = []
+    row = []
+    (raw, field) = ("", "")
+    characters = iter(data.decode("utf-8"))
+    for character in characters:
+        if character == "\\":
+            escaped = next(characters)
+            raw += character + escaped
+            field += escaped
+        elif character in "\t\n":
+            row.append(None if raw == vertica_load.NULL else field)
+            (raw, field) = ("", "")
+            if character == "\n":
+                rows.append(row)
+                row = []
+        else:
+            raw += character
+            field += character
+    return rows
+
+
+def test_bulk_load():
+    '''
+    Load an uncompressed file in byte ranges and two gzipped shards
+    in parallel, through a sink which parses the COPY data back.
+    '''
+    directory = tempfile.mkdtemp()
+    try:
+        names = ["plain", "tab\there", "line\nbreak", "back\\slash",
+                 "caf\u00e9", "null", None, ""]
+        rows = [[i if i % 7 else None, names[i % len(names)], str(i)]
+                for i in range(300)]
+        paths = []
+        for (name, part) in [("all.tsvx", rows[:200]),
+                             ("a.tsvx.gz", rows[200:250]),
+                             ("b.tsvx.gz", rows[250:])]:
+            path = os.path.join(directory, name)
+            writer = helpers.open_tsvx_writer(path)
+            writer.headers = ["id", "name", "note"]
+            writer.types = [int, str, str]
+            writer.write_headers()
+            for row in part:
+                writer.write(*row)
+            if name == "all.tsvx":
+                writer.write_chunk("1\ttoo short\n")
+            writer.close()
+            paths.append(path)
+
+        loaded = []
+        lock = threading.Lock()
+
+        def sink(stream):
+            copied = parse_copy(stream.read())
+            with lock:
+                loaded.extend(copied)
+            return (len(copied), 0)
+
+        reports = []
+        counts = vertica_load.load(paths, sink, streams=3, chunk_size=512,
+                                   report=reports.append)
+        assert counts == (300, 1)
+        assert len(reports) > 3
+        expected = [[None if i is None else str(i), name, note]
+                    for (i, name, note) in rows]
+        assert sorted(loaded, key=lambda row: int(row[2])) == expected
+    finally:
+        shutil.rmtree(directory)
+
+
+class FakeCollection:
+    '''
+    The parts of a pymongo collection the Mongo export uses
+    '''
+    def __init__(self, documents):
+        self.documents = documents
+        self.calls = []
+
+    def estimated_document_count(self):
+        return len(self.documents)
+
+    def aggregate(self, pipeline):
+        size = pipeline[0]["$sample"]["size"]
+        self.calls.append(("sample", size))
+        return iter(random.sample(self.documents,
+                                  min(size, len(self.documents))))
+
+    def find(self, query, projection=None, skip=0, limit=0, batch_size=None):
+        self.calls.append(("find", skip, limit))
+        documents = self.documents[skip:]
+        if limit:
+            documents = documents[:limit]
+        if projection:
+            documents = [dict((key, value) for key, value in document.items()
+                              if projection.get(key))
+                         for document in documents]
+        return iter(documents)
+
+
+def test_mongo_export():
+    '''
+    Probe a schema from samples in parallel, then export with it
+    '''
+    when = datetime.datetime(2014, 5, 6, 10, 0, 0)
+    documents = [{"_id": i, "user": {"name": "user" + str(i), "age": i % 90},
+                  "score": i / 2.0 if i % 2 else i, "when": when,
+                  "tags": ["a", "b"], "extra": {"k" + str(i): 1}}
+                 for i in range(1000)]
+    documents[500]["user"]["age"] = "unknown"
+    collection = FakeCollection(documents)
+
+    schema = mongo_export.probe_schema(collection, sample_size=100,
+                                       workers=4, omits=["extra"])
+    assert [call[0] for call in collection.calls] == ["sample"] * 4
+    # The one odd age may or may not be in the sample
+    assert schema.pop("user.age") in ({"int"}, {"int", "str"})
+    assert schema == {"_id": {"int"}, "user.name": {"str"},
+                      "score": {"int", "float"}, "when": {"datetime"},
+                      "tags": {"list"}, "extra": {"dict"}}
+
+    # A sample as big as the collection reads all of it, in ranges
+    collection.calls = []
+    full = mongo_export.probe_schema(collection, sample_size=None, workers=4)
+    assert sorted(call[1] for call in collection.calls) == [0, 251, 502, 753]
+    assert full["user.age"] == {"int", "str"}
+    assert full["extra.k7"] == {"int", "NoneType"}
+    assert len(full) == 1006
+
+    del schema["extra"]
+    schema["user.age"] = {"int"}
+    directory = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(directory, "users.tsvx")
+        writer = helpers.open_tsvx_writer(filename)
+        try:
+            mongo_export.export_collection(
+                collection, writer, schema, batch_size=64)
+            assert False, "Expected a mismatch"
+        except mongo_export.SchemaMismatchException as error:
+            # The document with the odd age doesn't fit
+            assert dict(error.plan.mismatches) == {"user.age": 1}
+        writer.close()
+
+        # Widened to a string, it does
+        writer = helpers.open_tsvx_writer(filename)
+        (plan, rows) = mongo_export.export_collection(
+            collection, writer,
+            mongo_export.widen_schema(schema, ["user.age"]), batch_size=64)
+        writer.close()
+        assert rows == 1000
+        assert plan.columns == ["_id", "score", "tags", "user.age",
+                                "user.name", "when"]
+        exported = read_rows(filename)
+        assert exported[3] == [3, 1.5, '["a", "b"]', "3", "user3", when]
+        assert exported[500][3] == "unknown"
+        assert [row[0] for row in exported] == list(range(1000))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    for name, test in sorted(globals().items()):
+        if name.startswith("test_"):
+            test()
+            print(name, "ok")
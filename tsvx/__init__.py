@@ -5,4 +5,31 @@ TSV files with regards to headers, metadata, and escaping, while
 maintaining their human-readability and ease of processing.
 '''
 
-from .tsvx import reader, writer
+from .tsvx import reader, writer, read_header
+
+
+# Heavier operations are imported when first used, to keep `import tsvx`
+# fast.
+_LAZY = {
+    "sort": "sorting",
+    "join": "joins",
+    "aggregate": "aggregation",
+    "profile": "profiling",
+    "diff": "snapshots",
+    "distinct": "deduplication",
+    "partitioned_writer": "partitioning",
+    "partition": "partitioning",
+    "partition_rows": "partitioning",
+    "lookup": "sidecars",
+    "dataset": "multifile",
+}
+
+
+def __getattr__(name):
+    if name in _LAZY:
+        import importlib
+        module = importlib.import_module("." + _LAZY[name], __name__)
+        return getattr(module, name)
+    raise AttributeError(
+        "module {module!r} has no attribute {name!r}".format(
+            module=__name__, name=name))
@@ -0,0 +1,378 @@
+'''
+Group-by aggregation over TSVx files, in bounded memory.
+
+    reader = tsvx.reader(tsvx.helpers.open_text("enrollments.tsvx.gz"))
+    writer = tsvx.writer(tsvx.helpers.open_text("by_course.tsvx", "w"))
+    tsvx.aggregate(reader, ["course_id"], {
+        "students": ("distinct-count", "user_id"),
+        "rows": "count",
+        "mean_grade": ("mean", "grade")}, writer)
+
+Aggregates are `count` (rows, or with a variable, values present),
+`sum`, `min`, `max`, `mean`, and `distinct-count`. Missing values
+(which don't parse as their column's type) are skipped.
+
+We read rows in batches, and decode only the columns we need, a column
+at a time. Within a batch, rows are grouped by key first, so each
+aggregate is updated once per group with a list of values.
+
+If the input is sorted on the group-by variables (as recorded by
+`tsvx.sort`), groups are contiguous, and we hold one at a time.
+Otherwise, we keep a hash table of groups. If it grows past
+`memory_limit` bytes, partial aggregates are spilled to disk,
+partitioned by hash of the key, and each partition is merged at the
+end. Output from the sorted path, and from hash tables which fit in
+memory, is sorted by key.
+'''
+
+import itertools
+import os
+import os.path
+import pickle
+import shutil
+import tempfile
+
+from . import exceptions
+from . import joins
+from . import parser
+from . import sorting
+
+MEMORY_LIMIT = 256 * 1024 * 1024
+
+# Number of partitions we spill to
+PARTITIONS = 64
+
+BATCH_ROWS = 10000
+
+# Rough memory used by each distinct value we hold
+VALUE_OVERHEAD = 64
+
+
+def _update_min(state, values):
+    if not values:
+        return state
+    value = min(values)
+    return value if state is None or value < state else state
+
+
+def _update_max(state, values):
+    if not values:
+        return state
+    value = max(values)
+    return value if state is None or value > state else state
+
+
+def _update_mean(state, values):
+    state[0] += sum(values)
+    state[1] += len(values)
+    return state
+
+
+def _update_distinct(state, values):
+    state.update(values)
+    return state
+
+
+# For each aggregate: a new state, the state updated with a list of
+# values, two states merged, and the result from a state.
+AGGREGATES = {
+    "count": (lambda: 0,
+              lambda state, values: state + len(values),
+              lambda a, b: a + b,
+              lambda state: state),
+    "sum": (lambda: 0,
+            lambda state, values: state + sum(values),
+            lambda a, b: a + b,
+            lambda state: state),
+    "min": (lambda: None,
+            _update_min,
+            lambda a, b: a if b is None else _update_min(a, [b]),
+            lambda state: state),
+    "max": (lambda: None,
+            _update_max,
+            lambda a, b: a if b is None else _update_max(a, [b]),
+            lambda state: state),
+    "mean": (lambda: [0, 0],
+             _update_mean,
+             lambda a, b: [a[0] + b[0], a[1] + b[1]],
+             lambda state: state[0] / state[1] if state[1] else None),
+    "distinct-count": (set,
+                       _update_distinct,
+                       lambda a, b: a | b,
+                       len),
+}
+
+
+def _output_type(function, column_type):
+    if function in ("count", "distinct-count"):
+        return "int"
+    if function == "mean":
+        return "float"
+    if function == "sum" and column_type != "int":
+        return "float"
+    return column_type
+
+
+def _order(key):
+    '''
+    Sort order for keys which may hold `None`s
+    '''
+    return tuple((value is not None, value) for value in key)
+
+
+class _Aggregation:
+    '''
+    The group-by variables and aggregates, and a table of groups
+    '''
+    def __init__(self, reader, by, aggs):
+        types = reader.extra_headers['types']
+        self.by = [reader.variable_index(variable) for variable in by]
+        self.names = []
+        self.specs = []
+        self.types = [types[index] for index in self.by]
+        for (name, spec) in aggs.items():
+            if isinstance(spec, str):
+                spec = (spec, None)
+            (function, variable) = spec
+            if function not in AGGREGATES:
+                raise exceptions.TSVxException(
+                    "Unknown aggregate {function} for {name}".format(
+                        function=function, name=name))
+            if variable is None and function != "count":
+                raise exceptions.TSVxException(
+                    "{function} needs a variable".format(function=function))
+            index = None
+            if variable is not None:
+                index = reader.variable_index(variable)
+            self.names.append(name)
+            self.specs.append((AGGREGATES[function], index))
+            self.types.append(_output_type(
+                function, None if index is None else types[index]))
+        self.columns = sorted(
+            set(self.by) | set(index for (_, index) in self.specs
+                               if index is not None))
+        self.parsers = reader.parsers
+        self.table = {}
+        self.size = 0
+
+    def decode(self, lines):
+        '''
+        The keys of a batch of lines, and the decoded columns we need
+        '''
+        fields = [line.rstrip("\n").split("\t") for line in lines]
+        columns = {}
+        try:
+            for index in self.columns:
+                columns[index] = parser.parse_column(
+                    self.parsers[index], [row[index] for row in fields])
+        except IndexError:
+            raise exceptions.TSVxFileFormatException(
+                "Line with too few fields in {lines}".format(
+                    lines=repr(lines[:3])))
+        if self.by:
+            keys = list(zip(*[columns[index] for index in self.by]))
+        else:
+            keys = [()] * len(fields)
+        return (keys, columns)
+
+    def new(self):
+        return [functions[0]() for (functions, _) in self.specs]
+
+    def update(self, states, columns, rows):
+        '''
+        Add the rows numbered `rows` to a group's states. Returns how
+        many distinct values were added.
+        '''
+        added = 0
+        for (i, ((_, update, _, _), index)) in enumerate(self.specs):
+            if index is None:
+                values = rows
+            else:
+                column = columns[index]
+                values = [column[row] for row in rows
+                          if column[row] is not None]
+            if isinstance(states[i], set):
+                before = len(states[i])
+                states[i] = update(states[i], values)
+                added += len(states[i]) - before
+            else:
+                states[i] = update(states[i], values)
+        return added
+
+    def merge(self, states, other):
+        for (i, ((_, _, merge, _), _)) in enumerate(self.specs):
+            states[i] = merge(states[i], other[i])
+
+    def row(self, key, states):
+        return list(key) + [functions[3](state) for ((functions, _), state)
+                            in zip(self.specs, states)]
+
+    def add_batch(self, lines):
+        '''
+        Add a batch of lines to the hash table
+        '''
+        (keys, columns) = self.decode(lines)
+        groups = {}
+        for (row, key) in enumerate(keys):
+            groups.setdefault(key, []).append(row)
+        for (key, rows) in groups.items():
+            states = self.table.get(key)
+            if states is None:
+                states = self.table[key] = self.new()
+                self.size += sorting.ROW_OVERHEAD * (1 + len(self.specs))
+            self.size += VALUE_OVERHEAD * self.update(states, columns, rows)
+
+    def write_headers(self, reader, writer, by, ordered):
+        writer.headers = [reader.column_names[index] for index in self.by] \
+            + self.names
+        writer.variables = list(by) + self.names
+        writer.types = self.types
+        writer.add_metadata("aggregated-by", list(by))
+        if ordered:
+            writer.add_metadata("sorted-by", list(by))
+        writer.write_headers()
+
+
+def _batches(reader):
+    lines = (line for line in reader.generator if line.strip("\n"))
+    while True:
+        batch = list(itertools.islice(lines, BATCH_ROWS))
+        if not batch:
+            return
+        yield batch
+
+
+def _write_sorted(aggregation, writer, table):
+    rows = [aggregation.row(key, table[key])
+            for key in sorted(table, key=_order)]
+    for start in range(0, len(rows), BATCH_ROWS):
+        writer.write_rows(rows[start:start + BATCH_ROWS])
+    return len(rows)
+
+
+def _aggregate_sorted(aggregation, reader, writer):
+    '''
+    Aggregate input sorted on the group-by variables, a group at a time
+    '''
+    (current, states) = (None, None)
+    output = []
+    count = 0
+    for lines in _batches(reader):
+        (keys, columns) = aggregation.decode(lines)
+        start = 0
+        for (key, run) in itertools.groupby(keys):
+            length = len(list(run))
+            if states is None or key != current:
+                if states is not None:
+                    if _order(key) < _order(current):
+                        raise exceptions.TSVxException(
+                            "The input isn't sorted on the group-by "
+                            "variables, although its metadata says so")
+                    output.append(aggregation.row(current, states))
+                (current, states) = (key, aggregation.new())
+            aggregation.update(states, columns,
+                               list(range(start, start + length)))
+            start += length
+        writer.write_rows(output)
+        count += len(output)
+        output = []
+    if states is not None:
+        writer.write_rows([aggregation.row(current, states)])
+        count += 1
+    return count
+
+
+def _spill(aggregation, directory):
+    '''
+    Write the hash table to partition files, and empty it
+    '''
+    partitions = [[] for _ in range(PARTITIONS)]
+    for (key, states) in aggregation.table.items():
+        partitions[hash(key) % PARTITIONS].append((key, states))
+    for (number, items) in enumerate(partitions):
+        if items:
+            path = os.path.join(directory, "part-{0}".format(number))
+            with open(path, "ab") as fp:
+                pickle.dump(items, fp, pickle.HIGHEST_PROTOCOL)
+    aggregation.table = {}
+    aggregation.size = 0
+
+
+def _read_partition(path):
+    with open(path, "rb") as fp:
+        while True:
+            try:
+                yield pickle.load(fp)
+            except EOFError:
+                return
+
+
+def aggregate(reader, by, aggs, writer, memory_limit=MEMORY_LIMIT,
+              temporary_directory=None):
+    r'''
+    Group the rows of `reader` by the variables in `by`, and write a
+    row of aggregates per group to `writer`. `aggs` maps output names
+    to `(aggregate, variable)` pairs (or just "count"). Returns the
+    number of groups.
+
+    >>> import io, tsvx
+    >>> reader = tsvx.reader(io.StringIO(
+    ...     "k\tv\nstr\tint\t(types)\nk\tv\t(variables)\n---\n"
+    ...     "a\t1\nb\t5\na\t3\n"))
+    >>> output = io.StringIO()
+    >>> aggregate(reader, ["k"], {"n": "count", "total": ("sum", "v"),
+    ...                           "mean": ("mean", "v")},
+    ...           tsvx.writer(output))
+    2
+    >>> output.getvalue().split("-" * 10 + "\n")[-1]
+    'a\t2\t4\t2.0\nb\t1\t5\t5.0\n'
+
+    Missing keys make a group of their own, and aggregates over no
+    values are missing; both read back as `None`:
+
+    >>> reader = tsvx.reader(io.StringIO(
+    ...     "k\tv\nint\tint\t(types)\nk\tv\t(variables)\n---\n"
+    ...     "None\t1\n2\tNone\n2\tNone\n"))
+    >>> output = io.StringIO()
+    >>> aggregate(reader, ["k"], {"low": ("min", "v"), "mean": ("mean", "v")},
+    ...           tsvx.writer(output))
+    2
+    >>> [line.values() for line in tsvx.reader(io.StringIO(output.getvalue()))]
+    [[None, 1, 1.0], [2, None, None]]
+    '''
+    if isinstance(by, str):
+        by = [by]
+    aggregation = _Aggregation(reader, by, aggs)
+    if joins.sorted_on(reader, by):
+        aggregation.write_headers(reader, writer, by, ordered=True)
+        return _aggregate_sorted(aggregation, reader, writer)
+
+    directory = None
+    try:
+        for lines in _batches(reader):
+            aggregation.add_batch(lines)
+            if aggregation.size > memory_limit:
+                if directory is None:
+                    directory = tempfile.mkdtemp(
+                        prefix="tsvx-aggregate-", dir=temporary_directory)
+                _spill(aggregation, directory)
+        if directory is None:
+            aggregation.write_headers(reader, writer, by, ordered=True)
+            return _write_sorted(aggregation, writer, aggregation.table)
+
+        _spill(aggregation, directory)
+        aggregation.write_headers(reader, writer, by, ordered=False)
+        count = 0
+        for name in sorted(os.listdir(directory)):
+            table = {}
+            for items in _read_partition(os.path.join(directory, name)):
+                for (key, states) in items:
+                    if key in table:
+                        aggregation.merge(table[key], states)
+                    else:
+                        table[key] = states
+            count += _write_sorted(aggregation, writer, table)
+        return count
+    finally:
+        if directory is not None:
+            shutil.rmtree(directory, ignore_errors=True)
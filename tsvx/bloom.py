@@ -0,0 +1,266 @@
+'''
+Bloom filters: compact sets of strings which answer "maybe present"
+or "definitely absent".
+
+    seen = BloomFilter.for_capacity(1000000, error_rate=0.001)
+    seen.add("user-17")
+    "user-17" in seen   # True
+    "user-18" in seen   # False, except for about one in a thousand
+
+Filters serialize to bytes (and files), so they can be kept next to
+the data they describe, and loaded without reading it. A TSVx file's
+filter on a variable is kept in a sidecar, `<file>.<variable>.bloom`,
+which also records the variable's type, so we can encode values to
+look up without opening the file (see `tsvx.sidecars`). Looking up
+values in a sidecar reads only the bytes holding their bits.
+
+When we don't know how many values a filter will hold, a
+`GrowingBloomFilter` keeps their hashes, and builds a filter of the
+right size at the end.
+'''
+
+import array
+import hashlib
+import math
+import struct
+
+ERROR_RATE = 0.01
+
+# Values a growing filter keeps the hashes of, before it settles on a
+# filter of this size
+CAPACITY = 1000 * 1000
+
+MAGIC = b"TSVxBloom"
+_HEADER = struct.Struct(">9sQI")
+
+
+class BloomFilter:
+    '''
+    A Bloom filter of `bits` bits, setting `hashes` bits per value.
+
+    >>> bloom = BloomFilter.for_capacity(100, error_rate=0.01)
+    >>> bloom.update(str(i) for i in range(100))
+    >>> all(str(i) in bloom for i in range(100))
+    True
+    >>> sum(str(i) in bloom for i in range(100, 1100)) < 50
+    True
+    >>> BloomFilter.from_bytes(bloom.to_bytes()) == bloom
+    True
+    '''
+    def __init__(self, bits, hashes, data=None):
+        if bits < 1 or hashes < 1:
+            raise ValueError("A Bloom filter needs at least a bit and a hash")
+        self.bits = bits
+        self.hashes = hashes
+        self.data = bytearray(data) if data is not None else \
+            bytearray((bits + 7) // 8)
+
+    @classmethod
+    def for_capacity(cls, capacity, error_rate=ERROR_RATE):
+        '''
+        A filter sized to hold `capacity` values with about
+        `error_rate` false positives
+        '''
+        capacity = max(1, capacity)
+        bits = int(math.ceil(
+            -capacity * math.log(error_rate) / math.log(2) ** 2))
+        hashes = max(1, int(round(bits / capacity * math.log(2))))
+        return cls(bits, hashes)
+
+    def _positions(self, value):
+        return _positions(_hashes(value), self.bits, self.hashes)
+
+    def add(self, value):
+        self.add_hashes(_hashes(value))
+
+    def add_hashes(self, hashes):
+        '''
+        Add a value, given as the pair of hashes `_hashes` gives for it
+        '''
+        data = self.data
+        for position in _positions(hashes, self.bits, self.hashes):
+            data[position >> 3] |= 1 << (position & 7)
+
+    def update(self, values):
+        for value in values:
+            self.add(value)
+
+    def __contains__(self, value):
+        data = self.data
+        return all(data[position >> 3] & (1 << (position & 7))
+                   for position in self._positions(value))
+
+    def __eq__(self, other):
+        return isinstance(other, BloomFilter) and \
+            (self.bits, self.hashes, self.data) == \
+            (other.bits, other.hashes, other.data)
+
+    def __or__(self, other):
+        '''
+        A filter of the values in either, for filters of the same shape
+        '''
+        if (self.bits, self.hashes) != (other.bits, other.hashes):
+            raise ValueError("Only filters of the same size can be merged")
+        return BloomFilter(self.bits, self.hashes, bytes(
+            a | b for (a, b) in zip(self.data, other.data)))
+
+    def to_bytes(self):
+        return _HEADER.pack(MAGIC, self.bits, self.hashes) + bytes(self.data)
+
+    @classmethod
+    def from_bytes(cls, data):
+        (magic, bits, hashes) = _HEADER.unpack_from(data)
+        if magic != MAGIC or len(data) != _HEADER.size + (bits + 7) // 8:
+            raise ValueError("Not a Bloom filter")
+        return cls(bits, hashes, data[_HEADER.size:])
+
+    def save(self, path):
+        with open(path, "wb") as fp:
+            fp.write(self.to_bytes())
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "rb") as fp:
+            return cls.from_bytes(fp.read())
+
+
+def _hashes(value):
+    '''
+    Two 64-bit hashes of a string. By double hashing, they give all the
+    bit positions of the value in a filter.
+    '''
+    digest = hashlib.blake2b(value.encode("utf-8"), digest_size=16).digest()
+    return (int.from_bytes(digest[:8], "big"),
+            int.from_bytes(digest[8:], "big") | 1)
+
+
+def _positions(hashes, bits, count):
+    (first, second) = hashes
+    return [(first + i * second) % bits for i in range(count)]
+
+
+class GrowingBloomFilter:
+    '''
+    Collects values for a filter whose size we don't know up front.
+    We keep the hashes of the values (16 bytes each), and `build` a
+    filter sized for them with `error_rate` false positives. Past
+    `limit` values, we stop keeping hashes, and fill a filter sized for
+    `limit` values instead.
+
+    >>> growing = GrowingBloomFilter()
+    >>> growing.update(str(i) for i in range(10))
+    >>> bloom = growing.build()
+    >>> all(str(i) in bloom for i in range(10)), bloom.bits
+    (True, 96)
+    '''
+    def __init__(self, error_rate=ERROR_RATE, limit=CAPACITY):
+        self.error_rate = error_rate
+        self.limit = limit
+        self._hashes = array.array("Q")
+        self._filter = None
+
+    def add(self, value):
+        if self._filter is not None:
+            self._filter.add(value)
+            return
+        self._hashes.extend(_hashes(value))
+        if len(self._hashes) > 2 * self.limit:
+            self._filter = self._fill(self.limit)
+
+    def update(self, values):
+        for value in values:
+            self.add(value)
+
+    def _fill(self, capacity):
+        bloom_filter = BloomFilter.for_capacity(capacity, self.error_rate)
+        hashes = self._hashes
+        for index in range(0, len(hashes), 2):
+            bloom_filter.add_hashes((hashes[index], hashes[index + 1]))
+        self._hashes = None
+        return bloom_filter
+
+    def build(self):
+        '''
+        The filter of the values added so far. After this, values are
+        added to that filter.
+        '''
+        if self._filter is None:
+            self._filter = self._fill(len(self._hashes) // 2)
+        return self._filter
+
+
+def sidecar_path(path, variable):
+    '''
+    Where the filter on `variable` of the TSVx file at `path` is kept
+    '''
+    return "{path}.{variable}.bloom".format(path=path, variable=variable)
+
+
+def save_sidecar(path, column_type, bloom_filter):
+    '''
+    Save a filter of the encoded values of a column of type
+    `column_type` (such as "int" or "ISO8601-date")
+    '''
+    with open(path, "wb") as fp:
+        fp.write(column_type.encode("utf-8") + b"\n")
+        fp.write(bloom_filter.to_bytes())
+
+
+def load_sidecar(path):
+    '''
+    The column type and filter saved by `save_sidecar`
+    '''
+    with open(path, "rb") as fp:
+        data = fp.read()
+    (column_type, data) = data.split(b"\n", 1)
+    return (column_type.decode("utf-8"), BloomFilter.from_bytes(data))
+
+
+class SidecarFilter:
+    '''
+    A filter saved by `save_sidecar`, which reads only the bytes each
+    lookup needs, rather than the whole filter:
+
+        with SidecarFilter(path) as sidecar:
+            "17" in sidecar
+
+    >>> import os, tempfile
+    >>> bloom = BloomFilter.for_capacity(100)
+    >>> bloom.update(str(i) for i in range(100))
+    >>> path = os.path.join(tempfile.mkdtemp(), "test.bloom")
+    >>> save_sidecar(path, "int", bloom)
+    >>> with SidecarFilter(path) as sidecar:
+    ...     (sidecar.column_type, all(str(i) in sidecar for i in range(100)))
+    ('int', True)
+    >>> import shutil; shutil.rmtree(os.path.dirname(path))
+    '''
+    def __init__(self, path):
+        self._fp = open(path, "rb")
+        try:
+            self.column_type = self._fp.readline()[:-1].decode("utf-8")
+            (magic, self.bits, self.hashes) = _HEADER.unpack(
+                self._fp.read(_HEADER.size))
+        except (ValueError, struct.error):
+            self._fp.close()
+            raise ValueError("Not a Bloom filter sidecar: " + path)
+        if magic != MAGIC:
+            self._fp.close()
+            raise ValueError("Not a Bloom filter sidecar: " + path)
+        self._start = self._fp.tell()
+
+    def __contains__(self, value):
+        for position in sorted(_positions(_hashes(value), self.bits,
+                                          self.hashes)):
+            self._fp.seek(self._start + (position >> 3))
+            if not self._fp.read(1)[0] & (1 << (position & 7)):
+                return False
+        return True
+
+    def close(self):
+        self._fp.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
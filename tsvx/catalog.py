@@ -0,0 +1,221 @@
+'''
+A catalog of the TSVx files in a directory, such as the output of
+`full_vertica_dump.py`.
+
+Opening every file of a big dump to find a table is slow. We read just
+the headers of each file, and cache them in the directory (in
+`.tsvx-catalog.json`), keyed by path, size, and modification time. On
+later scans, only new or changed files are read.
+
+    catalog = tsvx.catalog.Catalog("dump/")
+    for header in catalog.find(variable="user_id"):
+        print(header.path, header.title)
+
+To list a directory from the shell, run `python -m tsvx.catalog`.
+
+Usage:
+  catalog.py <directory> [--no-cache]
+'''
+
+import fnmatch
+import json
+import os
+import os.path
+
+from . import exceptions
+from . import helpers
+from . import tsvx
+
+CACHE_FILE = ".tsvx-catalog.json"
+EXTENSIONS = (".tsvx", ".tsvx.gz")
+CACHE_VERSION = 1
+
+
+class Catalog:
+    r'''
+    Headers of all TSVx files in a directory (and, optionally, its
+    subdirectories). Iterating gives `TSVxHeader` objects, sorted by
+    path, with extra `path`, `size`, and `mtime` attributes.
+
+    Files whose headers can't be read (for instance, a dump which failed
+    part-way) are listed in `errors`, rather than raising.
+
+    >>> import gzip, shutil, tempfile
+    >>> directory = tempfile.mkdtemp()
+    >>> header = "title: Test\n---\na\nint\t(types)\na\t(variables)\n---\n"
+    >>> for (name, text) in [("good", header), ("truncated", header[:30]),
+    ...                      ("bad", header.replace("Test", "[unclosed"))]:
+    ...     with open(os.path.join(directory, name + ".tsvx"), "w") as fp:
+    ...         _ = fp.write(text)
+    ...     with gzip.open(os.path.join(directory, name + ".tsvx.gz"),
+    ...                    "wt") as fp:
+    ...         _ = fp.write(text)
+    >>> with open(os.path.join(directory, "good.tsvx.gz"), "rb") as fp:
+    ...     data = fp.read()
+    >>> with open(os.path.join(directory, "cut.tsvx.gz"), "wb") as fp:
+    ...     _ = fp.write(data[:len(data) // 2])
+    >>> catalog = Catalog(directory, cache=False)
+    >>> sorted(os.path.basename(header.path) for header in catalog)
+    ['good.tsvx', 'good.tsvx.gz']
+    >>> for path in sorted(catalog.errors):
+    ...     print(os.path.basename(path))
+    bad.tsvx
+    bad.tsvx.gz
+    cut.tsvx.gz
+    truncated.tsvx
+    truncated.tsvx.gz
+    >>> shutil.rmtree(directory)
+    '''
+    def __init__(self, directory, recursive=False, cache=True):
+        self.directory = directory
+        self.recursive = recursive
+        self.cache_path = None
+        if cache:
+            self.cache_path = os.path.join(directory, CACHE_FILE)
+        self._entries = {}
+        self.errors = {}
+        self.refresh()
+
+    def _files(self):
+        '''
+        Paths of all TSVx files in the directory
+        '''
+        if self.recursive:
+            for root, directories, files in os.walk(self.directory):
+                for filename in files:
+                    if filename.endswith(EXTENSIONS):
+                        yield os.path.join(root, filename)
+        else:
+            for filename in os.listdir(self.directory):
+                if filename.endswith(EXTENSIONS):
+                    yield os.path.join(self.directory, filename)
+
+    def _load_cache(self):
+        '''
+        Cached entries, as a dictionary from path to entry. Entries
+        hold the raw header lines, which are quick to re-parse.
+        '''
+        if not self.cache_path or not os.path.exists(self.cache_path):
+            return {}
+        try:
+            with open(self.cache_path) as fp:
+                cache = json.load(fp)
+        except (OSError, ValueError):
+            return {}
+        if cache.get("version") != CACHE_VERSION:
+            return {}
+        return cache["files"]
+
+    def _save_cache(self, files):
+        '''
+        Write the cache. Failure (e.g. a read-only directory) just means
+        we don't have a cache next time.
+        '''
+        if not self.cache_path:
+            return
+        temporary = self.cache_path + ".tmp"
+        try:
+            with open(temporary, "w") as fp:
+                json.dump({"version": CACHE_VERSION, "files": files}, fp)
+            os.replace(temporary, self.cache_path)
+        except OSError:
+            pass
+
+    def refresh(self):
+        '''
+        Rescan the directory. Only files which are new, or whose size or
+        modification time changed, are read.
+        '''
+        cached = self._load_cache()
+        files = {}
+        for path in self._files():
+            stat = os.stat(path)
+            entry = cached.get(path)
+            if entry is None or entry["size"] != stat.st_size or \
+               entry["mtime"] != stat.st_mtime:
+                entry = {"size": stat.st_size, "mtime": stat.st_mtime}
+                try:
+                    with helpers.open_text(path) as stream:
+                        entry["lines"] = tsvx.read_header_lines(stream)
+                except (OSError, UnicodeDecodeError, EOFError) as error:
+                    entry["error"] = str(error)
+            files[path] = entry
+
+        self._entries = {}
+        self.errors = {}
+        for path, entry in files.items():
+            if "error" not in entry:
+                try:
+                    header = tsvx.parse_header_lines(entry["lines"])
+                except (exceptions.TSVxException, ValueError,
+                        IndexError) as error:
+                    entry["error"] = str(error)
+            if "error" in entry:
+                self.errors[path] = entry["error"]
+                continue
+            header.path = path
+            header.size = entry["size"]
+            header.mtime = entry["mtime"]
+            self._entries[path] = header
+
+        if files != cached:
+            self._save_cache(files)
+
+    def __iter__(self):
+        for path in sorted(self._entries):
+            yield self._entries[path]
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __getitem__(self, path):
+        return self._entries[path]
+
+    def find(self, pattern=None, variable=None):
+        '''
+        Headers of files whose name (without directory) matches a glob
+        `pattern`, such as `"myschema.*"`, and/or which have a column
+        with the given `variable` name.
+        '''
+        for header in self:
+            if pattern and not fnmatch.fnmatch(
+                    os.path.basename(header.path), pattern):
+                continue
+            if variable and \
+               variable not in header.extra_headers.get('variables', []):
+                continue
+            yield header
+
+    def schemas(self):
+        '''
+        A dictionary mapping each path to a list of (variable, type)
+        pairs.
+        '''
+        return dict(
+            (header.path, list(zip(header.extra_headers.get('variables', []),
+                                   header.extra_headers.get('types', []))))
+            for header in self)
+
+
+def main():
+    '''
+    List the files in a directory with their titles and columns
+    '''
+    import docopt
+
+    arguments = docopt.docopt(__doc__)
+    catalog = Catalog(arguments["<directory>"],
+                      cache=not arguments["--no-cache"])
+    schemas = catalog.schemas()
+    for header in catalog:
+        print(header.path)
+        print("    " + str(header.metadata.get("title", "")))
+        for variable, column_type in schemas[header.path]:
+            print("    {0:30} {1}".format(variable, column_type))
+    for path, error in sorted(catalog.errors.items()):
+        print(path)
+        print("    Unreadable: " + error)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,335 @@
+'''
+Conversion of CSV and TSV files to TSVx.
+
+We parse the input with the `csv` module (so quoted CSV fields work),
+guess column types from a sample of rows, and run every field through
+the TSVx encoders, so the output is something the reader accepts.
+
+Large, uncompressed inputs are split into byte ranges at line
+boundaries. The ranges are converted in parallel processes, and
+stitched back together in order. In that mode, quoted fields may not
+span lines; we raise an exception if one does.
+'''
+
+import concurrent.futures
+import csv
+import io
+import itertools
+import os
+import re
+import sys
+
+from . import exceptions
+from . import helpers
+from . import parser
+from . import tsvx
+
+
+USAGE = '''Convert a CSV or TSV file to TSVx format.
+
+Usage:
+  tsv2tsvx [<input>] [<output>] [--delimiter=<delimiter>]
+           [--title=<title>] [--description=<description>]
+           [--types=<types>] [--jobs=<jobs>] [--sample=<rows>]
+  tsv2tsvx -h | --help
+
+Options:
+  -h --help                    Show this screen.
+  --delimiter=<delimiter>      Input delimiter. Guessed from the header
+                               if omitted.
+  --title=<title>              Add a title to the file
+  --description=<description>  Add a description to the file
+  --types=<types>              A comma-separated list of column types.
+                               Guessed from the data if omitted.
+  --jobs=<jobs>                Number of parallel processes
+  --sample=<rows>              Rows used to guess types [default: 1000]
+'''
+
+DELIMITERS = ['\t', ',', ';', '|']
+
+# Size of the byte ranges we hand to worker processes, and the number
+# of rows we convert at a time when streaming.
+CHUNK_SIZE = 8 * 1024 * 1024
+BATCH_ROWS = 10000
+
+# Types we'll guess from the data, with parsers and compiled patterns.
+# We skip `null`, and the slow dateutil heuristics; such columns become
+# strings.
+_GUESSES = [
+    (python_type, parse, [re.compile(regexp) for regexp in regexps])
+    for python_type, json_type, parse, encode, regexps in parser.TYPE_MAP
+    if python_type not in ("str", "NoneType", "unformatted-datetime") and
+    regexps
+]
+_JSON_TYPES = dict((row[0], row[1]) for row in parser.TYPE_MAP)
+
+
+def guess_delimiter(header):
+    r'''
+    Guess the delimiter from the header line.
+
+    >>> guess_delimiter("a,b,c\n")
+    ','
+    >>> guess_delimiter("a\tb,c\n")
+    '\t'
+    '''
+    for delimiter in DELIMITERS:
+        if delimiter in header:
+            return delimiter
+    raise exceptions.TSVxFileFormatException(
+        "Headers did not contain tab, comma, semicolon, or pipe. "
+        "Could not guess delimiter. Please specify the delimiter."
+    )
+
+
+def _dialect(delimiter):
+    '''
+    `csv` arguments for a delimiter. Legacy TSV files don't quote
+    fields, so there, a quote is just a quote.
+    '''
+    if delimiter == '\t':
+        return {'delimiter': delimiter, 'quoting': csv.QUOTE_NONE}
+    return {'delimiter': delimiter, 'strict': True}
+
+
+def _guess_value(value):
+    '''
+    Guess the type of a single field, confirming with the TSVx parser
+    that the reader will accept it.
+    '''
+    for python_type, parse, patterns in _GUESSES:
+        for pattern in patterns:
+            if pattern.match(value):
+                try:
+                    parse(value)
+                except (ValueError, exceptions.TSVxFileFormatException):
+                    break
+                return python_type
+    return "str"
+
+
+def _widen(current, new):
+    '''
+    Combine the type guessed so far for a column with the type of a
+    new value. `None` means we haven't seen a value yet.
+
+    >>> _widen(None, 'int')
+    'int'
+    >>> _widen('int', 'float')
+    'float'
+    >>> _widen('ISO8601-date', 'int')
+    'str'
+    '''
+    if current is None or current == new:
+        return new
+    if set([current, new]) == set(["int", "float"]):
+        return "float"
+    return "str"
+
+
+def guess_types(rows, width):
+    '''
+    Guess column types from an iterable of rows (lists of strings).
+    If values in a column disagree, we widen ints to floats, and
+    anything else to strings.
+
+    >>> guess_types([["1", "x", "2.5"], ["2", "3", "7"]], 3)
+    ['int', 'str', 'float']
+    >>> guess_types([["2014-05-06", "true"]], 2)
+    ['ISO8601-date', 'bool']
+    '''
+    types = [None] * width
+    for row in rows:
+        for i, value in enumerate(row[:width]):
+            if types[i] != "str":
+                types[i] = _widen(types[i], _guess_value(value))
+    return [python_type or "str" for python_type in types]
+
+
+def _encoder(python_type):
+    '''
+    Function mapping a field of the input to a TSVx field of the
+    given type. Strings get escaped. Other types are checked with the
+    TSVx parser, and passed through.
+    '''
+    if python_type == "str":
+        return parser._encodestr
+    parse = parser.parser_for(python_type)
+
+    def encode(value):
+        parse(value)
+        return value
+    return encode
+
+
+def _convert_rows(rows, types):
+    '''
+    Convert parsed rows into a block of TSVx lines. Returns the block
+    and the number of rows in it.
+    '''
+    encoders = [_encoder(python_type) for python_type in types]
+    width = len(encoders)
+    lines = []
+    for row in rows:
+        if not row:
+            continue
+        if len(row) != width:
+            raise exceptions.TSVxFileFormatException(
+                "Expected {width} fields, got {count}: {row}".format(
+                    width=width, count=len(row), row=repr(row)))
+        try:
+            lines.append("\t".join([
+                encode(item) for encode, item in zip(encoders, row)
+            ]))
+        except (ValueError, exceptions.TSVxFileFormatException) as error:
+            raise exceptions.TSVxFileFormatException(
+                "Could not convert {row} to types {types}: {error}. "
+                "Consider specifying types explicitly.".format(
+                    row=repr(row), types=types, error=error))
+    if not lines:
+        return ("", 0)
+    return ("\n".join(lines) + "\n", len(lines))
+
+
+def _convert_range(task):
+    '''
+    Worker for parallel conversion. Convert one byte range of the input
+    file. Runs in a separate process, so it takes a single tuple.
+    '''
+    (path, start, end, delimiter, types, encoding) = task
+    with open(path, "rb") as fp:
+        fp.seek(start)
+        text = fp.read(end - start).decode(encoding)
+    rows = csv.reader(io.StringIO(text, newline=''), **_dialect(delimiter))
+    try:
+        return _convert_rows(rows, types)
+    except csv.Error as error:
+        raise exceptions.TSVxFileFormatException(
+            "Could not parse bytes {start}-{end}: {error}. If quoted fields "
+            "contain newlines, convert with jobs=1.".format(
+                start=start, end=end, error=error))
+
+
+def convert(source, destination, delimiter=None, types=None,
+            title=None, description=None, jobs=None,
+            sample_rows=1000, chunk_size=CHUNK_SIZE, encoding="utf-8"):
+    '''
+    Convert a CSV/TSV file to TSVx. `source` and `destination` may be
+    filenames (optionally ending in `.gz`), or text streams. The first
+    line of the input holds the column names. Types are guessed from
+    the first `sample_rows` rows, unless passed as a list of type names.
+
+    Uncompressed input files larger than `chunk_size` are converted in
+    `jobs` parallel processes (by default, one per CPU). Returns the
+    number of rows written.
+    '''
+    if isinstance(source, str):
+        input_stream = helpers.open_text(
+            source, "r", encoding=encoding, newline='')
+    else:
+        input_stream = source
+    if isinstance(destination, str):
+        output_stream = helpers.open_text(
+            destination, "w", encoding=encoding, newline='')
+    else:
+        output_stream = destination
+
+    header = input_stream.readline()
+    if not delimiter:
+        delimiter = guess_delimiter(header)
+    dialect = _dialect(delimiter)
+    column_names = next(csv.reader([header], **dialect))
+    rows = csv.reader(input_stream, **dialect)
+    if not types:
+        sample = list(itertools.islice(rows, sample_rows))
+        rows = itertools.chain(sample, rows)
+        types = guess_types(sample, len(column_names))
+    types = [helpers.to_python_type(python_type) for python_type in types]
+    types = [getattr(t, "__name__", t) for t in types]
+
+    writer = tsvx.writer(output_stream)
+    if title:
+        writer.title = title
+    if description:
+        writer.description = description
+    writer.headers = [name.replace('\t', ' ') for name in column_names]
+    writer.types = types
+    writer.line_header("json", [_JSON_TYPES[t] for t in types])
+    writer.write_headers()
+
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+    parallel = (isinstance(source, str) and not source.endswith(".gz") and
+                jobs > 1 and os.path.getsize(source) > chunk_size)
+
+    row_count = 0
+    if parallel:
+        input_stream.close()
+        with open(source, "rb") as fp:
+            fp.readline()
+            offsets = helpers.line_offsets(
+                fp, fp.tell(), os.path.getsize(source), chunk_size)
+        tasks = [(source, start, end, delimiter, types, encoding)
+                 for start, end in zip(offsets[:-1], offsets[1:])]
+        with concurrent.futures.ProcessPoolExecutor(jobs) as executor:
+            for (block, count) in helpers.bounded_map(
+                    executor, _convert_range, tasks, 2 * jobs):
+                writer.write_chunk(block)
+                row_count += count
+    else:
+        while True:
+            batch = list(itertools.islice(rows, BATCH_ROWS))
+            if not batch:
+                break
+            (block, count) = _convert_rows(batch, types)
+            writer.write_chunk(block)
+            row_count += count
+        if isinstance(source, str):
+            input_stream.close()
+
+    if isinstance(destination, str):
+        writer.close()
+    else:
+        output_stream.flush()
+    return row_count
+
+
+def main(argv=None):
+    '''
+    Command-line entry point (`tsv2tsvx`).
+    '''
+    import docopt
+
+    arguments = docopt.docopt(USAGE, argv)
+    inputfile = arguments["<input>"]
+    outputfile = arguments["<output>"]
+
+    if outputfile and os.path.exists(outputfile):
+        print("Error: Output file already exists. Please erase it first.")
+        sys.exit(-1)
+    if inputfile and not os.path.exists(inputfile):
+        print("Error: Input file doesn't exist.")
+        sys.exit(-1)
+
+    types = None
+    if arguments["--types"]:
+        types = arguments["--types"].split(",")
+    jobs = None
+    if arguments["--jobs"]:
+        jobs = int(arguments["--jobs"])
+    delimiter = arguments["--delimiter"]
+    if delimiter == "\\t":
+        delimiter = "\t"
+
+    convert(inputfile or sys.stdin,
+            outputfile or sys.stdout,
+            delimiter=delimiter,
+            types=types,
+            title=arguments["--title"],
+            description=arguments["--description"],
+            jobs=jobs,
+            sample_rows=int(arguments["--sample"]))
+
+
+if __name__ == "__main__":
+    main()
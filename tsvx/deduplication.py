@@ -0,0 +1,231 @@
+'''
+Removing duplicate rows from TSVx files, in bounded memory.
+
+    reader = tsvx.reader(tsvx.helpers.open_text("users.tsvx.gz"))
+    writer = tsvx.writer(tsvx.helpers.open_text("unique.tsvx.gz", "w"))
+    tsvx.distinct(reader, writer, on=["user_id"])
+
+Rows are duplicates if they're identical, or, with `on`, if they have
+the same values of those variables (compared as their declared types).
+We keep the first of each.
+
+If the input is sorted on the key (as recorded by `tsvx.sort`),
+duplicates are next to each other, and we hold one group at a time.
+Otherwise, we keep a hash set of the keys we've seen. If it grows past
+`memory_limit` bytes, the set, and the rest of the input, are split
+by hash of the key into partitions on disk, and each partition
+deduplicated in turn. Until then, rows keep their order; after, they
+come out a partition at a time.
+
+With `approximate=True`, the set is a Bloom filter sized for
+`capacity` keys instead. This takes one pass, in fixed memory, and
+keeps the order of the input, but drops about `error_rate` of the
+unique rows as false positives.
+'''
+
+import itertools
+import os
+import os.path
+import pickle
+import shutil
+import tempfile
+
+from . import bloom
+from . import sorting
+
+MEMORY_LIMIT = 256 * 1024 * 1024
+
+# Number of partitions we spill to
+PARTITIONS = 64
+
+BATCH_ROWS = 10000
+
+# Keys a Bloom filter is sized for, by default
+CAPACITY = 10 * 1000 * 1000
+
+
+def _lines(lines):
+    for line in lines:
+        line = line.rstrip("\n")
+        if line:
+            yield line
+
+
+class _Output:
+    '''
+    Writes lines in batches, and counts them
+    '''
+    def __init__(self, writer):
+        self.writer = writer
+        self.batch = []
+        self.rows = 0
+
+    def write(self, line):
+        self.batch.append(line)
+        if len(self.batch) >= BATCH_ROWS:
+            self.flush()
+
+    def flush(self):
+        if self.batch:
+            self.writer.write_chunk("\n".join(self.batch) + "\n")
+            self.rows += len(self.batch)
+            self.batch = []
+
+
+def _sorted_by(reader, on):
+    '''
+    The variables the input is sorted on which bring duplicates
+    together, or None
+    '''
+    order = reader.metadata.get("sorted-by")
+    if not isinstance(order, list) or not order:
+        return None
+    if on is None:
+        return order
+    if order[:len(on)] == list(on):
+        return list(on)
+    return None
+
+
+def _write_headers(reader, writer, on, ordered):
+    writer.copy_headers(reader)
+    writer.add_metadata("distinct-on", list(on or reader.variables))
+    if not ordered:
+        writer.metadata.pop("sorted-by", None)
+        writer.metadata.pop("sorted-reverse", None)
+    writer.write_headers()
+
+
+def _distinct_sorted(lines, output, key, group_key):
+    '''
+    Deduplicate lines whose duplicates are adjacent, a group at a time
+    '''
+    for (_, group) in itertools.groupby(lines, key=group_key):
+        seen = set()
+        for line in group:
+            value = key(line)
+            if value not in seen:
+                seen.add(value)
+                output.write(line)
+
+
+def _distinct_approximate(lines, output, key, capacity, error_rate):
+    seen = bloom.BloomFilter.for_capacity(capacity, error_rate)
+    for line in lines:
+        value = repr(key(line))
+        if value not in seen:
+            seen.add(value)
+            output.write(line)
+
+
+def _distinct_hashed(lines, output, key, size_of, memory_limit,
+                     temporary_directory):
+    '''
+    Deduplicate with a hash set, partitioning to disk if it grows past
+    `memory_limit` bytes
+    '''
+    seen = set()
+    size = 0
+    for line in lines:
+        value = key(line)
+        if value in seen:
+            continue
+        seen.add(value)
+        output.write(line)
+        size += size_of(line)
+        if size > memory_limit:
+            break
+    else:
+        return
+
+    directory = tempfile.mkdtemp(prefix="tsvx-distinct-",
+                                 dir=temporary_directory)
+    try:
+        # The keys we've written, and the lines we haven't looked at,
+        # by partition
+        partitions = [[] for _ in range(PARTITIONS)]
+        for value in seen:
+            partitions[hash(value) % PARTITIONS].append(value)
+        seen = None
+        paths = [os.path.join(directory, "part-{0}".format(number))
+                 for number in range(PARTITIONS)]
+        for (path, values) in zip(paths, partitions):
+            with open(path + ".seen", "wb") as fp:
+                pickle.dump(values, fp, pickle.HIGHEST_PROTOCOL)
+        partitions = None
+        files = [open(path, "w", encoding="utf-8") for path in paths]
+        try:
+            for line in lines:
+                files[hash(key(line)) % PARTITIONS].write(line + "\n")
+        finally:
+            for fp in files:
+                fp.close()
+
+        for path in paths:
+            with open(path + ".seen", "rb") as fp:
+                seen = set(pickle.load(fp))
+            with open(path, encoding="utf-8") as fp:
+                for line in _lines(fp):
+                    value = key(line)
+                    if value not in seen:
+                        seen.add(value)
+                        output.write(line)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def distinct(reader, writer, on=None, memory_limit=MEMORY_LIMIT,
+             approximate=False, capacity=CAPACITY,
+             error_rate=bloom.ERROR_RATE, temporary_directory=None):
+    r'''
+    Copy the rows of `reader` to `writer`, without duplicates: rows
+    which are identical or, if given, have equal values of the
+    variables `on`. Returns the number of rows written. The writer's
+    headers are set up for us.
+
+    >>> import io, tsvx
+    >>> header = "a\tb\nint\tstr\t(types)\na\tb\t(variables)\n---\n"
+    >>> body = "1\tx\n2\ty\n1\tx\n01\tz\n"
+    >>> output = io.StringIO()
+    >>> distinct(tsvx.reader(io.StringIO(header + body)),
+    ...          tsvx.writer(output))
+    3
+    >>> output.getvalue().split("-" * 10 + "\n")[-1]
+    '1\tx\n2\ty\n01\tz\n'
+    >>> output = io.StringIO()
+    >>> distinct(tsvx.reader(io.StringIO(header + body)),
+    ...          tsvx.writer(output), on=["a"], memory_limit=1)
+    2
+    >>> output.getvalue().split("-" * 10 + "\n")[-1]
+    '1\tx\n2\ty\n'
+    '''
+    if isinstance(on, str):
+        on = [on]
+    if on is None:
+        def key(line):
+            return line
+
+        def size_of(line):
+            return sorting.ROW_OVERHEAD + len(line)
+    else:
+        key = sorting.key_function(reader, on)
+
+        def size_of(line):
+            return sorting.ROW_OVERHEAD * (2 + len(on))
+
+    lines = _lines(reader.generator)
+    output = _Output(writer)
+    order = _sorted_by(reader, on)
+    if approximate:
+        _write_headers(reader, writer, on, ordered=True)
+        _distinct_approximate(lines, output, key, capacity, error_rate)
+    elif order is not None:
+        _write_headers(reader, writer, on, ordered=True)
+        _distinct_sorted(lines, output, key,
+                         sorting.key_function(reader, order))
+    else:
+        _write_headers(reader, writer, on, ordered=False)
+        _distinct_hashed(lines, output, key, size_of, memory_limit,
+                         temporary_directory)
+    output.flush()
+    return output.rows
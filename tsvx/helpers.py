@@ -1,9 +1,13 @@
 '''
 Simple generic utility functions not specific to TSVx
 '''
+import collections
 import itertools
+import re
 
-import dateutil.parser
+# Characters read per block when prefetching, and blocks read ahead
+PREFETCH_CHUNK = 4 * 1024 * 1024
+PREFETCH_DEPTH = 4
 
 
 def valid_variable(string):
@@ -50,6 +54,129 @@ def peek(generator, item_count=-1):
     return (items, generator)
 
 
+def open_text(filename, mode="r", **kwargs):
+    '''
+    Open a file in text mode, decompressing on the fly if the name ends
+    in `.gz`. Keyword arguments are passed on to `open`.
+    '''
+    if filename.endswith(".gz"):
+        import gzip
+        return gzip.open(filename, mode + "t", **kwargs)
+    return open(filename, mode, **kwargs)
+
+
+def line_offsets(fp, start, end, chunk_size):
+    r'''
+    Split the byte range [start, end) of a seekable binary file into
+    chunks of roughly `chunk_size` bytes. Each chunk begins at the
+    start of a line. Returns the boundaries, including `start` and
+    `end`:
+
+    >>> import io
+    >>> import io
+    >>> line_offsets(io.BytesIO(b"aa\nbb\ncc\n"), 0, 9, 4)
+    [0, 6, 9]
+    >>> line_offsets(io.BytesIO(b"aa\nbb\ncc\n"), 3, 9, 100)
+    [3, 9]
+    '''
+    offsets = [start]
+    position = start
+    while position + chunk_size < end:
+        fp.seek(position + chunk_size - 1)
+        fp.readline()
+        position = fp.tell()
+        if position >= end:
+            break
+        offsets.append(position)
+    offsets.append(end)
+    return offsets
+
+
+def bounded_map(executor, function, iterable, window):
+    '''
+    Like `executor.map`, but with at most `window` calls in flight.
+    Results are yielded in order. This keeps memory bounded when the
+    results are large and the consumer is slower than the workers.
+
+    >>> import concurrent.futures
+    >>> with concurrent.futures.ThreadPoolExecutor(2) as executor:
+    ...     list(bounded_map(executor, abs, [-1, 2, -3], 2))
+    [1, 2, 3]
+    '''
+    pending = collections.deque()
+    for item in iterable:
+        if len(pending) >= window:
+            yield pending.popleft().result()
+        pending.append(executor.submit(function, item))
+    while pending:
+        yield pending.popleft().result()
+
+
+def prefetch_lines(stream, chunk_size=PREFETCH_CHUNK, depth=PREFETCH_DEPTH):
+    r'''
+    Iterate over the lines of a text stream, with a background thread
+    reading ahead, in blocks of `chunk_size` characters, up to `depth`
+    blocks. The thread does the I/O (and decompression, for gzipped
+    streams) and splits blocks into lines, so slow reads overlap with
+    whatever we do with the lines.
+
+    >>> import io
+    >>> list(prefetch_lines(io.StringIO("a\nb\r\nc"), chunk_size=3))
+    ['a\n', 'b\r\n', 'c']
+    '''
+    import io
+    import queue
+    import threading
+
+    blocks = queue.Queue(depth)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                blocks.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def read():
+        try:
+            rest = ""
+            while True:
+                block = stream.read(chunk_size)
+                if not block:
+                    break
+                end = block.rfind("\n") + 1
+                if end == 0:
+                    rest += block
+                    continue
+                # Only split on "\n", as reading the stream line by line
+                # would
+                lines = list(io.StringIO(rest + block[:end]))
+                rest = block[end:]
+                if not put(lines):
+                    return
+            if rest:
+                put([rest])
+            put(None)
+        except Exception as error:
+            put(error)
+
+    threading.Thread(target=read, daemon=True).start()
+    try:
+        while True:
+            lines = blocks.get()
+            if lines is None:
+                return
+            if isinstance(lines, Exception):
+                raise lines
+            for line in lines:
+                yield line
+    finally:
+        stop.set()
+
+
 def read_to_dash(generator):
     '''
     Read a file until a set of dashes is encountered
@@ -62,6 +189,89 @@ def read_to_dash(generator):
     return "\n".join(lines)
 
 
+# A line of YAML with a plain key, and a value we're certain is a
+# string or an int: single-quoted, or plain text without characters YAML
+# treats specially. Anything else goes through the full YAML parser.
+_SIMPLE_YAML_LINE = re.compile(
+    r"^([A-Za-z_][A-Za-z0-9_-]*): +(?:'((?:[^']|'')*)'|"
+    r"(-?(?:0|[1-9][0-9]*))|"
+    r"([A-Za-z_/][A-Za-z0-9_ ./()+-]*[A-Za-z0-9_./()+-]|[A-Za-z_/]))$")
+
+# Plain words YAML 1.1 reads as booleans or nulls
+_YAML_WORDS = set(["yes", "no", "true", "false", "on", "off", "null"])
+
+
+def _load_simple_yaml(text):
+    '''
+    Parse YAML consisting only of simple `key: value` lines. Return
+    `None` if it's anything more complex.
+
+    >>> _load_simple_yaml("title: Test file\\ncreated-date: '2016-10-29'")
+    {'title': 'Test file', 'created-date': '2016-10-29'}
+    >>> _load_simple_yaml("rows: 42\\nname: 'it''s'")
+    {'rows': 42, 'name': "it's"}
+    >>> _load_simple_yaml("flag: yes") is None
+    True
+    >>> _load_simple_yaml("version: 2.7") is None
+    True
+    '''
+    result = {}
+    for line in text.split("\n"):
+        if not line.strip():
+            continue
+        match = _SIMPLE_YAML_LINE.match(line)
+        if not match:
+            return None
+        (key, quoted, number, plain) = match.groups()
+        if key.lower() in _YAML_WORDS:
+            return None
+        if quoted is not None:
+            result[key] = quoted.replace("''", "'")
+        elif number is not None:
+            result[key] = int(number)
+        elif plain.lower() in _YAML_WORDS:
+            return None
+        else:
+            result[key] = plain
+    return result
+
+
+def load_yaml(text):
+    '''
+    Load a YAML dictionary. Simple `key: value` documents (which most
+    headers are) are parsed directly, without importing `yaml`, which
+    is slow to import. Otherwise, we use the safe loader, in its fast C
+    version if available. Malformed YAML raises `ValueError`.
+
+    >>> load_yaml("title: Test")
+    {'title': 'Test'}
+    >>> load_yaml("authors: [a, b]")
+    {'authors': ['a', 'b']}
+    '''
+    simple = _load_simple_yaml(text)
+    if simple is not None:
+        return simple
+    import yaml
+    loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+    try:
+        return yaml.load(text, Loader=loader)
+    except yaml.YAMLError as error:
+        raise ValueError("Malformed YAML: " + str(error))
+
+
+def dump_yaml(data):
+    '''
+    Dump a YAML dictionary in block style, with the C dumper if it's
+    available.
+
+    >>> print(dump_yaml({'title': 'Test'}), end='')
+    title: Test
+    '''
+    import yaml
+    dumper = getattr(yaml, "CDumper", yaml.Dumper)
+    return yaml.dump(data, Dumper=dumper, default_flow_style=False)
+
+
 EXISTING_VARIABLES = set()
 
 
@@ -104,6 +314,7 @@ def datetime_to_ISO8601(datetime_string):
     >>> datetime_to_ISO8601("10/28/2014 00:00:00")
     '2014-10-28T00:00:00'
     '''
+    import dateutil.parser
     return dateutil.parser.parse(datetime_string).isoformat()
 
 
@@ -0,0 +1,349 @@
+'''
+Joins between TSVx files, in bounded memory.
+
+    left = tsvx.reader(tsvx.helpers.open_text("users.tsvx.gz"))
+    right = tsvx.reader(tsvx.helpers.open_text("courses.tsvx.gz"))
+    writer = tsvx.writer(tsvx.helpers.open_text("joined.tsvx.gz", "w"))
+    tsvx.join(left, right, ["user_id"], writer)
+
+If both inputs are sorted on the join variables (as recorded by
+`tsvx.sort`), we do a merge join: both are streamed, and only one group
+of equal keys from the right side is held at a time.
+
+Otherwise, we do a hash join: the right side is loaded into a hash
+table, and the left side streamed past it. If the right side grows
+past `memory_limit` bytes, both sides are split by hash of the key
+into partitions on disk, and each pair of partitions joined in turn
+(a grace hash join).
+
+Keys are compared as their declared types. Rows whose keys are missing
+never match. The output has the columns of the left side, then those
+of the right, except for the join variables; right variables which
+clash with left ones get a suffix. Lines are spliced together as text,
+so nothing is decoded but the keys. Merge joins, and hash joins which
+fit in memory, keep the order of the left side.
+'''
+
+import itertools
+import os
+import os.path
+import shutil
+import tempfile
+
+from . import exceptions
+from . import parser
+from . import sorting
+
+MEMORY_LIMIT = 256 * 1024 * 1024
+
+# Number of partitions a hash join spills to
+PARTITIONS = 64
+
+BATCH_ROWS = 10000
+
+
+def sorted_on(header, variables):
+    '''
+    Whether a file is sorted (ascending) on `variables`, as recorded in
+    its metadata by `tsvx.sort`
+    '''
+    order = header.metadata.get("sorted-by")
+    return isinstance(order, list) and \
+        order[:len(variables)] == list(variables) and \
+        not header.metadata.get("sorted-reverse")
+
+
+def _lines(reader):
+    '''
+    The body lines of a reader, without newlines
+    '''
+    for line in reader.generator:
+        line = line.rstrip("\n")
+        if line:
+            yield line
+
+
+def _missing(key):
+    return any(flag == 0 for (flag, value) in key)
+
+
+class _Output:
+    '''
+    Writes joined lines in batches, and counts them
+    '''
+    def __init__(self, writer):
+        self.writer = writer
+        self.batch = []
+        self.rows = 0
+
+    def write(self, line):
+        self.batch.append(line)
+        if len(self.batch) >= BATCH_ROWS:
+            self.flush()
+
+    def flush(self):
+        if self.batch:
+            self.writer.write_chunk("\n".join(self.batch) + "\n")
+            self.rows += len(self.batch)
+            self.batch = []
+
+
+class _Join:
+    '''
+    The parts of a join which don't depend on the algorithm
+    '''
+    def __init__(self, left, right, on, right_on, how, suffix):
+        if how not in ("inner", "left"):
+            raise ValueError("Unknown join: " + repr(how))
+        right_on = right_on or on
+        if len(on) != len(right_on):
+            raise exceptions.TSVxException(
+                "Join on {left} against {right}: different numbers of "
+                "variables".format(left=on, right=right_on))
+        left_indices = [left.variable_index(v) for v in on]
+        right_indices = [right.variable_index(v) for v in right_on]
+        left_types = [left.extra_headers['types'][i] for i in left_indices]
+        right_types = [right.extra_headers['types'][i]
+                       for i in right_indices]
+        if left_types != right_types:
+            raise exceptions.TSVxException(
+                "Join variables have different types: {left} and "
+                "{right}".format(left=left_types, right=right_types))
+
+        self.left = left
+        self.right = right
+        self.on = list(on)
+        self.how = how
+        self.suffix = suffix
+        self.left_key = sorting.key_function(left, on)
+        self.right_key = sorting.key_function(right, right_on)
+        self.keep = [i for i in range(len(right.variables))
+                     if i not in right_indices]
+        types = right.extra_headers['types']
+        self.missing = "".join(
+            "\t" + parser.encoder_for(types[i])(None) for i in self.keep)
+
+    def extra(self, line):
+        '''
+        The fields of a right line we add to left lines, with a leading
+        tab
+        '''
+        if not self.keep:
+            return ""
+        fields = line.split("\t")
+        return "".join("\t" + fields[i] for i in self.keep)
+
+    def write_headers(self, writer, ordered):
+        '''
+        Set up and write the headers of the joined file. If `ordered`,
+        the output keeps the order of the left side.
+        '''
+        (left, right) = (self.left, self.right)
+        variables = list(left.variables)
+        names = list(left.column_names)
+        for i in self.keep:
+            variable = right.variables[i]
+            name = right.column_names[i]
+            if variable in variables:
+                variable += self.suffix
+            if name in names:
+                name += self.suffix
+            variables.append(variable)
+            names.append(name)
+        writer.headers = names
+        writer.variables = variables
+        writer.types = left.extra_headers['types'] + [
+            right.extra_headers['types'][i] for i in self.keep]
+        keys = (set(left.extra_headers) | set(right.extra_headers)) - \
+            set(['types', 'variables'])
+        for key in sorted(keys):
+            left_values = left.extra_headers.get(
+                key, [""] * len(left.variables))
+            right_values = right.extra_headers.get(
+                key, [""] * len(right.variables))
+            writer.line_header(key, list(left_values) + [
+                right_values[i] for i in self.keep])
+        writer.add_metadata("joined-on", self.on)
+        if ordered and "sorted-by" in left.metadata:
+            writer.add_metadata("sorted-by", left.metadata["sorted-by"])
+            if left.metadata.get("sorted-reverse"):
+                writer.add_metadata("sorted-reverse", True)
+        writer.write_headers()
+
+    def probe(self, output, lines, table):
+        '''
+        Join left `lines` against a hash table of right lines
+        '''
+        for line in lines:
+            key = self.left_key(line)
+            matches = None if _missing(key) else table.get(key)
+            if matches:
+                for match in matches:
+                    output.write(line + self.extra(match))
+            elif self.how == "left":
+                output.write(line + self.missing)
+
+
+def _ordered_groups(lines, key, side):
+    '''
+    Groups of lines with equal keys, checking they're in order
+    '''
+    previous = None
+    for (value, group) in itertools.groupby(lines, key=key):
+        if previous is not None and value < previous:
+            raise exceptions.TSVxException(
+                "The {side} input isn't sorted on the join variables, "
+                "although its metadata says so".format(side=side))
+        previous = value
+        yield (value, group)
+
+
+def merge_join(join, writer):
+    '''
+    Join two inputs sorted on the join variables
+    '''
+    join.write_headers(writer, ordered=True)
+    output = _Output(writer)
+    right = _ordered_groups(_lines(join.right), join.right_key, "right")
+    current = next(right, None)
+    for (key, group) in _ordered_groups(
+            _lines(join.left), join.left_key, "left"):
+        while current is not None and current[0] < key:
+            current = next(right, None)
+        matches = None
+        if current is not None and current[0] == key and \
+           not _missing(key):
+            if not isinstance(current[1], list):
+                current = (current[0],
+                           [join.extra(line) for line in current[1]])
+            matches = current[1]
+        for line in group:
+            if matches:
+                for extra in matches:
+                    output.write(line + extra)
+            elif join.how == "left":
+                output.write(line + join.missing)
+    output.flush()
+    return output.rows
+
+
+def hash_join(join, writer, memory_limit=MEMORY_LIMIT,
+              temporary_directory=None):
+    '''
+    Join two inputs with a hash table of the right one, partitioning
+    both to disk if the table grows past `memory_limit` bytes
+    '''
+    table = {}
+    size = 0
+    right = _lines(join.right)
+    for line in right:
+        key = join.right_key(line)
+        if _missing(key):
+            continue
+        table.setdefault(key, []).append(line)
+        size += len(line) + sorting.ROW_OVERHEAD
+        if size > memory_limit:
+            break
+    else:
+        join.write_headers(writer, ordered=True)
+        output = _Output(writer)
+        join.probe(output, _lines(join.left), table)
+        output.flush()
+        return output.rows
+
+    join.write_headers(writer, ordered=False)
+    output = _Output(writer)
+
+    def unmatched(line):
+        if join.how == "left":
+            output.write(line + join.missing)
+
+    directory = tempfile.mkdtemp(prefix="tsvx-join-",
+                                 dir=temporary_directory)
+    try:
+        paths = [(os.path.join(directory, "left-{0}".format(i)),
+                  os.path.join(directory, "right-{0}".format(i)))
+                 for i in range(PARTITIONS)]
+        _partition([path for (_, path) in paths], join.right_key,
+                   itertools.chain(
+                       (line for lines in table.values() for line in lines),
+                       right))
+        table = None
+        _partition([path for (path, _) in paths], join.left_key,
+                   _lines(join.left), unmatched)
+        for (left_path, right_path) in paths:
+            table = {}
+            for line in _read_lines(right_path):
+                table.setdefault(join.right_key(line), []).append(line)
+            join.probe(output, _read_lines(left_path), table)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    output.flush()
+    return output.rows
+
+
+def _partition(paths, key, lines, missing=None):
+    '''
+    Split `lines` between files at `paths`, by hash of key. Lines with
+    missing keys are passed to `missing`, or dropped.
+    '''
+    files = [open(path, "w", encoding="utf-8") for path in paths]
+    try:
+        for line in lines:
+            value = key(line)
+            if _missing(value):
+                if missing:
+                    missing(line)
+                continue
+            files[hash(value) % len(files)].write(line + "\n")
+    finally:
+        for fp in files:
+            fp.close()
+
+
+def _read_lines(path):
+    with open(path, encoding="utf-8") as fp:
+        for line in fp:
+            yield line.rstrip("\n")
+
+
+def join(left, right, on, writer, right_on=None, how="inner",
+         memory_limit=MEMORY_LIMIT, suffix="_right",
+         temporary_directory=None):
+    r'''
+    Join two readers on the variables `on` (or, if the right side
+    names them differently, `on` on the left and `right_on` on the
+    right), writing to `writer`. `how` is "inner" or "left". Returns
+    the number of rows written. The writer's headers are set up for
+    us; give it a title first, if you'd like.
+
+    >>> import io, tsvx
+    >>> header = "a\tb\nint\tstr\t(types)\na\tb\t(variables)\n---\n"
+    >>> left = tsvx.reader(io.StringIO(header + "1\tx\n2\ty\n"))
+    >>> right = tsvx.reader(io.StringIO(header + "2\tz\n2\tw\n"))
+    >>> output = io.StringIO()
+    >>> join(left, right, ["a"], tsvx.writer(output), how="left")
+    3
+    >>> output.getvalue().split("-" * 10 + "\n")[-1]
+    '1\tx\t"null"\n2\ty\tz\n2\ty\tw\n'
+
+    Unmatched rows of a left join read back with missing values, in
+    columns of any type:
+
+    >>> numbers = tsvx.reader(io.StringIO(
+    ...     "a\tn\nint\tint\t(types)\na\tn\t(variables)\n---\n2\t7\n"))
+    >>> output = io.StringIO()
+    >>> join(tsvx.reader(io.StringIO(header + "1\tx\n2\ty\n")), numbers,
+    ...      ["a"], tsvx.writer(output), how="left")
+    2
+    >>> [line.values() for line in tsvx.reader(io.StringIO(output.getvalue()))]
+    [[1, 'x', None], [2, 'y', 7]]
+    '''
+    if isinstance(on, str):
+        on = [on]
+    if isinstance(right_on, str):
+        right_on = [right_on]
+    plan = _Join(left, right, on, right_on, how, suffix)
+    if sorted_on(left, on) and sorted_on(right, right_on or on):
+        return merge_join(plan, writer)
+    return hash_join(plan, writer, memory_limit, temporary_directory)
@@ -0,0 +1,379 @@
+'''
+Many TSVx files, read as one table.
+
+    events = tsvx.dataset("dump/events-*.tsvx.gz")
+    for row in events.rows(columns=["user_id", "created"],
+                           where={"kind": "login"}):
+        ...
+
+A dataset is a glob, a list of files, a directory of files, or a
+partitioned directory (or its manifest; see `tsvx.partitioning`), in
+which case `partitions=` picks partitions without opening the rest.
+
+We read the headers of every file up front (in parallel, and only the
+headers), and check the files have the same variables and types. Rows
+come back as tuples of the `columns` we ask for (all, by default),
+decoded a column at a time, and only from the columns we need.
+`where` maps variables to a value, a list of values, or a function of
+the value which returns whether we want the row.
+
+Shards are scanned concurrently, on threads (the default), or with
+`processes=True`, on a process pool, which parses in parallel too, but
+needs `where` functions which can be pickled. With `ordered=True`
+rows come back file by file, in order; otherwise, in batches, as
+they're ready. Threads hand over batches through bounded queues, so
+memory use doesn't depend on the size of the files. Processes return
+a task at a time, so uncompressed files are split into byte ranges of
+about `chunk_size`.
+'''
+
+import concurrent.futures
+import glob
+import itertools
+import os
+import os.path
+import queue
+import threading
+
+from . import exceptions
+from . import helpers
+from . import parser
+from . import partitioning
+from . import sidecars
+from . import tsvx
+
+WORKERS = 4
+
+BATCH_ROWS = 10000
+
+CHUNK_SIZE = 64 * 1024 * 1024
+
+# Batches each thread may have waiting for the consumer
+QUEUE_BATCHES = 4
+
+
+def _dataset_paths(source, partitions=None):
+    '''
+    The files of a dataset, from a glob, a list of files, a directory,
+    or a manifest
+    '''
+    if not isinstance(source, str):
+        return list(source)
+    if partitioning.is_manifest(source):
+        source = os.path.dirname(source) or "."
+    if os.path.isdir(source):
+        if partitioning.read_manifest(source) is not None or any(
+                "=" in name for name in os.listdir(source)):
+            return partitioning.partition_paths(source, partitions)
+        source = os.path.join(source, "*.tsvx*")
+    return sorted(path for path in glob.glob(source, recursive=True)
+                  if path.endswith((".tsvx", ".tsvx.gz")))
+
+
+class _Scan:
+    '''
+    What to read from each shard: the columns to return, and the
+    conditions on them. This goes to worker processes, so it keeps
+    types rather than parsers.
+    '''
+    def __init__(self, header, columns, where, batch_size):
+        types = header.extra_headers['types']
+        self.indices = [header.variable_index(column) for column in columns]
+        self.conditions = [(header.variable_index(variable), condition)
+                           for (variable, condition) in where.items()]
+        needed = set(self.indices) | set(
+            index for (index, _) in self.conditions)
+        self.types = dict((index, types[index]) for index in needed)
+        self.batch_size = batch_size
+
+    def rows(self, lines):
+        '''
+        The rows we want from a batch of body lines
+        '''
+        fields = [line.rstrip("\n").split("\t") for line in lines]
+        fields = [row for row in fields if row != [""]]
+        if not fields:
+            return []
+        columns = {}
+        try:
+            for (index, column_type) in self.types.items():
+                columns[index] = parser.parse_column(
+                    parser.parser_for(column_type),
+                    [row[index] for row in fields])
+        except IndexError:
+            raise exceptions.TSVxFileFormatException(
+                "Line with too few fields in {lines}".format(
+                    lines=repr(lines[:3])))
+        keep = range(len(fields))
+        for (index, condition) in self.conditions:
+            column = columns[index]
+            keep = [row for row in keep
+                    if partitioning.matches(condition, column[row])]
+        selected = [columns[index] for index in self.indices]
+        return [tuple(column[row] for column in selected) for row in keep]
+
+    def batches(self, task):
+        '''
+        Batches of rows from a task: a whole file, as `(path, None,
+        None)`, or a byte range of an uncompressed one
+        '''
+        (path, start, end) = task
+        if start is None:
+            with helpers.open_text(path) as stream:
+                tsvx.read_header_lines(stream)
+                while True:
+                    lines = list(itertools.islice(stream, self.batch_size))
+                    if not lines:
+                        return
+                    rows = self.rows(lines)
+                    if rows:
+                        yield rows
+        with open(path, "rb") as fp:
+            fp.seek(start)
+            lines = fp.read(end - start).decode("utf-8").split("\n")
+        for begin in range(0, len(lines), self.batch_size):
+            rows = self.rows(lines[begin:begin + self.batch_size])
+            if rows:
+                yield rows
+
+
+def _scan_task(argument):
+    '''
+    Worker: all the batches of a task. Runs in a separate process, so
+    it takes a single tuple.
+    '''
+    (scan, task) = argument
+    return list(scan.batches(task))
+
+
+def _put(channel, item, stop):
+    '''
+    Put an item on a queue, unless the consumer has gone away
+    '''
+    while not stop.is_set():
+        try:
+            channel.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+class _Finished:
+    '''
+    What a thread puts on its queue after a task: its error, if any
+    '''
+    def __init__(self, error=None):
+        self.error = error
+
+
+def _scan_threads(scan, tasks, workers, ordered):
+    '''
+    Batches from `tasks`, scanned on threads
+    '''
+    stop = threading.Event()
+    if ordered:
+        channels = [queue.Queue(QUEUE_BATCHES) for _ in tasks]
+    else:
+        channels = [queue.Queue(QUEUE_BATCHES * workers)] * len(tasks)
+    numbered = iter(enumerate(tasks))
+    lock = threading.Lock()
+
+    def work():
+        while not stop.is_set():
+            with lock:
+                (number, task) = next(numbered, (None, None))
+            if task is None:
+                return
+            try:
+                for batch in scan.batches(task):
+                    if not _put(channels[number], batch, stop):
+                        return
+            except Exception as error:
+                _put(channels[number], _Finished(error), stop)
+                return
+            _put(channels[number], _Finished(), stop)
+
+    threads = [threading.Thread(target=work, daemon=True)
+               for _ in range(min(workers, len(tasks)))]
+    for thread in threads:
+        thread.start()
+    try:
+        finished = 0
+        channel = 0
+        while finished < len(tasks):
+            item = channels[channel].get()
+            if isinstance(item, _Finished):
+                if item.error is not None:
+                    raise item.error
+                finished += 1
+                if ordered:
+                    channel += 1
+            else:
+                yield item
+    finally:
+        stop.set()
+
+
+def _scan_processes(scan, tasks, workers, ordered):
+    '''
+    Batches from `tasks`, scanned on a process pool, with at most two
+    tasks per worker in flight
+    '''
+    arguments = [(scan, task) for task in tasks]
+    with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+        if ordered:
+            for batches in helpers.bounded_map(
+                    executor, _scan_task, arguments, 2 * workers):
+                for batch in batches:
+                    yield batch
+            return
+        arguments = iter(arguments)
+        running = set()
+        while True:
+            for argument in itertools.islice(
+                    arguments, 2 * workers - len(running)):
+                running.add(executor.submit(_scan_task, argument))
+            if not running:
+                return
+            (done, running) = concurrent.futures.wait(
+                running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                for batch in future.result():
+                    yield batch
+
+
+class Dataset:
+    '''
+    TSVx files with compatible headers, read as one table.
+
+    This shouldn't be created directly. We would generally use
+    `tsvx.dataset(...)`.
+    '''
+    def __init__(self, paths, headers):
+        self.paths = paths
+        self.headers = headers
+        self.header = headers[0]
+
+    @property
+    def variables(self):
+        return self.header.variables
+
+    @property
+    def column_names(self):
+        return self.header.column_names
+
+    @property
+    def types(self):
+        return self.header.extra_headers['types']
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __repr__(self):
+        return "<Dataset of {files} files: {variables}>".format(
+            files=len(self.paths), variables=", ".join(self.variables))
+
+    def _tasks(self, paths, processes, chunk_size):
+        if not processes:
+            return [(path, None, None) for path in paths]
+        tasks = []
+        for path in paths:
+            if path.endswith(".gz"):
+                tasks.append((path, None, None))
+                continue
+            (_, start) = tsvx.header_offset(path)
+            with open(path, "rb") as fp:
+                offsets = helpers.line_offsets(
+                    fp, start, os.path.getsize(path), chunk_size)
+            tasks.extend(zip([path] * len(offsets),
+                             offsets[:-1], offsets[1:]))
+        return tasks
+
+    def batches(self, columns=None, where=None, ordered=True,
+                workers=WORKERS, processes=False, batch_size=BATCH_ROWS,
+                chunk_size=CHUNK_SIZE, paths=None):
+        '''
+        Lists of rows (tuples of the values of `columns`) which match
+        `where`, from each file in turn (if `ordered`), or as they're
+        ready
+        '''
+        scan = _Scan(self.header, columns or self.variables, where or {},
+                     batch_size)
+        tasks = self._tasks(self.paths if paths is None else paths,
+                            processes, chunk_size)
+        if not tasks:
+            return iter([])
+        if processes:
+            return _scan_processes(scan, tasks, workers, ordered)
+        return _scan_threads(scan, tasks, workers, ordered)
+
+    def rows(self, columns=None, where=None, **kwargs):
+        '''
+        The rows (tuples of the values of `columns`) which match
+        `where`. Takes the options of `batches`.
+        '''
+        for batch in self.batches(columns, where, **kwargs):
+            for row in batch:
+                yield row
+
+    def __iter__(self):
+        return self.rows()
+
+    def lookup(self, variable, values, columns=None, **kwargs):
+        '''
+        The rows whose `variable` is one of `values`, skipping files
+        whose Bloom filter sidecars (see `tsvx.sidecars`) rule them out
+        '''
+        values = set(values)
+        paths = sidecars.candidates(self.paths, variable, values)
+        return self.rows(columns, {variable: values}, paths=paths,
+                         **kwargs)
+
+
+def _read_headers(paths, workers):
+    with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+        return list(executor.map(tsvx.read_header, paths))
+
+
+def dataset(source, partitions=None, workers=WORKERS):
+    r'''
+    A `Dataset` of the TSVx files `source` names: a glob, a list of
+    files, a directory, or a partitioned directory or its manifest
+    (where `partitions` filters partitions, as in
+    `tsvx.partitioning.partition_paths`).
+
+    >>> import os, shutil, tempfile
+    >>> directory = tempfile.mkdtemp()
+    >>> for shard in range(3):
+    ...     with open(os.path.join(directory, "{0}.tsvx".format(shard)),
+    ...               "w") as fp:
+    ...         _ = fp.write("id\tn\nint\tint\t(types)\nid\tn\t(variables)\n"
+    ...                      "---\n{0}\t{1}\n{1}\t{0}\n".format(shard, 9))
+    >>> shards = dataset(os.path.join(directory, "*.tsvx"))
+    >>> shards
+    <Dataset of 3 files: id, n>
+    >>> list(shards.rows(columns=["n"], where={"id": lambda i: i < 9}))
+    [(9,), (9,), (9,)]
+    >>> sorted(shards.rows(where={"id": 9}, ordered=False))
+    [(9, 0), (9, 1), (9, 2)]
+    >>> shutil.rmtree(directory)
+    '''
+    paths = _dataset_paths(source, partitions)
+    if not paths:
+        raise exceptions.TSVxException(
+            "No TSVx files in {source}".format(source=source))
+    headers = _read_headers(paths, workers)
+    first = headers[0]
+    for (path, header) in zip(paths[1:], headers[1:]):
+        if header.variables != first.variables or \
+           header.extra_headers['types'] != first.extra_headers['types']:
+            raise exceptions.TSVxException(
+                "{path} doesn't match {first}: {variables} ({types}) "
+                "against {first_variables} ({first_types})".format(
+                    path=path, first=paths[0],
+                    variables=", ".join(header.variables),
+                    types=", ".join(header.extra_headers['types']),
+                    first_variables=", ".join(first.variables),
+                    first_types=", ".join(first.extra_headers['types'])))
+    return Dataset(paths, headers)
@@ -0,0 +1,427 @@
+'''
+Hive-style partitioned datasets: a directory of TSVx files, split by
+the values of some variables.
+
+    writer = tsvx.partitioned_writer("events", header,
+                                     by=[("created", "date")])
+    for row in rows:
+        writer.write(*row)
+    writer.close()
+
+writes each row to `events/created=2017-03-14/part-0.tsvx.gz`, for the
+date of its `created` timestamp. Each file is a complete TSVx file
+(partition variables included), with the partition recorded in its
+metadata as `partition`. On close, we write a manifest,
+`events/manifest-part-0.yaml`, listing the partitions, their files,
+and row counts.
+
+    for line in tsvx.partition_rows("events", where={
+            "created": lambda day: "2017-03-01" <= day < "2017-04-01"}):
+        ...
+
+reads just the partitions which match, without opening the others.
+
+Partition values are taken from the text of the field, optionally
+through a transform: a function of the text, or one of "year", "month",
+or "date", which cut an ISO 8601 date or timestamp down. Missing values
+go to the `__null__` partition. Values are %-escaped in directory
+names.
+
+We keep at most `max_open` files open, closing the least recently used
+when we need another. Files we've closed are reopened for appending
+(gzipped files grow a new gzip member, which readers handle). Several
+writers may fill one directory at once, if each has its own `part`
+number: each writes its own manifest, and readers take them together.
+
+With `bloom="user_id"`, each file gets a Bloom filter sidecar on that
+variable, so lookups by it can skip files (see `tsvx.sidecars`).
+'''
+
+import collections
+import fnmatch
+import glob
+import os
+import os.path
+import urllib.parse
+
+from . import bloom as bloom_filters
+from . import exceptions
+from . import helpers
+from . import parser
+from . import tsvx
+
+MAX_OPEN = 64
+
+# Values each file's Bloom filter is sized for, by default
+BLOOM_CAPACITY = 100 * 1000
+
+BATCH_ROWS = 10000
+
+NULL = "__null__"
+
+MANIFEST = "manifest-part-{0}.yaml"
+
+TRANSFORMS = {
+    "year": lambda text: text[:4],
+    "month": lambda text: text[:7],
+    "date": lambda text: text[:10],
+}
+
+
+def _escape(value):
+    return urllib.parse.quote(value, safe="")
+
+
+def _unescape(value):
+    return urllib.parse.unquote(value)
+
+
+def _partition_directory(values):
+    '''
+    The relative directory of a partition, from its `(variable, value)`
+    pairs
+
+    >>> _partition_directory([("day", "2017-03-14"), ("kind", "a/b")])
+    'day=2017-03-14/kind=a%2Fb'
+    '''
+    return "/".join(
+        "{variable}={value}".format(variable=variable, value=_escape(value))
+        for (variable, value) in values)
+
+
+def _parse_directory(path):
+    '''
+    The `(variable, value)` pairs of a partition's relative directory
+    '''
+    values = []
+    for part in path.split("/"):
+        if "=" not in part:
+            raise exceptions.TSVxFileFormatException(
+                "Not a partition directory: " + path)
+        (variable, value) = part.split("=", 1)
+        values.append((variable, _unescape(value)))
+    return values
+
+
+class _Partition:
+    '''
+    An open file of a partition, and the lines waiting to be written
+    to it
+    '''
+    def __init__(self, writer):
+        self.writer = writer
+        self.batch = []
+
+    def flush(self):
+        if self.batch:
+            self.writer.write_chunk("".join(self.batch))
+            self.batch = []
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+
+class PartitionedWriter:
+    '''
+    Writes rows to a directory of TSVx files, partitioned by the
+    values of `by`: variables, or `(variable, transform)` pairs. The
+    files have the columns, line headers, and metadata of `header` (a
+    reader, or a `TSVxHeader`). If `bloom` is a variable, each file
+    gets a Bloom filter sidecar on it.
+
+    This shouldn't be called directly. We would generally use
+    `tsvx.partitioned_writer(...)`.
+    '''
+    def __init__(self, directory, header, by, part=0, compress=True,
+                 max_open=MAX_OPEN, bloom=None,
+                 bloom_capacity=BLOOM_CAPACITY):
+        self.directory = directory
+        self.header = header
+        self.bloom = bloom
+        self.bloom_capacity = bloom_capacity
+        self.filename = "part-{0}.tsvx".format(part) + \
+            (".gz" if compress else "")
+        self.manifest_path = os.path.join(directory, MANIFEST.format(part))
+        self.max_open = max_open
+        types = header.extra_headers['types']
+        self.by = []
+        for item in by:
+            if isinstance(item, str):
+                (variable, transform) = (item, None)
+            else:
+                (variable, transform) = item
+            index = header.variable_index(variable)
+            self.by.append((variable, index,
+                            parser.encoder_for(types[index])(None),
+                            TRANSFORMS.get(transform, transform),
+                            transform if isinstance(transform, str)
+                            else None))
+        self._encoders = [parser.encoder_for(t) for t in types]
+        self.open = collections.OrderedDict()
+        self.started = set()
+        self.rows = collections.Counter()
+
+    def partition(self, fields):
+        '''
+        The relative directory a row (as a list of encoded fields)
+        belongs in
+        '''
+        values = []
+        for (variable, index, null, transform, _) in self.by:
+            text = fields[index]
+            if text == null:
+                text = NULL
+            elif transform is not None:
+                text = transform(text)
+            values.append((variable, text))
+        return _partition_directory(values)
+
+    def _file(self, directory):
+        partition = self.open.get(directory)
+        if partition is not None:
+            self.open.move_to_end(directory)
+            return partition
+        while len(self.open) >= self.max_open:
+            (_, evicted) = self.open.popitem(last=False)
+            evicted.close()
+        path = os.path.join(self.directory, directory, self.filename)
+        if directory in self.started:
+            writer = tsvx.writer(helpers.open_text(path, "a",
+                                                   encoding="utf-8"))
+            writer.copy_headers(self.header)
+            if self.bloom:
+                sidecar = bloom_filters.sidecar_path(path, self.bloom)
+                writer.add_bloom(self.bloom, sidecar, bloom_filter=(
+                    bloom_filters.load_sidecar(sidecar)[1]))
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            writer = tsvx.writer(helpers.open_text(path, "w",
+                                                   encoding="utf-8"))
+            writer.copy_headers(self.header)
+            writer.add_metadata("partition", dict(
+                _parse_directory(directory)))
+            if self.bloom:
+                writer.add_bloom(
+                    self.bloom, bloom_filters.sidecar_path(path, self.bloom),
+                    capacity=self.bloom_capacity)
+            writer.write_headers()
+            self.started.add(directory)
+        partition = self.open[directory] = _Partition(writer)
+        return partition
+
+    def write_line(self, line):
+        '''
+        Write a TSVx-encoded line
+        '''
+        line = line.rstrip("\n")
+        if not line:
+            return
+        directory = self.partition(line.split("\t"))
+        partition = self._file(directory)
+        partition.batch.append(line + "\n")
+        self.rows[directory] += 1
+        if len(partition.batch) >= BATCH_ROWS:
+            partition.flush()
+
+    def write(self, *args):
+        '''
+        Write a row, given as its values, in their native types
+        '''
+        if len(args) != len(self._encoders):
+            raise ValueError(
+                "Length of row items {rows} does not match number of "
+                "columns {types}: {arg}".format(
+                    rows=len(args), types=len(self._encoders),
+                    arg=repr(args)))
+        self.write_line("\t".join(
+            encode(item) for (encode, item) in zip(self._encoders, args)))
+
+    def write_rows(self, rows):
+        for row in rows:
+            self.write(*row)
+
+    def manifest(self):
+        '''
+        A description of what we've written, merged with any earlier
+        manifest for our part number
+        '''
+        previous = _load_manifest(self.manifest_path) or {}
+        files = {entry["path"]: entry
+                 for entry in previous.get("files", [])}
+        for (directory, rows) in self.rows.items():
+            path = directory + "/" + self.filename
+            files[path] = {
+                "path": path,
+                "partition": dict(_parse_directory(directory)),
+                "rows": rows}
+        manifest = {
+            "partitioned-by": [
+                variable if name is None else [variable, name]
+                for (variable, _, _, _, name) in self.by],
+            "variables": list(self.header.variables),
+            "types": list(self.header.extra_headers['types']),
+            "files": [files[path] for path in sorted(files)]}
+        if self.bloom:
+            manifest["bloom"] = self.bloom
+        return manifest
+
+    def close(self):
+        '''
+        Close the open files, and write the manifest. It's written to a
+        temporary file and renamed, so readers never see half of it.
+        '''
+        while self.open:
+            (_, partition) = self.open.popitem(last=False)
+            partition.close()
+        os.makedirs(self.directory, exist_ok=True)
+        temporary = "{path}.{pid}.tmp".format(path=self.manifest_path,
+                                              pid=os.getpid())
+        with open(temporary, "w", encoding="utf-8") as fp:
+            fp.write(helpers.dump_yaml(self.manifest()))
+        os.replace(temporary, self.manifest_path)
+
+
+def partitioned_writer(directory, header, by, part=0, compress=True,
+                       max_open=MAX_OPEN, bloom=None,
+                       bloom_capacity=BLOOM_CAPACITY):
+    '''
+    A `PartitionedWriter`, writing to `directory`.
+    '''
+    return PartitionedWriter(directory, header, by, part, compress,
+                             max_open, bloom, bloom_capacity)
+
+
+def partition(reader, directory, by, **kwargs):
+    r'''
+    Copy a TSVx reader into a partitioned directory. Lines are routed
+    as text, without decoding. Returns the directory's manifest.
+
+    >>> import io, shutil, tempfile
+    >>> directory = tempfile.mkdtemp()
+    >>> reader = tsvx.reader(io.StringIO(
+    ...     "when\tn\nISO8601-datetime\tint\t(types)\n"
+    ...     "when\tn\t(variables)\n---\n"
+    ...     "2017-03-14T09:00:00\t1\n2017-03-15T10:00:00\t2\n"
+    ...     "2017-03-14T23:00:00\t3\n"))
+    >>> manifest = partition(reader, directory, [("when", "date")],
+    ...                      compress=False)
+    >>> [(f["path"], f["rows"]) for f in manifest["files"]]
+    [('when=2017-03-14/part-0.tsvx', 2), ('when=2017-03-15/part-0.tsvx', 1)]
+    >>> [line.n for line in partition_rows(
+    ...     directory, where={"when": "2017-03-14"})]
+    [1, 3]
+
+    Another writer, with its own part number, adds to the dataset:
+
+    >>> reader = tsvx.reader(io.StringIO(
+    ...     "when\tn\nISO8601-datetime\tint\t(types)\n"
+    ...     "when\tn\t(variables)\n---\n2017-03-14T12:00:00\t4\n"))
+    >>> manifest = partition(reader, directory, [("when", "date")],
+    ...                      compress=False, part=1)
+    >>> [f["path"] for f in manifest["files"]]  # doctest: +NORMALIZE_WHITESPACE
+    ['when=2017-03-14/part-0.tsvx', 'when=2017-03-14/part-1.tsvx',
+     'when=2017-03-15/part-0.tsvx']
+    >>> sorted(line.n for line in partition_rows(
+    ...     directory, where={"when": "2017-03-14"}))
+    [1, 3, 4]
+    >>> shutil.rmtree(directory)
+    '''
+    writer = partitioned_writer(directory, reader, by, **kwargs)
+    for line in reader.generator:
+        writer.write_line(line)
+    writer.close()
+    return read_manifest(directory)
+
+
+def is_manifest(path):
+    '''
+    Whether `path` names a writer's manifest
+    '''
+    return fnmatch.fnmatch(os.path.basename(path), MANIFEST.format("*"))
+
+
+def _load_manifest(path):
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding="utf-8") as fp:
+        return helpers.load_yaml(fp.read())
+
+
+def read_manifest(directory):
+    '''
+    The manifest of a partitioned directory: the files listed by the
+    manifests of all its writers. None if it has none.
+    '''
+    manifest = None
+    files = {}
+    paths = sorted(glob.glob(os.path.join(
+        glob.escape(directory), MANIFEST.format("*"))))
+    for path in paths:
+        part = _load_manifest(path)
+        if part is None:
+            continue
+        if manifest is None:
+            manifest = dict(part)
+        for entry in part["files"]:
+            files[entry["path"]] = entry
+    if manifest is not None:
+        manifest["files"] = [files[path] for path in sorted(files)]
+    return manifest
+
+
+def matches(condition, value):
+    '''
+    Whether `value` meets `condition`: a value, a list of values, or a
+    function returning whether we want it
+    '''
+    if callable(condition):
+        return condition(value)
+    if isinstance(condition, (list, tuple, set, frozenset)):
+        return value in condition
+    return value == condition
+
+
+def _wanted(values, where):
+    return all(matches(where[variable], value)
+               for (variable, value) in values if variable in where)
+
+
+def partition_paths(directory, where=None):
+    '''
+    The files of a partitioned directory in partitions which match
+    `where`: a dictionary from partition variables to a value, a list
+    of values, or a function of the value which returns whether we
+    want it. We use the manifest if there is one; otherwise, we walk
+    the directories, skipping those which don't match.
+    '''
+    where = where or {}
+    manifest = read_manifest(directory)
+    if manifest is not None:
+        return [os.path.join(directory, entry["path"])
+                for entry in manifest["files"]
+                if _wanted(entry["partition"].items(), where)]
+
+    paths = []
+
+    def walk(relative):
+        for name in sorted(os.listdir(os.path.join(directory, relative))):
+            path = os.path.join(relative, name)
+            if os.path.isdir(os.path.join(directory, path)):
+                if "=" in name and _wanted(_parse_directory(name), where):
+                    walk(path)
+            elif relative and name.endswith((".tsvx", ".tsvx.gz")):
+                paths.append(os.path.join(directory, path))
+    walk("")
+    return paths
+
+
+def partition_rows(directory, where=None):
+    '''
+    The rows (as `TSVxLine`s) of the partitions of `directory` which
+    match `where`, a file at a time
+    '''
+    for path in partition_paths(directory, where):
+        with helpers.open_text(path) as stream:
+            for line in tsvx.reader(stream):
+                yield line
@@ -0,0 +1,440 @@
+'''
+One-pass profiles of the columns of TSVx files.
+
+For each column, we count missing values, and find the minimum and
+maximum, an approximate number of distinct values (a HyperLogLog
+sketch), approximate quantiles of numbers and dates (a KLL-style
+sketch), and approximately the most frequent values (Misra-Gries).
+Each sketch takes a fixed amount of memory, however big the file.
+
+Sketches merge, so big uncompressed files are profiled in byte ranges
+in parallel processes, and the shards of a dump (all with the same
+columns) each in their own process, and the results combined.
+
+    profile = tsvx.profile(["dump/users.tsvx.gz"])
+    print(profile.columns["age"].quantiles([0.5]))
+
+From the shell:
+
+Usage:
+  tsvx-profile <file>... [--jobs=<jobs>] [--top=<k>] [--json]
+
+Options:
+  --jobs=<jobs>  Number of parallel processes
+  --top=<k>      Most frequent values to show [default: 5]
+  --json         Print JSON, rather than text
+'''
+
+import collections
+import concurrent.futures
+import hashlib
+import itertools
+import json
+import math
+import os
+import random
+
+from . import exceptions
+from . import helpers
+from . import parser
+from . import tsvx
+
+CHUNK_SIZE = 64 * 1024 * 1024
+BATCH_ROWS = 10000
+
+# Types we find quantiles of
+ORDERED_TYPES = set(["int", "float", "Decimal", "ISO8601-date", "date",
+                     "ISO8601-datetime", "datetime", "unformatted-datetime"])
+
+
+def _hash64(value):
+    return int.from_bytes(
+        hashlib.blake2b(value.encode("utf-8"), digest_size=8).digest(), "big")
+
+
+class HyperLogLog:
+    '''
+    Approximate count of distinct strings, in 2**`precision` bytes.
+    The error is about 1.04 / sqrt(2**precision): 1.6% by default.
+
+    >>> sketch = HyperLogLog()
+    >>> sketch.update(str(i % 1000) for i in range(5000))
+    >>> 950 < sketch.estimate() < 1050
+    True
+    '''
+    def __init__(self, precision=12):
+        self.precision = precision
+        self.registers = bytearray(2 ** precision)
+
+    def update(self, values):
+        bits = 64 - self.precision
+        mask = (1 << bits) - 1
+        registers = self.registers
+        for value in values:
+            code = _hash64(value)
+            index = code >> bits
+            rank = bits - (code & mask).bit_length() + 1
+            if rank > registers[index]:
+                registers[index] = rank
+
+    def merge(self, other):
+        self.registers = bytearray(map(max, self.registers, other.registers))
+
+    def estimate(self):
+        size = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / size)
+        estimate = alpha * size * size / sum(
+            2.0 ** -register for register in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * size and zeros:
+            estimate = size * math.log(size / float(zeros))
+        return int(round(estimate))
+
+
+class QuantileSketch:
+    '''
+    Approximate quantiles of a stream of ordered values. We keep levels
+    of at most `k` values; when a level fills, it's sorted, and every
+    other value moves up a level, standing for twice as many.
+
+    >>> sketch = QuantileSketch()
+    >>> sketch.update(range(100000))
+    >>> [abs(value - 100000 * q) < 2000 for (q, value)
+    ...  in zip([0.1, 0.5, 0.9], sketch.quantiles([0.1, 0.5, 0.9]))]
+    [True, True, True]
+    '''
+    def __init__(self, k=256, seed=0):
+        self.k = k
+        self.levels = [[]]
+        self.count = 0
+        self.random = random.Random(seed)
+
+    def update(self, values):
+        values = list(values)
+        self.levels[0].extend(values)
+        self.count += len(values)
+        self._compact()
+
+    def merge(self, other):
+        for (level, values) in enumerate(other.levels):
+            if level >= len(self.levels):
+                self.levels.append([])
+            self.levels[level].extend(values)
+        self.count += other.count
+        self._compact()
+
+    def _compact(self):
+        level = 0
+        while level < len(self.levels):
+            values = self.levels[level]
+            if len(values) > self.k:
+                values.sort()
+                # An odd value out stays where it is
+                keep = values[-1:] if len(values) % 2 else []
+                if keep:
+                    values = values[:-1]
+                if level + 1 == len(self.levels):
+                    self.levels.append([])
+                self.levels[level + 1].extend(
+                    values[self.random.randint(0, 1)::2])
+                self.levels[level] = keep
+            level += 1
+
+    def quantiles(self, fractions):
+        '''
+        Approximate values at each of `fractions` (between 0 and 1) of
+        the way through the data
+        '''
+        weighted = sorted((value, 2 ** level)
+                          for (level, values) in enumerate(self.levels)
+                          for value in values)
+        if not weighted:
+            return [None] * len(fractions)
+        total = sum(weight for (_, weight) in weighted)
+        results = []
+        for fraction in fractions:
+            target = fraction * total
+            seen = 0
+            for (value, weight) in weighted:
+                seen += weight
+                if seen >= target:
+                    break
+            results.append(value)
+        return results
+
+
+class FrequentValues:
+    '''
+    The most frequent values of a stream (Misra-Gries): we keep counts
+    for at most `capacity` values. Counts are lower bounds, off by at
+    most n / capacity.
+
+    >>> sketch = FrequentValues(10)
+    >>> sketch.update(["a"] * 50 + ["b"] * 30 + [str(i) for i in range(40)])
+    >>> [value for (value, count) in sketch.top(2)]
+    ['a', 'b']
+    '''
+    def __init__(self, capacity=100):
+        self.capacity = capacity
+        self.counts = collections.Counter()
+
+    def update(self, values):
+        self._add(collections.Counter(values))
+
+    def merge(self, other):
+        self._add(other.counts)
+
+    def _add(self, counts):
+        self.counts.update(counts)
+        if len(self.counts) > self.capacity:
+            cut = sorted(self.counts.values(),
+                         reverse=True)[self.capacity]
+            self.counts = collections.Counter(
+                dict((value, count - cut)
+                     for (value, count) in self.counts.items()
+                     if count > cut))
+
+    def top(self, k):
+        return self.counts.most_common(k)
+
+
+class ColumnProfile:
+    '''
+    Statistics for one column of type `type_name`
+    '''
+    def __init__(self, type_name):
+        self.type = type_name
+        self.count = 0
+        self.nulls = 0
+        self.min = None
+        self.max = None
+        self.distinct = HyperLogLog()
+        self.frequent = FrequentValues()
+        self.sketch = None
+        if type_name in ORDERED_TYPES:
+            self.sketch = QuantileSketch()
+
+    def update(self, strings):
+        '''
+        Add a batch of values, as they're written in the file
+        '''
+        total = len(strings)
+        self.count += total
+        if self.type == "str":
+            strings = [string for string in strings if string != '"null"']
+        values = parser.parse_column(parser.parser_for(self.type), strings)
+        present = [value for value in values if value is not None]
+        self.nulls += total - len(present)
+        if not present:
+            return
+        self._bounds(min(present), max(present))
+        self.distinct.update(set(string for (string, value)
+                                 in zip(strings, values)
+                                 if value is not None))
+        self.frequent.update(present)
+        if self.sketch is not None:
+            self.sketch.update(present)
+
+    def _bounds(self, low, high):
+        if low is not None and (self.min is None or low < self.min):
+            self.min = low
+        if high is not None and (self.max is None or high > self.max):
+            self.max = high
+
+    def merge(self, other):
+        self.count += other.count
+        self.nulls += other.nulls
+        self._bounds(other.min, other.max)
+        self.distinct.merge(other.distinct)
+        self.frequent.merge(other.frequent)
+        if self.sketch is not None:
+            self.sketch.merge(other.sketch)
+
+    def quantiles(self, fractions):
+        if self.sketch is None:
+            return None
+        return self.sketch.quantiles(fractions)
+
+    def report(self, top=5):
+        '''
+        The statistics, as a dictionary
+        '''
+        report = collections.OrderedDict([
+            ("type", self.type), ("count", self.count),
+            ("nulls", self.nulls), ("min", self.min), ("max", self.max),
+            ("distinct", self.distinct.estimate()),
+        ])
+        if self.sketch is not None:
+            report["quantiles"] = collections.OrderedDict(
+                zip(["5%", "25%", "50%", "75%", "95%"],
+                    self.sketch.quantiles([0.05, 0.25, 0.5, 0.75, 0.95])))
+        report["top"] = self.frequent.top(top)
+        return report
+
+
+class Profile:
+    '''
+    Profiles of every column of a file (or set of shards). `columns`
+    maps variables to `ColumnProfile`s, in file order.
+    '''
+    def __init__(self, header):
+        self.variables = list(header.variables)
+        self.types = list(header.extra_headers['types'])
+        self.columns = collections.OrderedDict(
+            (variable, ColumnProfile(type_name))
+            for (variable, type_name) in zip(self.variables, self.types))
+        self.rows = 0
+        self.malformed = 0
+
+    def update(self, lines):
+        '''
+        Add a batch of body lines
+        '''
+        width = len(self.variables)
+        rows = [line.rstrip("\n").split("\t") for line in lines]
+        good = [row for row in rows if len(row) == width]
+        self.malformed += len(rows) - len(good)
+        self.rows += len(good)
+        if not good:
+            return
+        for (column, strings) in zip(self.columns.values(), zip(*good)):
+            column.update(list(strings))
+
+    def merge(self, other):
+        if other.types != self.types:
+            raise exceptions.TSVxException(
+                "Can't combine profiles of files with different types")
+        self.rows += other.rows
+        self.malformed += other.malformed
+        for (column, other_column) in zip(self.columns.values(),
+                                          other.columns.values()):
+            column.merge(other_column)
+
+    def report(self, top=5):
+        return collections.OrderedDict([
+            ("rows", self.rows), ("malformed", self.malformed),
+            ("columns", collections.OrderedDict(
+                (variable, column.report(top))
+                for (variable, column) in self.columns.items()))])
+
+
+def _batches(lines):
+    lines = (line for line in lines if line.strip("\n"))
+    while True:
+        batch = list(itertools.islice(lines, BATCH_ROWS))
+        if not batch:
+            return
+        yield batch
+
+
+def _profile_range(task):
+    '''
+    Worker: profile a byte range of an uncompressed file, or (if
+    `start` is `None`) a whole file. Runs in a separate process, so it
+    takes a single tuple.
+    '''
+    (path, start, end) = task
+    if start is None:
+        with helpers.open_text(path) as stream:
+            reader = tsvx.reader(stream)
+            profile = Profile(reader)
+            for batch in _batches(reader.generator):
+                profile.update(batch)
+        return profile
+    (header, _) = tsvx.header_offset(path)
+    profile = Profile(header)
+    with open(path, "rb") as fp:
+        offsets = helpers.line_offsets(fp, start, end, CHUNK_SIZE // 16)
+        for (begin, finish) in zip(offsets[:-1], offsets[1:]):
+            fp.seek(begin)
+            text = fp.read(finish - begin).decode("utf-8")
+            for batch in _batches(text.split("\n")):
+                profile.update(batch)
+    return profile
+
+
+def _tasks(paths, chunk_size):
+    tasks = []
+    for path in paths:
+        if path.endswith(".gz"):
+            tasks.append((path, None, None))
+            continue
+        (_, start) = tsvx.header_offset(path)
+        with open(path, "rb") as fp:
+            offsets = helpers.line_offsets(
+                fp, start, os.path.getsize(path), chunk_size)
+        tasks.extend(zip([path] * len(offsets), offsets[:-1], offsets[1:]))
+    return tasks
+
+
+def profile(paths, jobs=None, chunk_size=CHUNK_SIZE):
+    r'''
+    Profile the TSVx files at `paths` (a filename, or a list of the
+    shards of one table), in one pass. Uncompressed files are split into
+    byte ranges of `chunk_size`; ranges and gzipped files are profiled
+    in `jobs` processes (by default, one per CPU). Returns a `Profile`.
+    '''
+    if isinstance(paths, str):
+        paths = [paths]
+    if not paths:
+        raise ValueError("No files to profile")
+    tasks = _tasks(paths, chunk_size)
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+    if jobs > 1 and len(tasks) > 1:
+        with concurrent.futures.ProcessPoolExecutor(jobs) as executor:
+            profiles = list(executor.map(_profile_range, tasks))
+    else:
+        profiles = [_profile_range(task) for task in tasks]
+    result = profiles[0]
+    for other in profiles[1:]:
+        result.merge(other)
+    return result
+
+
+def _format(value):
+    if value is None:
+        return ""
+    if isinstance(value, float):
+        return "{0:.6g}".format(value)
+    if isinstance(value, str):
+        return parser.encode(value, str)
+    return str(value)
+
+
+def main(argv=None):
+    '''
+    Command-line entry point (`tsvx-profile`)
+    '''
+    import docopt
+
+    arguments = docopt.docopt(__doc__, argv)
+    jobs = None
+    if arguments["--jobs"]:
+        jobs = int(arguments["--jobs"])
+    top = int(arguments["--top"])
+    result = profile(arguments["<file>"], jobs=jobs)
+    if arguments["--json"]:
+        print(json.dumps(result.report(top), default=str, indent=2))
+        return
+    print("{rows} rows".format(rows=result.rows))
+    if result.malformed:
+        print("{count} malformed lines".format(count=result.malformed))
+    for (variable, column) in result.columns.items():
+        report = column.report(top)
+        print(variable)
+        print("    type {type}, {nulls} missing, ~{distinct} distinct".format(
+            **report))
+        print("    min {low}, max {high}".format(
+            low=_format(report["min"]), high=_format(report["max"])))
+        if "quantiles" in report:
+            print("    " + ", ".join(
+                "{name}: {value}".format(name=name, value=_format(value))
+                for (name, value) in report["quantiles"].items()))
+        print("    top: " + ", ".join(
+            "{value} ({count})".format(value=_format(value), count=count)
+            for (value, count) in report["top"]))
+
+
+if __name__ == "__main__":
+    main()
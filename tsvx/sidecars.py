@@ -0,0 +1,137 @@
+'''
+Key lookups across many TSVx files, skipping files which can't hold
+the key.
+
+A file can have a Bloom filter sidecar for a variable, written as it's
+written (`writer.add_bloom("user_id")`, or `bloom="user_id"` on a
+partitioned writer), or afterwards, with `build_sidecar`, or from the
+shell:
+
+    python -m tsvx.sidecars --variable=user_id dump/*.tsvx.gz
+
+Then
+
+    tsvx.lookup(glob.glob("dump/*.tsvx.gz"), "user_id", [17, 42])
+
+opens only the files whose filters say they might have user 17 or 42
+(and files with no filter). Looking up a set of keys this way is a
+semi-join.
+
+Usage:
+  sidecars.py --variable=<variable> [--error-rate=<rate>] <file>...
+
+Options:
+  --variable=<variable>  Variable to build filters on
+  --error-rate=<rate>    Rate of false positives [default: 0.01]
+'''
+
+import os.path
+
+from . import bloom
+from . import helpers
+from . import parser
+from . import tsv_types
+from . import tsvx
+
+
+def build_sidecar(path, variable, error_rate=bloom.ERROR_RATE):
+    '''
+    Write the Bloom filter sidecar on `variable` for an existing TSVx
+    file. We read the file twice: once to size the filter, and once to
+    fill it. Returns the sidecar's path.
+    '''
+    with helpers.open_text(path) as stream:
+        header = tsvx.parse_header_lines(tsvx.read_header_lines(stream))
+        rows = sum(1 for line in stream if line.strip("\n"))
+    index = header.variable_index(variable)
+    bloom_filter = bloom.BloomFilter.for_capacity(rows, error_rate)
+    with helpers.open_text(path) as stream:
+        tsvx.read_header_lines(stream)
+        for line in stream:
+            line = line.rstrip("\n")
+            if line:
+                bloom_filter.add(line.split("\t")[index])
+    sidecar = bloom.sidecar_path(path, variable)
+    bloom.save_sidecar(sidecar, header.extra_headers['types'][index],
+                       bloom_filter)
+    return sidecar
+
+
+def might_contain(path, variable, values):
+    '''
+    Whether the file at `path` might have a row whose `variable` is
+    one of `values`. Without a sidecar, we can't tell, so it might.
+    '''
+    sidecar = bloom.sidecar_path(path, variable)
+    if not os.path.exists(sidecar):
+        return True
+    with bloom.SidecarFilter(sidecar) as bloom_filter:
+        encode = parser.encoder_for(bloom_filter.column_type)
+        return any(encode(value) in bloom_filter for value in values)
+
+
+def candidates(paths, variable, values):
+    '''
+    The files among `paths` which might have rows whose `variable` is
+    one of `values`
+    '''
+    values = list(values)
+    return [path for path in paths if might_contain(path, variable, values)]
+
+
+def lookup(paths, variable, values):
+    r'''
+    The rows (as `TSVxLine`s) of the TSVx files at `paths` whose
+    `variable` is one of `values`, opening only files whose Bloom
+    filter sidecars (if any) say they might have them.
+
+    >>> import os, tempfile
+    >>> directory = tempfile.mkdtemp()
+    >>> paths = []
+    >>> for shard in range(3):
+    ...     path = os.path.join(directory, "{0}.tsvx".format(shard))
+    ...     writer = tsvx.writer(open(path, "w"))
+    ...     writer.headers = writer.variables = ["id", "shard"]
+    ...     writer.types = [int, int]
+    ...     _ = writer.add_bloom("id")
+    ...     writer.write_headers()
+    ...     writer.write_rows([(shard * 100 + i, shard) for i in range(100)])
+    ...     writer.close()
+    ...     paths.append(path)
+    >>> candidates(paths, "id", [150, 160])[0] == paths[1]
+    True
+    >>> [line.shard for line in lookup(paths, "id", [150, 250])]
+    [1, 2]
+    >>> os.path.getsize(paths[0] + ".id.bloom") < 200
+    True
+    >>> import shutil; shutil.rmtree(directory)
+    '''
+    values = list(values)
+    for path in candidates(paths, variable, values):
+        with helpers.open_text(path) as stream:
+            reader = tsvx.reader(stream)
+            index = reader.variable_index(variable)
+            encode = parser.encoder_for(reader.extra_headers['types'][index])
+            wanted = set(encode(value) for value in values)
+            for line in reader.generator:
+                fields = line.rstrip("\n").split("\t")
+                if len(fields) > index and fields[index] in wanted:
+                    if not line.endswith("\n"):
+                        line += "\n"
+                    yield tsv_types.TSVxLine(line, reader)
+
+
+def main():
+    '''
+    Build Bloom filter sidecars from the command line
+    '''
+    import docopt
+
+    arguments = docopt.docopt(__doc__)
+    for path in arguments["<file>"]:
+        print(build_sidecar(path, arguments["--variable"],
+                            float(arguments["--error-rate"])))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,205 @@
+'''
+Change sets between two snapshots of a table.
+
+Given yesterday's export and today's, keyed on the primary key, we
+write the rows which were inserted, deleted, or changed, as a TSVx
+file with an extra `operation` column ("insert", "delete", or
+"update"), so downstream systems can apply deltas rather than reload
+everything. Deleted rows are written as they were; inserted and
+changed ones as they are now.
+
+    tsvx.diff("users-monday.tsvx.gz", "users-tuesday.tsvx.gz",
+              ["id"], "users-changes.tsvx.gz")
+
+Both inputs are walked in key order, in step, a key at a time, so
+memory use doesn't depend on their size. Inputs which aren't sorted
+on the key (as recorded by `tsvx.sort`) are sorted first, on disk.
+Rows are compared as text, so the two snapshots should come from the
+same exporter.
+'''
+
+import collections
+import itertools
+import os.path
+import shutil
+import tempfile
+
+from . import exceptions
+from . import helpers
+from . import joins
+from . import sorting
+from . import tsvx
+
+
+def _groups(stream, key):
+    '''
+    Groups of body lines with equal keys, from a stream at the start of
+    the body
+    '''
+    lines = (line.rstrip("\n") for line in stream)
+    lines = (line for line in lines if line)
+    previous = None
+    for (value, group) in itertools.groupby(lines, key=key):
+        if previous is not None and value < previous:
+            raise exceptions.TSVxException(
+                "Input isn't sorted on the key, although its metadata "
+                "says so")
+        previous = value
+        yield (value, list(group))
+
+
+def _sorted_copy(path, key, directory, memory_limit, name):
+    '''
+    `path`, if it's sorted on `key`, or a sorted copy of it, called
+    `name` (the two snapshots often have the same filename)
+    '''
+    if joins.sorted_on(tsvx.read_header(path), key):
+        return path
+    destination = os.path.join(directory, name + ".tsvx")
+    sorting.sort(path, destination, key, memory_limit=memory_limit,
+                 temporary_directory=directory)
+    return destination
+
+
+def _changes(old, new, key):
+    '''
+    `(operation, line)` pairs taking the `old` groups to the `new`
+    '''
+    old_group = next(old, None)
+    new_group = next(new, None)
+    while old_group is not None or new_group is not None:
+        if new_group is None or \
+           (old_group is not None and old_group[0] < new_group[0]):
+            for line in old_group[1]:
+                yield ("delete", line)
+            old_group = next(old, None)
+        elif old_group is None or new_group[0] < old_group[0]:
+            for line in new_group[1]:
+                yield ("insert", line)
+            new_group = next(new, None)
+        else:
+            (before, after) = (old_group[1], new_group[1])
+            if len(before) == 1 and len(after) == 1:
+                if before != after:
+                    yield ("update", after[0])
+            else:
+                # A key which isn't unique: compare the rows as sets
+                removed = collections.Counter(before) - \
+                    collections.Counter(after)
+                added = collections.Counter(after) - \
+                    collections.Counter(before)
+                for line in removed.elements():
+                    yield ("delete", line)
+                for line in added.elements():
+                    yield ("insert", line)
+            old_group = next(old, None)
+            new_group = next(new, None)
+
+
+def _operation_variable(variables):
+    name = "operation"
+    while name in variables:
+        name = "_" + name
+    return name
+
+
+def diff(old, new, key, destination, memory_limit=sorting.MEMORY_LIMIT,
+         temporary_directory=None):
+    r'''
+    Write the changes from the TSVx file `old` to `new` (filenames,
+    optionally gzipped), keyed on the variables `key`, to
+    `destination` (a filename or text stream). Returns a `Counter` of
+    operations.
+
+    >>> import io, os, tempfile
+    >>> directory = tempfile.mkdtemp()
+    >>> header = "id\tname\nint\tstr\t(types)\nid\tname\t(variables)\n---\n"
+    >>> for (name, body) in [("old", "1\ta\n2\tb\n3\tc\n"),
+    ...                      ("new", "3\tc\n1\tA\n4\td\n")]:
+    ...     with open(os.path.join(directory, name), "w") as fp:
+    ...         _ = fp.write(header + body)
+    >>> output = io.StringIO()
+    >>> counts = diff(os.path.join(directory, "old"),
+    ...               os.path.join(directory, "new"), ["id"], output)
+    >>> sorted(counts.items())
+    [('delete', 1), ('insert', 1), ('update', 1)]
+    >>> output.getvalue().split("-" * 10 + "\n")[-1]
+    'update\t1\tA\ndelete\t2\tb\ninsert\t4\td\n'
+
+    Snapshots often have the same filename, in different directories;
+    here, they're big enough not to be read in one go, and unsorted:
+
+    >>> for (name, start, changed) in [("monday", 0, "a"),
+    ...                                ("tuesday", 100, "b")]:
+    ...     os.mkdir(os.path.join(directory, name))
+    ...     with open(os.path.join(directory, name, "users.tsvx"),
+    ...               "w") as fp:
+    ...         _ = fp.write(header + "".join(
+    ...             "{0}\t{1}\n".format(i, changed if i % 100 == 0 else i)
+    ...             for i in reversed(range(start, start + 20000))))
+    >>> counts = diff(os.path.join(directory, "monday", "users.tsvx"),
+    ...               os.path.join(directory, "tuesday", "users.tsvx"),
+    ...               ["id"], io.StringIO())
+    >>> sorted(counts.items())
+    [('delete', 100), ('insert', 100), ('update', 199)]
+    >>> shutil.rmtree(directory)
+    '''
+    if isinstance(key, str):
+        key = [key]
+    old_header = tsvx.read_header(old)
+    new_header = tsvx.read_header(new)
+    if old_header.variables != new_header.variables or \
+       old_header.extra_headers['types'] != new_header.extra_headers['types']:
+        raise exceptions.TSVxException(
+            "{old} and {new} have different columns".format(old=old, new=new))
+    key_function = sorting.key_function(new_header, key)
+
+    directory = tempfile.mkdtemp(prefix="tsvx-diff-", dir=temporary_directory)
+    streams = []
+    try:
+        groups = []
+        for (path, name) in ((old, "old"), (new, "new")):
+            stream = helpers.open_text(
+                _sorted_copy(path, key, directory, memory_limit, name))
+            streams.append(stream)
+            tsvx.read_header_lines(stream)
+            groups.append(_groups(stream, key_function))
+
+        if isinstance(destination, str):
+            output_stream = helpers.open_text(destination, "w")
+        else:
+            output_stream = destination
+        writer = tsvx.writer(output_stream)
+        writer.copy_headers(new_header)
+        operation = _operation_variable(new_header.variables)
+        writer.headers = [operation] + writer.headers
+        writer.variables = [operation] + writer.variables
+        writer.types = ["str"] + writer.types
+        for name in writer.extra_headers:
+            writer.extra_headers[name] = [""] + writer.extra_headers[name]
+        for name in ("sorted-reverse", "joined-on", "aggregated-by"):
+            writer.metadata.pop(name, None)
+        writer.add_metadata("diff-key", list(key))
+        writer.add_metadata("diff-old", os.path.basename(old))
+        writer.add_metadata("diff-new", os.path.basename(new))
+        writer.add_metadata("sorted-by", list(key))
+        writer.write_headers()
+
+        counts = collections.Counter()
+        batch = []
+        for (change, line) in _changes(groups[0], groups[1], key_function):
+            counts[change] += 1
+            batch.append(change + "\t" + line + "\n")
+            if len(batch) >= sorting.BATCH_ROWS:
+                writer.write_chunk("".join(batch))
+                batch = []
+        writer.write_chunk("".join(batch))
+        if isinstance(destination, str):
+            writer.close()
+        else:
+            output_stream.flush()
+        return counts
+    finally:
+        for stream in streams:
+            stream.close()
+        shutil.rmtree(directory, ignore_errors=True)
@@ -0,0 +1,242 @@
+'''
+External merge sort for TSVx files, in bounded memory.
+
+We read rows until we've used about `memory_limit` bytes, sort them,
+and spill them to a temporary TSVx file (a run). At the end, the runs
+are merged with a heap. Keys are compared as their declared types (so
+`10` comes after `9`), and lines are copied through untouched, so
+escapes survive. If there are too many runs to open at once, we merge
+them in more than one pass.
+
+Missing values (which don't parse as their column's type) sort first.
+Strings sort by code point. The sort is stable.
+
+    tsvx.sort("users.tsvx.gz", "sorted.tsvx.gz", by=["country", "age"])
+
+The output has the headers and metadata of the input, and records its
+order in the metadata, as `sorted-by` (and `sorted-reverse`, if it's
+descending). To sort from the shell, run `python -m tsvx.sorting`.
+
+Usage:
+  sorting.py <input> <output> --by=<variables> [--reverse]
+             [--memory=<megabytes>]
+
+Options:
+  --by=<variables>      Comma-separated variables to sort on
+  --reverse             Sort in descending order
+  --memory=<megabytes>  Memory to sort in [default: 256]
+'''
+
+import heapq
+import operator
+import os
+import os.path
+import shutil
+import tempfile
+
+from . import exceptions
+from . import helpers
+from . import tsvx
+
+MEMORY_LIMIT = 256 * 1024 * 1024
+
+# Most runs we merge at once
+MAX_MERGE = 64
+
+# Rough memory used per row, besides the line itself: the list slot, the
+# key tuple and its items
+ROW_OVERHEAD = 200
+
+BATCH_ROWS = 10000
+
+
+def key_function(header, variables):
+    r'''
+    A function giving the sort key for a line of a TSVx body (a string),
+    on `variables`, decoded as their column types. Values which don't
+    parse (such as nulls) sort before those which do.
+
+    >>> header = tsvx.read_header(iter(["a\tb\n", "int\tstr\t(types)\n",
+    ...                                 "a\tb\t(variables)\n", "---\n"]))
+    >>> key = key_function(header, ["a"])
+    >>> key("10\tx\n") > key("9\ty\n") > key("None\tz\n")
+    True
+    '''
+    indices = [header.variable_index(variable) for variable in variables]
+    parsers = [header.parsers[index] for index in indices]
+    columns = list(zip(indices, parsers))
+
+    def key(line):
+        fields = line.rstrip("\n").split("\t")
+        result = []
+        for index, parse in columns:
+            try:
+                value = parse(fields[index])
+            except (ValueError, IndexError,
+                    exceptions.TSVxFileFormatException):
+                value = None
+            if value is None:
+                result.append((0, fields[index] if index < len(fields)
+                               else ""))
+            else:
+                result.append((1, value))
+        return tuple(result)
+    return key
+
+
+def start_writer(stream, header, metadata=None):
+    '''
+    A writer on `stream` with the columns, line headers, and metadata of
+    `header` (plus anything in `metadata`). The headers are written.
+    '''
+    writer = tsvx.writer(stream)
+    writer.copy_headers(header)
+    for key, value in (metadata or {}).items():
+        if value is None:
+            writer.metadata.pop(key, None)
+        else:
+            writer.add_metadata(key, value)
+    writer.write_headers()
+    return writer
+
+
+def _write_run(path, header, rows):
+    '''
+    Spill sorted `(key, line)` pairs to a temporary TSVx file
+    '''
+    with open(path, "w", encoding="utf-8") as stream:
+        start_writer(stream, header)
+        for batch in _batches(rows):
+            stream.write("".join(line for (key, line) in batch))
+    return path
+
+
+def _read_run(path, key):
+    '''
+    The `(key, line)` pairs in a run
+    '''
+    with open(path, encoding="utf-8") as stream:
+        tsvx.read_header_lines(stream)
+        for line in stream:
+            yield (key(line), line)
+
+
+def _batches(rows):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= BATCH_ROWS:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _merge(iterables, reverse):
+    return heapq.merge(*iterables, key=operator.itemgetter(0),
+                       reverse=reverse)
+
+
+def sort(source, destination, by, memory_limit=MEMORY_LIMIT,
+         reverse=False, temporary_directory=None):
+    r'''
+    Sort the TSVx file `source` on the variables in `by`, into
+    `destination`. Both may be filenames (optionally ending in `.gz`),
+    or text streams. We hold about `memory_limit` bytes of rows at a
+    time, and spill the rest to `temporary_directory` (by default, the
+    system's). Returns the number of rows.
+
+    >>> import io
+    >>> source = io.StringIO("a\tb\nint\tstr\t(types)\n"
+    ...                      "a\tb\t(variables)\n---\n"
+    ...                      "10\tx\n9\ty\n10\tw\n")
+    >>> output = io.StringIO()
+    >>> sort(source, output, by=["a"], memory_limit=1)
+    3
+    >>> output.getvalue().split("-" * 10 + "\n")[-1]
+    '9\ty\n10\tx\n10\tw\n'
+    '''
+    if isinstance(by, str):
+        by = [by]
+    if isinstance(source, str):
+        input_stream = helpers.open_text(source)
+    else:
+        input_stream = source
+    directory = None
+    try:
+        reader = tsvx.reader(input_stream)
+        key = key_function(reader, by)
+        runs = []
+        rows = []
+        size = 0
+        count = 0
+        for line in reader.generator:
+            if not line.strip("\n"):
+                continue
+            if not line.endswith("\n"):
+                line += "\n"
+            rows.append((key(line), line))
+            count += 1
+            size += len(line) + ROW_OVERHEAD
+            if size >= memory_limit:
+                if directory is None:
+                    directory = tempfile.mkdtemp(prefix="tsvx-sort-",
+                                                 dir=temporary_directory)
+                rows.sort(key=operator.itemgetter(0), reverse=reverse)
+                runs.append(_write_run(
+                    os.path.join(directory, "run-{0}".format(len(runs))),
+                    reader, rows))
+                (rows, size) = ([], 0)
+        rows.sort(key=operator.itemgetter(0), reverse=reverse)
+
+        # Merge runs in groups, until there are few enough to merge at
+        # once. Merged runs go back in front, to keep the sort stable.
+        generation = 0
+        while len(runs) + 1 > MAX_MERGE:
+            group = runs[:MAX_MERGE]
+            generation += 1
+            merged = _write_run(
+                os.path.join(directory, "merged-{0}".format(generation)),
+                reader, _merge([_read_run(path, key) for path in group],
+                               reverse))
+            for path in group:
+                os.unlink(path)
+            runs = [merged] + runs[MAX_MERGE:]
+        ordered = _merge([_read_run(path, key) for path in runs] + [rows],
+                         reverse)
+
+        if isinstance(destination, str):
+            output_stream = helpers.open_text(destination, "w")
+        else:
+            output_stream = destination
+        writer = start_writer(output_stream, reader, {
+            "sorted-by": list(by),
+            "sorted-reverse": True if reverse else None})
+        for batch in _batches(ordered):
+            writer.write_chunk("".join(line for (key, line) in batch))
+        if isinstance(destination, str):
+            writer.close()
+        else:
+            output_stream.flush()
+        return count
+    finally:
+        if isinstance(source, str):
+            input_stream.close()
+        if directory is not None:
+            shutil.rmtree(directory, ignore_errors=True)
+
+
+def main():
+    '''
+    Sort a TSVx file from the command line
+    '''
+    import docopt
+
+    arguments = docopt.docopt(__doc__)
+    sort(arguments["<input>"], arguments["<output>"],
+         arguments["--by"].split(","), reverse=arguments["--reverse"],
+         memory_limit=int(arguments["--memory"]) * 1024 * 1024)
+
+
+if __name__ == "__main__":
+    main()
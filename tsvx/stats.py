@@ -0,0 +1,106 @@
+'''
+Opt-in instrumentation for readers and writers: rows and bytes
+processed, and the time spent parsing or encoding each column. This
+is meant to answer "which column is slow?" without a profiler. It
+costs a couple of timer calls per field, so it's off by default.
+'''
+
+import time
+
+
+class TSVxStats:
+    '''
+    Counters for one reader or writer. Bytes are for the body of the
+    file only (not the headers), as UTF-8.
+
+    >>> stats = TSVxStats()
+    >>> stats.parse_row(["1", "2.5"], [int, float])
+    [1, 2.5]
+    >>> stats.add_row(8)
+    >>> report = stats.report(["a", "b"], ["int", "float"])
+    >>> report["rows"], report["bytes"], sorted(report["columns"])
+    (1, 8, ['a', 'b'])
+    '''
+    def __init__(self):
+        self.rows = 0
+        self.bytes = 0
+        self.column_seconds = []
+        self.hooks = []
+
+    def _grow(self, width):
+        if len(self.column_seconds) < width:
+            self.column_seconds.extend(
+                [0.0] * (width - len(self.column_seconds)))
+
+    def parse_row(self, items, parsers):
+        '''
+        Parse a split line with a parser per column, timing each column
+        '''
+        self._grow(len(parsers))
+        timer = time.perf_counter
+        seconds = self.column_seconds
+        row = []
+        for i, (item, parse) in enumerate(zip(items, parsers)):
+            start = timer()
+            row.append(parse(item))
+            seconds[i] += timer() - start
+        return row
+
+    def encode_row(self, items, encoders):
+        '''
+        Encode a row of Python objects with an encoder per column, timing
+        each column
+        '''
+        self._grow(len(encoders))
+        timer = time.perf_counter
+        seconds = self.column_seconds
+        row = []
+        for i, (item, encode) in enumerate(zip(items, encoders)):
+            start = timer()
+            row.append(encode(item))
+            seconds[i] += timer() - start
+        return row
+
+    def add_hook(self, callback, every):
+        '''
+        Call `callback(owner)` every `every` rows (at least one).
+        '''
+        if every < 1:
+            raise ValueError(
+                "every must be at least 1, not {every}".format(every=every))
+        self.hooks.append((callback, every))
+
+    def add_row(self, byte_count, owner=None, rows=1):
+        '''
+        Count rows which were read or written, and fire any hooks which
+        are due.
+        '''
+        before = self.rows
+        self.rows += rows
+        self.bytes += byte_count
+        for callback, every in self.hooks:
+            if self.rows // every != before // every:
+                callback(owner)
+
+    def report(self, variables, types):
+        '''
+        Summarize as a dictionary. Times are in seconds, totalled by
+        column (using variable names, if we have them) and by type.
+        '''
+        columns = {}
+        by_type = {}
+        for i, seconds in enumerate(self.column_seconds):
+            name = i
+            if variables and i < len(variables):
+                name = variables[i]
+            columns[name] = seconds
+            if types and i < len(types):
+                type_name = getattr(types[i], "__name__", types[i])
+                by_type[type_name] = by_type.get(type_name, 0.0) + seconds
+        return {
+            "rows": self.rows,
+            "bytes": self.bytes,
+            "seconds": sum(self.column_seconds),
+            "columns": columns,
+            "types": by_type
+        }
@@ -4,11 +4,11 @@ The TSVxReader, TSVxWriter, and TSVxLine objects.
 
 import datetime
 import sys
-import yaml
 
 from . import helpers
 from . import parser
 from . import exceptions
+from . import stats
 
 
 class TSVxLine:
@@ -29,10 +29,15 @@ class TSVxLine:
         newline. Split on tabs. And parse
         '''
         split_line = line_string[:-1].split('\t')
-        self.line = list()
         try:
-            for item, item_type in zip(split_line, parent.types):
-                self.line.append(parser.parse(item, item_type))
+            if parent._stats is not None:
+                self.line = parent._stats.parse_row(
+                    split_line, parent.parsers)
+            else:
+                self.line = [
+                    parse(item)
+                    for parse, item in zip(parent.parsers, split_line)
+                ]
         except:
             print("Error parsing", line_string)
             raise
@@ -135,6 +140,7 @@ class TSVxReaderWriter():
         '''
         self._metadata = dict()
         self.extra_headers = dict()
+        self._stats = None
 
     def __repr__(self):
         '''
@@ -142,7 +148,7 @@ class TSVxReaderWriter():
         may be too verbose, so we'll probably cut back to just the title
         and maybe line header.
         '''
-        return yaml.dump(self._metadata)+"/"+str(self.extra_headers)
+        return helpers.dump_yaml(self._metadata)+"/"+str(self.extra_headers)
 
     def variable_index(self, variable):
         '''
@@ -183,29 +189,75 @@ class TSVxReaderWriter():
     def metadata(self):
         return self._metadata
 
+    def enable_stats(self):
+        '''
+        Start collecting statistics: rows and bytes processed, and time
+        spent per column. This slows things down a little.
+        '''
+        if self._stats is None:
+            self._stats = stats.TSVxStats()
+
+    def add_hook(self, callback, every=100000):
+        '''
+        Call `callback(self)` every `every` rows. For example, to log
+        progress on a long load:
+
+            reader.add_hook(lambda r: print(r.stats()), every=10**6)
+
+        This turns on statistics.
+        '''
+        self.enable_stats()
+        self._stats.add_hook(callback, every)
+
+    def stats(self):
+        '''
+        Statistics so far, as a dictionary with `rows`, `bytes`, total
+        `seconds` parsing or encoding, and `seconds` broken down by
+        `columns` and by `types`. Only available if turned on, with
+        `stats=True` or `enable_stats()`.
+        '''
+        if self._stats is None:
+            raise exceptions.TSVxException(
+                "Statistics are off. Pass stats=True, or call enable_stats()")
+        return self._stats.report(self.variables, self.types)
 
-class TSVxReader(TSVxReaderWriter):
+
+class TSVxHeader(TSVxReaderWriter):
+    '''
+    The headers of a TSVx file (metadata, column names, and line
+    headers), without the body. This is what `tsvx.read_header` gives,
+    and the base of the reader.
+    '''
     def __init__(self,
                  column_names,
                  metadata,
-                 line_header,
-                 generator):
-        '''
-        Create a new TSVx Reader. This shouldn't be called directly. We
-        would generally use `tsvx.reader(file_pointer)`. 
-        '''
+                 line_header):
         super().__init__()
         self._column_names = column_names
         self._metadata = metadata
         self.extra_headers = line_header
-        self.generator = generator
+        self._types = None
+        self._parsers = None
 
     @property
     def types(self):
         '''
         Python / string-style type names for each column
         '''
-        return list(map(helpers.to_python_type, self.extra_headers['types']))
+        if self._types is None:
+            self._types = list(
+                map(helpers.to_python_type, self.extra_headers['types']))
+        return self._types
+
+    @property
+    def parsers(self):
+        '''
+        The parser function for each column. We look these up once, rather
+        than once per item.
+        '''
+        if self._parsers is None:
+            self._parsers = [parser.parser_for(t) for t in self.types]
+        return self._parsers
 
     @property
     def column_names(self):
@@ -221,13 +273,41 @@ class TSVxReader(TSVxReaderWriter):
         '''
         return self.extra_headers['variables']
 
+
+class TSVxReader(TSVxHeader):
+    def __init__(self,
+                 column_names,
+                 metadata,
+                 line_header,
+                 generator,
+                 stats=False):
+        '''
+        Create a new TSVx Reader. This shouldn't be called directly. We
+        would generally use `tsvx.reader(file_pointer)`. 
+        '''
+        super().__init__(column_names, metadata, line_header)
+        self.generator = generator
+        if stats:
+            self.enable_stats()
+
     def __iter__(self):
         '''
         This is the basic way of stepping through a TSV: We iterate
         through the rows in the TSVx file. 
         '''
+        if self._stats is not None:
+            return self._iter_with_stats()
         return (TSVxLine(x, self) for x in self.generator)
 
+    def _iter_with_stats(self):
+        '''
+        Iterate, counting rows and bytes as we go
+        '''
+        for line_string in self.generator:
+            line = TSVxLine(line_string, self)
+            self._stats.add_row(len(line_string.encode('utf-8')), self)
+            yield line
+
     def close(self):
         '''
         This is dumb. We should figure out how not to be dumb later, but
@@ -243,7 +323,7 @@ class TSVxWriter(TSVxReaderWriter):
     '''
     Class to stream TSVs to a file.
     '''
-    def __init__(self, destination):
+    def __init__(self, destination, stats=False):
         '''
         We pass a file-pointer-like-object to create a writer. We then
         configure it by setting `headers`, etc.
@@ -261,6 +341,10 @@ class TSVxWriter(TSVxReaderWriter):
         self._variables = None
         self.written = False
         self._types = []
+        self._encoders = []
+        self._blooms = []
+        if stats:
+            self.enable_stats()
 
     @property
     def headers(self):
@@ -305,6 +389,61 @@ class TSVxWriter(TSVxReaderWriter):
                 self._types.append(python_type)  # e.g. `ISO8601-date`
             else:
                 self._types.append(python_type.__name__)  # e.g. `int`
+        self._encoders = [parser.encoder_for(t) for t in self._types]
+
+    def copy_headers(self, header):
+        '''
+        Take the column names, variables, types, line headers, and
+        metadata of another file (a reader, or a `TSVxHeader`). We keep
+        our own `created-date` and `generator`.
+        '''
+        self.headers = list(header.column_names)
+        self.variables = list(header.variables)
+        self.types = header.extra_headers['types']
+        for key, values in header.extra_headers.items():
+            if key not in ('types', 'variables'):
+                self.extra_headers[key] = list(values)
+        for key, value in header.metadata.items():
+            if key not in ('created-date', 'generator'):
+                self._metadata[key] = value
+
+    def add_bloom(self, variable, path=None, capacity=None,
+                  error_rate=None, bloom_filter=None):
+        '''
+        Keep a Bloom filter of the values of `variable`, and save it to
+        the sidecar `path` when we close. If the destination is a
+        named file, `path` defaults to `bloom.sidecar_path`. The filter
+        is sized for `capacity` values or, by default, for the rows we
+        write, with `error_rate` false positives (by default,
+        `bloom.ERROR_RATE`). To add to an existing filter (say, when
+        appending), pass it as `bloom_filter`.
+        '''
+        from . import bloom
+
+        if path is None:
+            path = bloom.sidecar_path(self.destination.name, variable)
+        if bloom_filter is None and capacity:
+            bloom_filter = bloom.BloomFilter.for_capacity(
+                capacity, error_rate or bloom.ERROR_RATE)
+        elif bloom_filter is None:
+            bloom_filter = bloom.GrowingBloomFilter(
+                error_rate or bloom.ERROR_RATE)
+        index = None
+        if self._variables:
+            index = self._variables.index(variable)
+        self._blooms.append([variable, path, bloom_filter, index])
+        return bloom_filter
+
+    def _index_blooms(self):
+        for entry in self._blooms:
+            entry[3] = self._variables.index(entry[0])
+
+    def _add_to_blooms(self, chunk):
+        for line in chunk.split("\n"):
+            if line:
+                fields = line.split("\t")
+                for (_, _, bloom_filter, index) in self._blooms:
+                    bloom_filter.add(fields[index])
 
     def add_metadata(self, key, value):
         '''
@@ -328,9 +467,11 @@ class TSVxWriter(TSVxReaderWriter):
                 helpers.variable_from_string(header)
                 for header
                 in self._headers]
+        if self._blooms:
+            self._index_blooms()
 
         if self._metadata:
-            metadata = yaml.dump(self._metadata, default_flow_style=False)
+            metadata = helpers.dump_yaml(self._metadata)
             self.destination.write(metadata)
             self.destination.write("-"*10 + "\n")
         self.destination.write("\t".join(self._headers) + "\n")
@@ -345,6 +486,17 @@ class TSVxWriter(TSVxReaderWriter):
 
         self.destination.write("-"*10 + "\n")
 
+    def _check_width(self, row):
+        if len(row) != len(self._types):
+            raise ValueError(
+                "Length of row items {rows} does not match "
+                "number of rows {types}: {arg}".format(
+                    rows=len(row),
+                    types=len(self._types),
+                    arg=repr(row)
+                )
+            )
+
     def write(self, *args):
         '''
         Write a row into the TSV file. Takes items to write as
@@ -352,24 +504,75 @@ class TSVxWriter(TSVxReaderWriter):
         through an encoder to convert them into the correct strings,
         adds tabs, and writes them.
         '''
-        if len(args) != len(self._types):
-            raise ValueError(
-                "Length of row items {rows} does not match "
-                "number of rows {types}: {arg}".format(
-                    rows=len(args),
-                    types=len(self._types),
-                    arg=repr(args)
-                )
-            )
-        encoded = [
-            parser.encode(item, item_type)
-            for item, item_type
-            in zip(args, self._types)
-        ]
-        self.destination.write("\t".join(encoded)+"\n")
+        self._check_width(args)
+        if self._stats is not None:
+            encoded = self._stats.encode_row(args, self._encoders)
+        else:
+            encoded = [
+                encode(item)
+                for encode, item
+                in zip(self._encoders, args)
+            ]
+        line = "\t".join(encoded)+"\n"
+        self.destination.write(line)
+        for (_, _, bloom_filter, index) in self._blooms:
+            bloom_filter.add(encoded[index])
+        if self._stats is not None:
+            self._stats.add_row(len(line.encode('utf-8')), self)
+
+    def encode_rows(self, rows):
+        '''
+        Encode an iterable of rows (sequences of native values, such as
+        the tuples from a database cursor) into a block of TSVx lines,
+        without writing it. This doesn't touch the writer's state, so
+        worker threads may call it, and hand the block to `write_chunk`.
+        '''
+        encoders = self._encoders
+        lines = []
+        for row in rows:
+            self._check_width(row)
+            lines.append("\t".join([
+                encode(item) for encode, item in zip(encoders, row)
+            ]))
+        if not lines:
+            return ""
+        return "\n".join(lines) + "\n"
+
+    def write_rows(self, rows):
+        '''
+        Write many rows at once; for instance, a `fetchmany()` batch from
+        a database cursor. This is faster than calling `write` per row.
+        '''
+        if self._stats is not None:
+            # Go row by row, so we get per-column timings
+            for row in rows:
+                self.write(*row)
+        else:
+            self.write_chunk(self.encode_rows(rows))
+
+    def write_chunk(self, chunk):
+        '''
+        Write a block of rows which are already TSVx-encoded, such as
+        the output of a converter. The block is written as-is, so it
+        must be complete lines.
+        '''
+        self.destination.write(chunk)
+        if self._blooms:
+            self._add_to_blooms(chunk)
+        if self._stats is not None:
+            self._stats.add_row(
+                len(chunk.encode('utf-8')), self, rows=chunk.count("\n"))
 
     def close(self):
         '''
-        This closes the stream associated with the writer.
+        This closes the stream associated with the writer, and saves
+        any Bloom filters.
         '''
         self.destination.close()
+        if self._blooms:
+            from . import bloom
+
+            for (variable, path, bloom_filter, index) in self._blooms:
+                if isinstance(bloom_filter, bloom.GrowingBloomFilter):
+                    bloom_filter = bloom_filter.build()
+                bloom.save_sidecar(path, self._types[index], bloom_filter)
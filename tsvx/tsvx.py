@@ -1,46 +1,173 @@
 '''
 This file defines the top-level operations -- the reader and
-writer. These are exported at the module level in __init__.py
+writer, and header-only reads. These are exported at the module level
+in __init__.py
 '''
 
 import sys
-import yaml
 
+from . import exceptions
 from . import helpers
 from . import tsv_types
 
 
-def reader(to_be_parsed):
+def reader(to_be_parsed, stats=False, prefetch=False):
     '''
     TSVx Reader. This can handle both text data and stream
     data. Perhaps break it up in the future?
+
+    With `stats=True`, the reader keeps per-column timing statistics
+    (see `TSVxReader.stats()`).
+
+    With `prefetch=True`, a background thread reads the stream ahead
+    of us, in blocks of a few megabytes, so I/O latency (on network
+    filesystems, or cold caches) overlaps with parsing. `prefetch` may
+    also be the block size, in characters.
     '''
 
     if isinstance(to_be_parsed, str):
-        return _parse_generator(to_be_parsed.split("\n"))
-    else:
-        return _parse_generator(to_be_parsed)
+        return _parse_generator(to_be_parsed.split("\n"), stats)
+    if prefetch:
+        if prefetch is True:
+            to_be_parsed = helpers.prefetch_lines(to_be_parsed)
+        else:
+            to_be_parsed = helpers.prefetch_lines(to_be_parsed, prefetch)
+    return _parse_generator(to_be_parsed, stats)
+
+
+def writer(destination, stats=False):
+    '''
+    Given an output stream, create a TSVx Writer. With `stats=True`,
+    the writer keeps per-column timing statistics.
+    '''
+    return tsv_types.TSVxWriter(destination, stats)
+
+
+def read_header(source):
+    r'''
+    Read just the headers of a TSVx file: metadata, column names, and
+    line headers. Takes a filename (which may be gzipped), or a text
+    stream. We stop reading at the end of the headers, so this is fast
+    even for huge (or compressed) files. Returns a `TSVxHeader`.
+
+    Headers which are malformed, or cut short, raise
+    `TSVxFileFormatException`.
+
+    >>> import gzip, io, os, tempfile
+    >>> header = "title: Test\n---\na\nint\t(types)\na\t(variables)\n---\n"
+    >>> read_header(io.StringIO(header)).extra_headers['types']
+    ['int']
+    >>> bad = header.replace("Test", "[unclosed")
+    >>> path = os.path.join(tempfile.mkdtemp(), "bad.tsvx.gz")
+    >>> with gzip.open(path, "wt") as fp:
+    ...     _ = fp.write(bad)
+    >>> for source in [io.StringIO(bad), io.StringIO(header[:30]), path]:
+    ...     try:
+    ...         read_header(source)
+    ...     except exceptions.TSVxFileFormatException as error:
+    ...         print(str(error).split(":")[0])
+    Malformed TSVx header
+    Incomplete or missing TSVx header
+    Malformed TSVx header
+    >>> import shutil; shutil.rmtree(os.path.dirname(path))
+    '''
+    try:
+        if isinstance(source, str):
+            with helpers.open_text(source) as stream:
+                lines = read_header_lines(stream)
+        else:
+            lines = read_header_lines(source)
+    except EOFError:
+        raise exceptions.TSVxFileFormatException(
+            "Incomplete or missing TSVx header")
+    return parse_header_lines(lines)
+
+
+def header_offset(path):
+    '''
+    Read the headers of an uncompressed TSVx file. Returns the
+    `TSVxHeader`, and the byte offset at which the body starts, so the
+    body can be split into byte ranges.
+    '''
+    size = [0]
+
+    def lines(fp):
+        for line in fp:
+            size[0] += len(line)
+            yield line.decode("utf-8")
+
+    with open(path, "rb") as fp:
+        header = parse_header_lines(read_header_lines(lines(fp)))
+    return (header, size[0])
+
+
+def read_header_lines(stream):
+    '''
+    Read the lines of a stream which make up the TSVx headers (up to,
+    and including, the dashes before the body).
+    '''
+    lines = []
+    dashes = 0
+    for line in stream:
+        lines.append(line)
+        if len(lines) == 1 and ":" not in line:
+            dashes = 1  # No metadata section
+        if line.startswith('---'):
+            dashes += 1
+            if dashes == 2:
+                break
+    return lines
 
 
-def writer(destination):
+def parse_header_lines(lines):
     '''
-    Given an output stream, create a TSVx Writer
+    Create a `TSVxHeader` from the lines of the headers, as returned by
+    `read_header_lines`.
     '''
-    return tsv_types.TSVxWriter(destination)
+    if not lines or not lines[-1].startswith('---') or \
+       len(lines) < 3:
+        raise exceptions.TSVxFileFormatException(
+            "Incomplete or missing TSVx header")
+    try:
+        (column_names, metadata, line_headers, rest) = \
+            _parse_header(iter(lines))
+    except (ValueError, IndexError, StopIteration) as error:
+        raise exceptions.TSVxFileFormatException(
+            "Malformed TSVx header: " + str(error))
+    return tsv_types.TSVxHeader(column_names, metadata, line_headers)
 
 
-def _parse_generator(generator):
+def _parse_generator(generator, stats=False):
     '''
     From a stream, pick out the headers and metadata, and create
     a new TSVxReader based on those. Return the TSVxReader object.
     '''
+    (column_names, metadata, line_headers, generator) = \
+        _parse_header(generator)
+
+    # Finally, we create a TSVx reader based on the metadata we
+    # read
+    return tsv_types.TSVxReader(
+        column_names,
+        metadata,
+        line_headers,
+        generator,
+        stats
+    )
+
+
+def _parse_header(generator):
+    '''
+    From a stream, pick out the headers and metadata. Returns the
+    column names, metadata, line headers, and the rest of the stream.
+    '''
     # Grab the first line from the generator
     (first, generator) = helpers.peek(generator)
 
     # If it looks like there's a YAML header, read that. Otherwise, we
     # skip the header. Perhaps we should raise an exception instead?
     if ":" in first:
-        metadata = yaml.safe_load(helpers.read_to_dash(generator))
+        metadata = helpers.load_yaml(helpers.read_to_dash(generator))
     else:
         metadata = {}
 
@@ -57,11 +184,4 @@ def _parse_generator(generator):
         value = line[:-1].split('\t')[:-1]
         line_headers[key] = value
 
-    # Finally, we create a TSVx reader based on the metadata we
-    # read
-    return tsv_types.TSVxReader(
-        column_names,
-        metadata,
-        line_headers,
-        generator
-    )
+    return (column_names, metadata, line_headers, generator)